@@ -1,8 +1,10 @@
 import customtkinter
-import os, re, random
+import os, re, random, sys
 from PIL import Image
 from options import *
 from scorers import Scorer, NoFiles, NoScores
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from modules.thumbnails import ThumbnailCache
 
 TEXT_HEIGHT=100
 
@@ -97,7 +99,8 @@ def main():
 
     callbacks= (check_quit, scorer.score, do_score_actions, basic_stats)
 
-    ImageHolder( app, data.image_iterator(), text_source=textfile_loader, callbacks=callbacks, on_dones=on_dones, size_calc=get_size, imgs_per_item=data.images_per_item )
+    thumbnails = ThumbnailCache(source_directory, display_height) if display_height else None
+    ImageHolder( app, data.image_iterator(), text_source=textfile_loader, callbacks=callbacks, on_dones=on_dones, size_calc=get_size, imgs_per_item=data.images_per_item, thumbnails=thumbnails )
         
     app.mainloop()
 
@@ -150,7 +153,7 @@ class DataHolder():
         return img.height / img.width
 
 class ImageHolder():
-    def __init__(self, app:customtkinter.CTk, data_holder:iter, text_source:callable=lambda a:None, callbacks=(), on_dones=(), size_calc=None, imgs_per_item=2):
+    def __init__(self, app:customtkinter.CTk, data_holder:iter, text_source:callable=lambda a:None, callbacks=(), on_dones=(), size_calc=None, imgs_per_item=2, thumbnails:ThumbnailCache=None):
         """
         Create an ImageHolder to display images as part of a CTk app, and respond to keypresses.
         app - the app of which this is part
@@ -161,6 +164,7 @@ class ImageHolder():
         size_calc - a callable that calculates sizes, signature (aspect_ratio, n=1, padding=TEXT_HEIGHT), returning (size:str, w:int, h:int) where 
                     size is of the form "wxh" suitable for tkinter, and w and h are width and height of a single image.
         imgs_per_item - a hint at the expected number of images in an item
+        thumbnails - an optional ThumbnailCache from which scaled images are read instead of the originals
 
         Any callback can rise StopIteration() to terminate the program - no further callbacks are processed, the on_dones are 
         """
@@ -175,6 +179,7 @@ class ImageHolder():
             lab.grid(row=0, column=i)
         self.text_line.grid(row=1,column=0, columnspan=imgs_per_item)
         self.text_source = text_source
+        self.thumbnails = thumbnails
         self.next_image()
         app.bind("<KeyRelease>", self.keyup)
 
@@ -183,7 +188,7 @@ class ImageHolder():
         newtext = self.text_source(self.img_filepaths[0]) or ""
 
         for i, img_filepath in enumerate(self.img_filepaths):
-            img = Image.open(img_filepath)
+            img = self.thumbnails.get(img_filepath) if self.thumbnails else Image.open(img_filepath)
             sizes = self.size_calc(img.height/img.width, len(self.img_filepaths))
             self.app.geometry(sizes[0])
             self.img = customtkinter.CTkImage(light_image=img, size=sizes[1:])
@@ -0,0 +1,115 @@
+import argparse, os, sys, json, time, struct, zlib, subprocess, tempfile, statistics
+
+HEAVY = ('numpy', 'scipy', 'matplotlib', 'PIL', 'tkinter', 'customtkinter')
+ROOT = os.path.dirname(os.path.abspath(__file__))
+
+CHILD = '''
+import sys, json, runpy
+sys.path.insert(0, {root!r})
+sys.argv = {argv!r}
+{code}
+print("\\n" + json.dumps(sorted(m for m in {heavy!r} if m in sys.modules)))
+'''
+
+RUN = "runpy.run_path(sys.argv[0], run_name='__main__')"
+HELP = "try:\n    " + RUN + "\nexcept SystemExit:\n    pass"
+SESSION = "import image_ab_scorer\nimage_ab_scorer.parse_arguments()\nimage_ab_scorer.Session()"
+
+def cases(directory):
+    '''
+    (name, argv, code, modules it mustn't import) for each headless path through the tools; {run} in argv is the run number.
+    Each case is run once first to warm up (building the image index, and filling the disk cache), and not timed.
+    '''
+    images = os.path.join(directory, "images")
+    return [
+        ("interpreter",                  [""], "pass", ()),
+        ("image_ab_scorer (import)",     [""], "import image_ab_scorer", ('tkinter', 'customtkinter', 'scipy', 'matplotlib', 'PIL')),
+        ("image_ab_scorer session",      ["image_ab_scorer.py", "-d", images, "-r", "--thumbnail_cache=0", "--savefile=session.csv"], SESSION,
+                                         ('tkinter', 'customtkinter', 'scipy', 'matplotlib', 'PIL')),
+        ("compare_scorefiles --no_plot", [os.path.join(ROOT, "compare_scorefiles.py"), "-d", images, "-n"], RUN, ('tkinter', 'customtkinter', 'matplotlib', 'PIL')),
+        ("copy_best",                    [os.path.join(ROOT, "copy_best.py"), "-d", images, "--save_in", os.path.join(directory, "best_{run}"), "--threshold=-1"], RUN,
+                                         ('tkinter', 'customtkinter', 'scipy', 'matplotlib', 'PIL')),
+        ("convert_scorefile",            [os.path.join(ROOT, "convert_scorefile.py"), "-d", images, "scores.csv", "scores_{run}.scoredb"], RUN,
+                                         ('tkinter', 'customtkinter', 'scipy', 'matplotlib', 'PIL')),
+        ("merge_shards",                 [os.path.join(ROOT, "merge_shards.py"), "-d", images, "--save_in", "merged_{run}.csv"], RUN,
+                                         ('tkinter', 'customtkinter', 'matplotlib', 'PIL')),
+        ("simulate --help",              [os.path.join(ROOT, "simulate.py"), "--help"], HELP, ('tkinter', 'customtkinter', 'scipy', 'matplotlib', 'PIL')),
+    ]
+
+def _png(width, height) -> bytes:
+    chunk = lambda kind, data : struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind + data))
+    rows = b"".join(b"\x00" + b"\x80\x80\x80" * width for _ in range(height))
+    return b"\x89PNG\r\n\x1a\n" + chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0)) + chunk(b"IDAT", zlib.compress(rows)) + chunk(b"IEND", b"")
+
+def make_directory(directory, n):
+    '''
+    n small images, and a scorefile for them
+    '''
+    images = os.path.join(directory, "images")
+    os.makedirs(images)
+    with open(os.path.join(images, "scores.csv"), 'w') as f:
+        print("relative_path,comparisons,score", file=f)
+        for i in range(n):
+            with open(os.path.join(images, f"{i:05d}.png"), 'wb') as im: im.write(_png(8, 8))
+            print(f"{i:05d}.png,{i%7},{(i%13-6)/6}", file=f)
+
+def run(argv, code, importtime=False) -> tuple[float, list[str], str]:
+    '''
+    Run code in a fresh interpreter; returns (wall seconds, the heavy modules it imported, its -X importtime output)
+    '''
+    command = [sys.executable] + (["-X", "importtime"] if importtime else []) + ["-c", CHILD.format(root=ROOT, argv=argv, code=code, heavy=HEAVY)]
+    start = time.perf_counter()
+    result = subprocess.run(command, capture_output=True, text=True, cwd=os.path.dirname(argv[0]) or None)
+    seconds = time.perf_counter() - start
+    if result.returncode: raise RuntimeError(f"{argv} failed:\n{result.stderr}")
+    return seconds, json.loads(result.stdout.strip().splitlines()[-1]), result.stderr
+
+def slowest_imports(importtime_output, n=10) -> list[tuple[int, str]]:
+    '''
+    The n imports with the largest cumulative time (microseconds) in -X importtime output
+    '''
+    found = []
+    for line in importtime_output.splitlines():
+        if line.startswith("import time:") and "|" in line:
+            _, cumulative, name = line[len("import time:"):].split("|")
+            if cumulative.strip().isdigit(): found.append((int(cumulative), name.rstrip()))
+    return sorted(found, reverse=True)[:n]
+
+def parse_arguments():
+    parser = argparse.ArgumentParser("Time how long each tool takes to start, and check that it doesn't import what its path doesn't need")
+    parser.add_argument('--repeats', type=int, default=5, help="Runs of each case (the median is reported)")
+    parser.add_argument('--images', type=int, default=200, help="Number of images in the test directory")
+    parser.add_argument('--baseline', default=None, help="Compare with the times in this json file (see --save)")
+    parser.add_argument('--tolerance', type=float, default=1.25, help="Fail if a case is slower than this multiple of its baseline")
+    parser.add_argument('--save', default=None, help="Save the times in this json file, to use as a baseline later")
+    parser.add_argument('--importtime', action="store_true", help="Also list the slowest imports of each case")
+    return parser.parse_args()
+
+def main():
+    args = parse_arguments()
+    baseline = {}
+    if args.baseline and os.path.exists(args.baseline):
+        with open(args.baseline) as f: baseline = json.load(f)
+    times, failures = {}, []
+    with tempfile.TemporaryDirectory() as directory:
+        make_directory(directory, args.images)
+        print("{:<30} {:>9} {:>9}  {}".format("case", "ms", "baseline", "heavy modules"))
+        for name, argv, code, forbidden in cases(directory):
+            run([a.format(run="warmup") for a in argv], code)
+            runs = [run([a.format(run=i) for a in argv], code) for i in range(args.repeats)]
+            times[name] = statistics.median(seconds for seconds, _, _ in runs)
+            heavy = runs[-1][1]
+            print("{:<30} {:>9.1f} {:>9}  {}".format(name, 1e3*times[name], f"{1e3*baseline[name]:.1f}" if name in baseline else "", ",".join(heavy)))
+            if (imported := [m for m in heavy if m in forbidden]): failures.append(f"{name} imported {','.join(imported)}")
+            if name in baseline and times[name] > args.tolerance * baseline[name]:
+                failures.append(f"{name} took {1e3*times[name]:.1f} ms, more than {args.tolerance} x {1e3*baseline[name]:.1f} ms")
+            if args.importtime:
+                for microseconds, module in slowest_imports(run([a.format(run="x") for a in argv], code, importtime=True)[2]):
+                    print("{:>40} {:>9.1f} ms".format(module.strip(), microseconds/1e3))
+    if args.save:
+        with open(args.save, 'w') as f: json.dump(times, f, indent=2)
+    for failure in failures: print("FAIL: " + failure)
+    sys.exit(1 if failures else 0)
+
+if __name__=="__main__":
+    main()
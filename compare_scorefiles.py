@@ -1,11 +1,10 @@
-from modules.scoring import ImageDatabase
-import scipy
-import matplotlib.pyplot as plt
-import os, argparse, time
+from modules.ranks import RankCheckpoints, RankMatrix, read_ranks, kendall
+from concurrent.futures import ProcessPoolExecutor
+import os, argparse, csv
 
 class CommentArgumentParser(argparse.ArgumentParser):
     def convert_arg_line_to_args(self, arg_line):
-        if arg_line.startswith('#'): return [] 
+        if arg_line.startswith('#'): return []
         line = "=".join(a.strip() for a in arg_line.split('='))
         return [line,] if len(line) else []
 
@@ -13,60 +12,95 @@ def parse_arguments():
     global args
     parser = CommentArgumentParser("Score a set of images by a series of AB comparisons", fromfile_prefix_chars='@')
     parser.add_argument('-d', '--directory', help="Top level directory", required=True)
-    parser.add_argument('-n', '--no_plot', action="store_true", help="Don't show a graph")
+    parser.add_argument('-n', '--no_plot', action="store_true", help="Don't save a graph")
     parser.add_argument('-s', '--scores', default="scores.csv", help="Filename of scores file (relative to top level directory)")
     parser.add_argument('-m', '--model_scorefile', help="Plot comparison with model scorefile")
+    parser.add_argument('--csv', default=None, help="Save the correlations here (relative to top level directory; default [scores].convergence.csv)")
+    parser.add_argument('--plot', default=None, help="Save the graph here (relative to top level directory; default [scores].convergence.png)")
+    parser.add_argument('--no_kendall', action="store_true", help="Only calculate spearman (Kendall tau takes much longer for large collections)")
+    parser.add_argument('--workers', type=int, default=1, help="Number of processes for reading scorefiles and calculating Kendall tau")
     args, unknown = parser.parse_known_args()
     if unknown: print(f"Ignoring unknown arguments {unknown}")
-    
-class Cache:
-    cache = {}
-    @classmethod
-    def get(cls, a):
-        if not a in cls.cache:
-            id = ImageDatabase(args.directory,loadfrom=a,add_files=False,remove_files=False)
-            id.sort()
-            cls.cache[a] = { f : i for i,f in enumerate(id.image_records) }
-        return cls.cache[a]
 
-def compare(files):
-    ranks = list(Cache.get(a) for a in files)
-    results = []
-    for rank_b, name_b in zip(ranks, files):
-        if name_b!=files[0]:
-            results.append(_compare(ranks[0],rank_b,files[0][:-4],name_b[:-4]))
-    return results
+def backfill(files, numbers, executor):
+    '''
+    Save a rank checkpoint for any numbered scorefile that doesn't have one yet (the scorefiles are read in parallel)
+    '''
+    missing = [(f, n) for f, n in zip(files, numbers) if n not in checkpoints]
+    mapper = executor.map if executor else map
+    for (_, n), (paths, ranks) in zip(missing, mapper(read_ranks, [os.path.join(args.directory, f) for f, _ in missing])):
+        checkpoints.save(n, paths, ranks)
 
-def _compare(rank_map_a,rank_map_b,name_a,name_b) -> float:
-    ranks_a = [ rank_map_a[f] for f in rank_map_a ]
-    ranks_b = [ rank_map_b[f] for f in rank_map_a ]
+def _kendall(pair) -> float: return kendall(*pair)
 
-    spearman = scipy.stats.spearmanr(ranks_a,ranks_b)
-    print("{:>30} v {:<30} spearman {:>6.4f} (p={:>8.2})".format(name_a, name_b, spearman.statistic, spearman.pvalue))
-    return spearman.statistic
+def kendalls(pairs, executor) -> list[float]:
+    '''
+    Kendall tau of each pair of rank arrays (None for each with --no_kendall)
+    '''
+    if args.no_kendall: return [None] * len(pairs)
+    return list((executor.map if executor else map)(_kendall, pairs))
 
 def find_numbered_files():
     nf = []
     for f in os.listdir(args.directory):
-        if os.path.splitext(f)[1]==".csv":
-            if f.startswith(os.path.splitext(args.scores)[0]+"_"): 
+        if os.path.splitext(f)[1]==os.path.splitext(args.scores)[1]:
+            if f.startswith(os.path.splitext(args.scores)[0]+"_"):
                 number = int(os.path.splitext(f)[0][len(os.path.splitext(args.scores)[0])+1:])
                 nf.append((number, f))
     nf.sort()
     return tuple(f for _,f in nf), tuple(n for n,_ in nf)
 
+def _print(name_a, name_b, rho, tau):
+    print("{:>30} v {:<30} spearman {:>6.4f}".format(name_a, name_b, rho) + (" kendall {:>6.4f}".format(tau) if tau is not None else ""))
+
+def save_plot(filepath, numbers, previous, model):
+    import matplotlib
+    matplotlib.use("Agg")
+    import matplotlib.pyplot as plt
+    figure, axes = plt.subplots(figsize=(10, 6))
+    if model is not None: axes.plot(numbers, model, label="v model")
+    axes.plot(numbers[1:], previous, label="v previous")
+    axes.set_xlabel("comparisons")
+    axes.set_ylabel("spearman")
+    axes.legend()
+    figure.savefig(filepath, dpi=100)
+    plt.close(figure)
+
 if __name__=="__main__":
     parse_arguments()
-    files, numbers = find_numbered_files()
+    stem = os.path.splitext(args.scores)[0]
+    checkpoints = RankCheckpoints(os.path.join(args.directory, stem+".ranks"))
+    executor = ProcessPoolExecutor(max_workers=args.workers) if args.workers > 1 else None
+    backfill(*find_numbered_files(), executor)
+    numbers = tuple(n for n in checkpoints.names() if isinstance(n, int))
+    name = lambda n : stem+f"_{n}"
+
+    model = checkpoints.by_id(*read_ranks(os.path.join(args.directory, args.model_scorefile))) if args.model_scorefile else None
+    matrix = RankMatrix(checkpoints, numbers)
 
-    if args.model_scorefile:
+    model_rho = model_tau = None
+    if model is not None:
         print("\n Comparison with model predictions")
-        data = compare((args.model_scorefile,)+ files)
-        if not args.no_plot: plt.plot(numbers, data)
-    
+        model_rho = matrix.against(model)
+        model_tau = kendalls([(model, row) for row in matrix.ranks], executor)
+        for n, rho, tau in zip(numbers, model_rho, model_tau): _print(os.path.splitext(args.model_scorefile)[0], name(n), rho, tau)
+
     print("\n Comparisons with previous database")
-    data = list(compare(files[i:i+2])[0] for i in range(len(files)-1))
-    if not args.no_plot:
-        plt.plot(numbers[1:],  data )
-        plt.show()
-        while(True): time.sleep(1)
\ No newline at end of file
+    previous_rho = matrix.consecutive()
+    previous_tau = kendalls(list(zip(matrix.ranks[:-1], matrix.ranks[1:])), executor)
+    for a, b, rho, tau in zip(numbers, numbers[1:], previous_rho, previous_tau): _print(name(a), name(b), rho, tau)
+    if executor: executor.shutdown()
+
+    csv_path = os.path.join(args.directory, args.csv or stem+".convergence.csv")
+    with open(csv_path, 'w', newline='') as f:
+        writer = csv.writer(f, lineterminator='\n')
+        writer.writerow(["comparisons", "spearman previous", "kendall previous"] + (["spearman model", "kendall model"] if model is not None else []))
+        for i, n in enumerate(numbers):
+            row = [n] + ([previous_rho[i-1], previous_tau[i-1]] if i else ["", ""])
+            if model is not None: row += [model_rho[i], model_tau[i]]
+            writer.writerow(["" if v is None else v for v in row])
+    print(f"\nSaved correlations in {csv_path}")
+    if not args.no_plot and numbers:
+        plot_path = os.path.join(args.directory, args.plot or stem+".convergence.png")
+        save_plot(plot_path, numbers, previous_rho, model_rho)
+        print(f"Saved graph in {plot_path}")
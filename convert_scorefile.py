@@ -0,0 +1,19 @@
+import argparse
+
+from modules.scoring import ImageDatabase
+
+def parse_arguments():
+    parser = argparse.ArgumentParser("Convert a scorefile between formats (.csv, .json or .scoredb, from the extension)")
+    parser.add_argument('-d', '--directory', help="Top level directory", required=True)
+    parser.add_argument('source', help="Scorefile to read (relative to top level directory)")
+    parser.add_argument('destination', help="Scorefile to write (relative to top level directory)")
+    return parser.parse_args()
+
+def main():
+    Args = parse_arguments()
+    db = ImageDatabase(base_directory=Args.directory, loadfrom=Args.source, add_files=False, remove_files=False)
+    db.save(Args.destination)
+    print(f"Converted {db.image_count} records from {Args.source} to {Args.destination}")
+
+if __name__=='__main__':
+    main()
@@ -1,6 +1,8 @@
-import argparse, os, shutil
+import argparse, os
+import numpy as np
 
-from modules.scoring import ImageDatabase, ImageRecord
+from modules.scoring import ImageDatabase
+from modules.export import Exporter, MODES, destination_names, top, top_percent
 
 class CommentArgumentParser(argparse.ArgumentParser):
     def convert_arg_line_to_args(self, arg_line):
@@ -13,26 +15,36 @@ def parse_arguments():
     parser.add_argument('-d', '--directory', help="Top level directory", required=True)
     parser.add_argument('--save_in', help="Directory to save in", required=True)
     parser.add_argument('-s', '--scores', default="scores.csv", help="Filename of scores file (relative to top level directory) from which scores are loaded")
-    parser.add_argument('--threshold', default=0.0, type=float, help="Keep images scoring above threshold")
+    parser.add_argument('--threshold', default=None, type=float, help="Keep images scoring above threshold (default 0.0 unless --top or --percentile is given)")
+    parser.add_argument('--top', default=None, type=int, help="Keep the top N images")
+    parser.add_argument('--percentile', default=None, type=float, help="Keep the top percentage of images (eg 10 for the best 10%%)")
+    parser.add_argument('--mode', choices=MODES, default='copy', help="copy the images, or hardlink or reflink them (falling back to a copy where not possible)")
+    parser.add_argument('--workers', default=8, type=int, help="Number of files to copy at once")
     parser.add_argument('--savefile', default=None, help="Save a scorefile for the kept images")
 
     return parser.parse_args()
 
-def get_name(root, rel, i):
-    return os.path.join(root, os.path.splitext(rel)[0]+f"_{i}"+os.path.splitext(rel)[1]) if i else os.path.join(root, rel)
-
 def main():
     Args = parse_arguments()
-    db = ImageDatabase(base_directory=Args.directory, loadfrom=Args.scores, trust_extensions=[".png",".jpg"])
-    db.remove(test=lambda a:a.score<Args.threshold)
-    if not os.path.exists(Args.save_in): os.makedirs(Args.save_in)
-    for record in db.records:
-        print(f"{os.path.join(Args.save_in, record.relative_path)}")
-        i = 0
-        while os.path.exists(get_name(Args.save_in, record.relative_path, i)): i = i + 1
-        shutil.copy(os.path.join(Args.directory, record.relative_path), get_name(Args.save_in, record.relative_path, i))
+    db = ImageDatabase(base_directory=Args.directory, loadfrom=Args.scores, add_files=False, remove_files=False)
+    scores = db.score_array
+    keep = np.ones(len(scores), dtype=bool)
+    if Args.threshold is not None or (Args.top is None and Args.percentile is None): keep &= scores >= (Args.threshold or 0.0)
+    if Args.top is not None: keep &= top(scores, Args.top)
+    if Args.percentile is not None: keep &= top_percent(scores, Args.percentile)
+    db.remove(mask=~keep)
+    db.sort(reverse=True)
+
+    relative_paths = db.paths_in_order
+    pairs = list(zip((os.path.join(Args.directory, rp) for rp in relative_paths), destination_names(Args.save_in, relative_paths)))
+    exporter = Exporter(Args.mode, Args.workers)
+    for i, (source, destination, error) in enumerate(exporter.export(pairs)):
+        if error: print(f"Failed to export {source} to {destination}: {error}")
+        if (i+1) % 1000 == 0: print(exporter.printable)
+    print(exporter.printable)
+
     if Args.savefile:
-        db.save_csv(os.path.join(Args.save_in, Args.savefile))
+        db.save(os.path.join(Args.save_in, Args.savefile))
 
 if __name__=='__main__':
     main()
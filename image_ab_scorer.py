@@ -1,8 +1,16 @@
-import random, math, time, argparse, os
-import customtkinter
-import scipy
+import time, argparse, os
 
 from modules.scoring import ImageDatabase, ImageRecord, ScoreUpdater
+from modules.choosing import ImageChooser, focus_band
+from modules.active import InformationChooser, BoundaryChooser
+from modules.prefetch import Prefetcher
+from modules.thumbnails import ThumbnailCache
+from modules.scorefiles import snapshot
+from modules.journal import Journal
+from modules.bradley_terry import BradleyTerryUpdater
+from modules.ranks import RankTracker, RankCheckpoints
+from modules.tournament import Tournament
+from modules.profiling import profiler, timer, timed, capture
 
 class CommentArgumentParser(argparse.ArgumentParser):
     def convert_arg_line_to_args(self, arg_line):
@@ -19,19 +27,52 @@ def parse_arguments():
     parser.add_argument('-r', '--restart', action="store_true", help="Force a restart (don't reload scores file even if present)")
     parser.add_argument('--savefile', default=None, help="Save scores here (relative to top level directory) instead of in the scores file")
     parser.add_argument('--trust', type=to_string_list, help="Comma separated list of extensions that are trusted to be images (eg -t=.jpg,.png)")
+    parser.add_argument('--model_scorefile', default=None, help="Seed the scores of images not yet compared from this scorefile (eg a model's predictions, relative to top level directory)")
+    parser.add_argument('--model_spread', type=float, default=0.5, help="Standard deviation given to seeded scores when too few compared images are in the model scorefile to calibrate it (requires --model_scorefile)")
+    parser.add_argument('--background_scan', action="store_true", help="Start comparing before the directory scan is complete (new images are added as they are found)")
 
+    parser.add_argument('--chooser', choices=['lcw','information','boundary'], default='lcw', help="lcw: prefer less compared images (see --lcw). information: prefer the most informative comparisons. boundary: decide which images are in the top (see --boundary_top, --boundary_threshold)")
     parser.add_argument('--lcw', type=float, default=0.4, help="Weighting priority towards less frequently compared images (0-0.99)")
     parser.add_argument('--height', type=int, default=768, help="Height of window")
     parser.add_argument('--number', type=int, default=100, help="Number of sets of images to compare")
+    parser.add_argument('--tournament', action="store_true", help="Rank all the images with a comparison sort, showing just the pairs it needs (progress is kept between runs)")
     parser.add_argument('--number_to_compare', type=int, default=2, help="Number of images to choose from")
+    parser.add_argument('--rank_all', action="store_true", help="Put all the images shown in order (press their numbers best first; backspace to undo) instead of just picking the best")
+    parser.add_argument('--focus_top', type=float, default=None, help="Only compare images in this top fraction (eg 0.2), reaching down by --focus_width")
+    parser.add_argument('--focus_threshold', type=float, default=None, help="Only compare images scoring within --focus_width of this score")
+    parser.add_argument('--focus_width', type=float, default=0.5, help="Width of the focus band (requires --focus_top or --focus_threshold)")
+    parser.add_argument('--boundary_top', type=int, default=None, help="Find the best N images (requires --chooser=boundary)")
+    parser.add_argument('--boundary_threshold', type=float, default=None, help="Find the images scoring above this (requires --chooser=boundary)")
+    parser.add_argument('--boundary_z', type=float, default=2.0, help="Width, in standard deviations, of the interval within which an image's score is uncertain (requires --chooser=boundary)")
+    parser.add_argument('--dedupe', choices=['none','exclude','merge'], default='none', help="Near-duplicate images: exclude shows only one of each group; merge also gives them all its score")
+    parser.add_argument('--dedupe_threshold', type=int, default=6, help="Images are near-duplicates if their perceptual hashes differ in at most this many bits (of 64)")
+    parser.add_argument('--compact_every', type=int, default=50, help="Save the scores file in the background after this many comparisons (every comparison is journalled immediately)")
+    parser.add_argument('--prefetch', type=int, default=4, help="Number of sets of images to prepare in the background")
+    parser.add_argument('--thumbnail_cache', type=int, default=500, help="Size limit (MB) of the cache of scaled images (0 to disable)")
+    parser.add_argument('--serve', type=int, default=None, help="Instead of opening a window, serve comparisons to browsers on this port (Ctrl-C to stop)")
+    parser.add_argument('--host', default="127.0.0.1", help="Address to serve on (requires --serve; 0.0.0.0 for all interfaces)")
 
     parser.add_argument('--k', type=float, default=0.7, help="K value for score updates")
+    parser.add_argument('--updater', choices=['elo','bt'], default='elo', help="elo: online updates only. bt: also refit all scores to the whole comparison history (Bradley-Terry) when saving")
     parser.add_argument('--weight_by_speed', action="store_true", help="Weight fast responses more (see also --default_seconds, --weight_min, --weight_max)")
     parser.add_argument('--default_seconds', type=float, default=1.5, help="Typical response time (requires --weight_by_speed)")
     parser.add_argument('--weight_min', type=float, default=0.5, help="Minimum weighting for slow responses (requires --weight_by_speed)")
     parser.add_argument('--weight_max', type=float, default=2, help="Maximum weighting for fase responses (requires --weight_by_speed)")
 
+    parser.add_argument('--profile', action="store_true", help="At the end, print how long each stage took (percentiles), and save them in profile.json and profile.csv")
+    parser.add_argument('--capture', choices=['cprofile','tracemalloc'], default=None, help="Also run under cProfile (saved in profile.prof) or tracemalloc (saved in memory.txt)")
+
     Args.namespace = parser.parse_args()
+    if Args.namespace.tournament and (Args.namespace.serve or Args.namespace.number_to_compare != 2):
+        parser.error("--tournament compares pairs, in the window (not with --serve or --number_to_compare)")
+    if Args.namespace.tournament and (Args.namespace.focus_top is not None or Args.namespace.focus_threshold is not None):
+        parser.error("--tournament ranks every image, so can't be used with --focus_top or --focus_threshold")
+    if Args.namespace.chooser=='boundary' and (Args.namespace.boundary_top is None) == (Args.namespace.boundary_threshold is None):
+        parser.error("--chooser=boundary needs one of --boundary_top or --boundary_threshold")
+    if Args.namespace.boundary_top is not None and Args.namespace.boundary_top < 1:
+        parser.error("--boundary_top must be at least 1")
+    if Args.namespace.chooser=='boundary' and (Args.namespace.focus_top is not None or Args.namespace.focus_threshold is not None):
+        parser.error("--chooser=boundary already concentrates on the top, so can't be used with --focus_top or --focus_threshold")
     print(Args.namespace)
 
 class _Args(object):
@@ -41,130 +82,268 @@ class _Args(object):
     def __getattr__(self, attr):
         if hasattr(self.namespace, attr): return getattr(self.namespace,attr)
         if attr=='load_from': return None if self.namespace.restart else self.namespace.scores
+        if attr=='index_file': return os.path.splitext(self.namespace.scores)[0]+".index.json"
+        if attr=='save_in': return self.namespace.savefile or self.namespace.scores
+        if attr=='journal_file': return os.path.join(self.namespace.directory, os.path.splitext(self.save_in)[0]+".journal.jsonl")
+        if attr=='history_file': return os.path.join(self.namespace.directory, os.path.splitext(self.save_in)[0]+".history.jsonl")
+        if attr=='tournament_file': return os.path.join(self.namespace.directory, os.path.splitext(self.save_in)[0]+".tournament.json")
+        if attr=='ranking_file': return os.path.splitext(self.save_in)[0]+".ranking.csv"
+        if attr=='ranks_directory': return os.path.join(self.namespace.directory, os.path.splitext(self.save_in)[0]+".ranks")
         raise KeyError(attr)
     
 Args = _Args()
 
 def clamp(n, min, max): return min if n < min else (max if n > max else n)
 
-class ImageChooser:
-    def __init__(self, image_records:list[ImageRecord], weighter:callable):
-        self.image_records = image_records
-        self.weighter = weighter
-
-    def pick_images(self, number) -> list[ImageRecord]:
-        weights = [self.weighter(x) for x in self.image_records]
-        choices = random.choices(self.image_records, weights=weights, k=number-1)
-        choices.append(random.choice(self.image_records))
-        for i,c in enumerate(choices):
-            if c in choices[i+1:]:
-                return self.pick_images(number)
-        return choices
-    
-    @classmethod
-    def from_database(cls, database:ImageDatabase, weighter:callable=None, low_count_weight:float=None):
-        weighter = weighter or cls.weighter(low_count_weight)
-        return ImageChooser(database.records, weighter)
-
-    @classmethod
-    def weighter(cls, low_count_weight=0.0):
-        if low_count_weight:
-            def lcw(ir:ImageRecord):
-                return math.pow(1-low_count_weight,ir.comparisons)
-            return lcw
-        return lambda a:1.0
-
-class TheApp:
+class Session:
+    '''
+    The database, image chooser and score updater, and the journal, shared by the window and the server
+    '''
     def __init__(self):
-        self.app = customtkinter.CTk()
-        self.app.title("")
-        self.database = ImageDatabase(Args.directory, loadfrom=Args.load_from, trust_extensions=Args.trust)
+        self.journal = Journal(Args.journal_file, Args.history_file)
+        with timer("load database"): self.database = ImageDatabase(Args.directory, loadfrom=Args.load_from, trust_extensions=Args.trust, index_file=Args.index_file,
+                                      background_scan=Args.background_scan, journal=None if Args.restart else self.journal)
+        while self.database.scanning and self.database.image_count < max(2, Args.number_to_compare):
+            self.database.add_scanned()
+            time.sleep(0.05)
+        self.database.add_scanned()
+        if Args.model_scorefile: self.database.seed(Args.model_scorefile, Args.model_spread)
 
         self.database.sort(reverse=True)
-        self.start_order = { f:i for i,f in enumerate(self.database.image_records) }
+        self.rank_tracker = RankTracker(self.database)
+        self.checkpoints = RankCheckpoints(Args.ranks_directory)
+
+        self.duplicates = None
+        if Args.dedupe!='none':
+            from modules.dedupe import Duplicates
+            self.duplicates = Duplicates.find(self.database, Args.dedupe_threshold)
+            print(self.duplicates.printable)
+            if Args.dedupe=='merge': self.duplicates.merge()
+        exclude = self.duplicates.excluded if self.duplicates else None
 
-        print(f"Comparing {len(self.database.records)} images")
-        assert len(self.database.records) >= 2
-        self.image_chooser = ImageChooser.from_database(self.database, low_count_weight=Args.lcw)
-        self.score_updater = ScoreUpdater(Args.k)
+        print(f"Comparing {len(self.database.records) - len(exclude or ())} images")
+        assert len(self.database.records) - len(exclude or ()) >= 2
+        band = focus_band(self.database.score_array, Args.focus_top, Args.focus_threshold, Args.focus_width)
+        self.tournament = None
+        with timer("build chooser"):
+            if Args.tournament:
+                self.tournament = self.image_chooser = Tournament(self.database, Args.tournament_file, self.journal.all_entries(), exclude)
+                print(f"Tournament: {self.tournament.printable}")
+            elif Args.chooser=='information': self.image_chooser = InformationChooser.from_database(self.database, exclude=exclude, band=band)
+            elif Args.chooser=='boundary':
+                self.image_chooser = BoundaryChooser.from_database(self.database, top=Args.boundary_top, threshold=Args.boundary_threshold, z=Args.boundary_z, exclude=exclude)
+                print(self.image_chooser.printable)
+            else: self.image_chooser = ImageChooser.from_database(self.database, low_count_weight=Args.lcw, exclude=exclude, band=band)
+        if band and getattr(self.image_chooser, 'members', None): print("Focusing on {:.0f} images scoring {:.3f} to {:.3f}".format(self.image_chooser.members.total, *band))
+        self.score_updater = BradleyTerryUpdater(Args.k) if Args.updater=='bt' else ScoreUpdater(Args.k)
         self.count = 0
+        self.total_comparisons = self.database.total_comparisons
+        self.thumbnails = ThumbnailCache(Args.directory, Args.height, max_bytes=Args.thumbnail_cache*1024*1024) if Args.thumbnail_cache else None
+        self.starttime = time.monotonic()
 
-        maw = self.database.max_aspect_ratio()
-        self.app.geometry(f"{Args.height*maw*Args.number_to_compare}x{Args.height}")
-        self.image_labels = [customtkinter.CTkLabel(self.app, text="") for _ in range(Args.number_to_compare)]
-        for i, label in enumerate(self.image_labels):
-            label.grid(row=0, column=2*i)
-            if i: self.app.grid_columnconfigure(2*i-1, weight=1)
+    def add_scanned(self) -> list[ImageRecord]:
+        if (new_records := self.database.add_scanned()):
+            self.database.apply_model([r.slot for r in new_records])
+            self.image_chooser.extend(new_records)
+        return new_records
 
-        self.app.bind("<KeyRelease>", self.keyup)
-        self.pick_images()
+    def k_fac(self, time_taken):
+        return clamp(Args.default_seconds / time_taken, Args.weight_min, Args.weight_max) if Args.weight_by_speed and time_taken else 1.0
 
-        self.starttime = time.monotonic()
-        
-    def pick_images(self):
-        self.image_records = self.image_chooser.pick_images(Args.number_to_compare)
-        for i, image_record in enumerate(self.image_records):
-            im = self.database.get_image(image_record)
-            try:
-                self.image_labels[i].configure(image = customtkinter.CTkImage(light_image=im, size=(int(Args.height*im.width/im.height),Args.height)))
-            except:
-                print(image_record)
-        self.lasttime = time.monotonic()
+    def entry(self, winner:ImageRecord, losers:list[ImageRecord], k_fac, **kwargs) -> dict:
+        return Journal.make_entry(self.total_comparisons, winner.relative_path, [r.relative_path for r in losers], Args.k, k_fac, **kwargs)
+
+    def apply(self, winner:ImageRecord, losers:list[ImageRecord], k_fac, ranked=False):
+        '''
+        Update the scores for a judgement: winner chosen from winner + losers, or if ranked, the images put in that order
+        '''
+        if ranked: self.score_updater.update_ranking([winner] + losers, k_fac=k_fac)
+        else:
+            for loser in losers: self.score_updater.update_scores(winner = winner, loser=loser, k_fac=k_fac)
+        self.total_comparisons += len(losers) * (len(losers) + 1) if ranked else 2*len(losers)
+        changed = [winner] + losers
+        if Args.dedupe=='merge':
+            changed += self.duplicates.propagate(changed)
+        if self.tournament: self.tournament.answer(winner, losers)
+        self.image_chooser.refresh(changed)
+        self.rank_tracker.refresh(changed)
+        self.count += 1
+
+    @property
+    def finished(self) -> bool:
+        return self.count >= Args.number or (self.tournament is not None and self.tournament.done)
+
+    @timed("checkpoint")
+    def checkpoint(self, database:ImageDatabase=None):
+        '''
+        Save the database (or a copy of it taken by the caller) in the background, folding the journal into it
+        '''
+        database = self.database.copy() if database is None else database
+        def save():
+            database.sort(reverse=True)
+            database.save(Args.save_in)
+        self.journal.compact(save)
 
+    @timed("save")
     def save(self):
+        if self.tournament and self.tournament.done:
+            self.tournament.finish(self.journal.all_entries())
+            self.rank_tracker.rebuild()
+        elif Args.updater=='bt' and self.score_updater.refit(self.database, self.journal.all_entries()):
+            if Args.dedupe=='merge': self.duplicates.merge()
+            self.rank_tracker.rebuild()
         self.database.sort(reverse=True)
-        savein = Args.savefile or Args.scores
-        also_savein = os.path.splitext(savein)[0]+f"_{self.database.total_comparisons}"+os.path.splitext(savein)[1]
-        for filename in [savein, also_savein]:
-            filepath = os.path.join(Args.directory, filename)
-            if filepath.endswith("csv"): self.database.save_csv(filepath)
-            else: self.database.save_scores(filepath)
+        self.checkpoints.save_database(self.database.total_comparisons, self.database)
+        also_savein = os.path.splitext(Args.save_in)[0]+f"_{self.database.total_comparisons}"+os.path.splitext(Args.save_in)[1]
+        self.journal.compact(lambda : self.database.save(Args.save_in), background=False)
+        self.journal.close()
+        snapshot(os.path.join(Args.directory, Args.save_in), os.path.join(Args.directory, also_savein))
+        if self.tournament and self.tournament.done:
+            self.database.save_csv(Args.ranking_file)
+            print(f"Tournament complete: ranking saved in {Args.ranking_file}")
 
     def stats(self):
 
-        print("{:>6.3f} s/image".format((time.monotonic()-self.starttime)/self.count))
+        print("{:>6.3f} s/image".format((time.monotonic()-self.starttime)/max(1, self.count)))
 
-        spearman = scipy.stats.spearmanr([ self.start_order[f] for f in self.start_order ],
-                                            [ self.start_order[f] for f in self.database.image_records ])
+        spearman = self.rank_tracker.spearman
         
-        summary = self.database.printable + " " + self.score_updater.printable + "spearman start-end: {:>6.4f}".format(spearman.statistic)
+        summary = self.database.printable + " " + self.score_updater.printable + "spearman start-end: {:>6.4f}".format(spearman)
         print(summary)
+        if isinstance(self.image_chooser, BoundaryChooser): print(self.image_chooser.printable)
         with open('summary.txt','a') as f: print(summary, file=f)
 
         if not os.path.exists('summary.csv'):
             with open('summary.csv', 'w') as f: print(",".join(self.database.for_csv_headers + self.score_updater.for_csv_headers + ("spearman start-end",)), file=f)
         with open('summary.csv','a') as f: 
-            to_csv = (str(x) for x in (self.database.for_csv + self.score_updater.for_csv + (spearman.statistic,)))
+            to_csv = (str(x) for x in (self.database.for_csv + self.score_updater.for_csv + (spearman,)))
             print(",".join(to_csv),file=f)
 
-    def update_scores(self, win):
-        time_taken = time.monotonic() - self.lasttime
-        k_fac = clamp(Args.default_seconds / time_taken, Args.weight_min, Args.weight_max) if Args.weight_by_speed else 1.0
-        for i in range(Args.number_to_compare):
-            if i!=win: self.score_updater.update_scores(winner = self.image_records[win], loser=self.image_records[i], k_fac=k_fac)
-        self.count += 1
+class TheApp(Session):
+    def __init__(self):
+        import customtkinter
+        self.app = customtkinter.CTk()
+        self.app.title("")
+        super().__init__()
+
+        self.max_aspect_ratio = self.database.max_aspect_ratio()
+        self.app.geometry(f"{Args.height*self.max_aspect_ratio*Args.number_to_compare}x{Args.height}")
+        self.image_labels = [customtkinter.CTkLabel(self.app, text="", compound="top", font=("", 32)) for _ in range(Args.number_to_compare)]
+        for i, label in enumerate(self.image_labels):
+            label.grid(row=0, column=2*i)
+            if i: self.app.grid_columnconfigure(2*i-1, weight=1)
+
+        self.prefetcher = Prefetcher(self.database, self.image_chooser, Args.number_to_compare, Args.height, depth=Args.prefetch,
+                                     wrap=lambda im:customtkinter.CTkImage(light_image=im, size=im.size), thumbnails=self.thumbnails)
+        self.app.bind("<KeyRelease>", self.keyup)
+        if self.finished: self.app.after(0, self.finish)
+        else: self.pick_images()
 
+        self.starttime = time.monotonic()
+        
+    def add_scanned(self) -> list[ImageRecord]:
+        '''
+        As Session.add_scanned, and widen the window if a new image needs it
+        '''
+        new_records = super().add_scanned()
+        if new_records and (maw := self.database.max_aspect_ratio([r.relative_path for r in new_records])) > self.max_aspect_ratio:
+            self.max_aspect_ratio = maw
+            self.app.geometry(f"{Args.height*maw*Args.number_to_compare}x{Args.height}")
+        return new_records
+
+    @timed("pick_images")
+    def pick_images(self):
+        self.add_scanned()
+        self.image_records, images = self.prefetcher.next()
+        self.ranking:list[int] = []
+        with timer("configure"):
+            for i, image_record in enumerate(self.image_records):
+                try:
+                    if isinstance(images[i], Exception): raise images[i]
+                    self.image_labels[i].configure(image = images[i], text="")
+                except:
+                    print(image_record)
+        self.lasttime = time.monotonic()
+
+    @timed("update_scores")
+    def update_scores(self, win, ranking:list[int]=None):
+        '''
+        Apply the choice of image win, or a ranking (indices of all the images shown, best first)
+        '''
+        k_fac = self.k_fac(time.monotonic() - self.lasttime)
+        order = ranking or [win] + [i for i in range(len(self.image_records)) if i!=win]
+        winner, losers = self.image_records[order[0]], [self.image_records[i] for i in order[1:]]
+        extra = { "ranked" : True } if ranking else {}
+        with timer("journal"): self.journal.record(self.entry(winner, losers, k_fac, **extra))
+        self.apply(winner, losers, k_fac, ranked=bool(ranking))
+        self.prefetcher.invalidate(self.image_records)
+        if Args.compact_every and self.count % Args.compact_every == 0 and self.count < Args.number: self.checkpoint()
+
+    def rank(self, k) -> bool:
+        '''
+        Add the image whose number was pressed to the ranking (backspace removes the last); True once all are ranked
+        '''
+        if k.keysym=='BackSpace' and self.ranking:
+            self.image_labels[self.ranking.pop()].configure(text="")
+        elif k.char and k.char in "123456789"[:Args.number_to_compare] and (i := int(k.char)-1) not in self.ranking:
+            self.ranking.append(i)
+            self.image_labels[i].configure(text=str(len(self.ranking)))
+            if len(self.ranking) == Args.number_to_compare - 1:
+                self.ranking += [j for j in range(Args.number_to_compare) if j not in self.ranking]
+                return True
+        return False
+
+    @timed("keypress")
     def keyup(self,k):
-        if k.char in "123456789"[:Args.number_to_compare+1]: 
+        if Args.rank_all:
+            if self.rank(k):
+                self.update_scores(win=self.ranking[0], ranking=self.ranking)
+                if not self.finished: self.pick_images()
+        elif k.char in "123456789"[:Args.number_to_compare+1]: 
             self.update_scores(win=int(k.char)-1)
-            self.pick_images()
-        if self.count>=Args.number or k.char=='q':
-            self.save()
-            self.stats()
-            self.app.quit()
-        self.app.title("{:>4}/{:<4} {:>6.3f} s/image".format(self.count, Args.number, (time.monotonic()-self.starttime)/self.count))
+            if not self.finished: self.pick_images()
+        if self.finished or k.char=='q':
+            self.finish()
+        self.app.title("{:>4}/{:<4} {:>6.3f} s/image".format(self.count, Args.number, (time.monotonic()-self.starttime)/max(1, self.count)) + 
+                       (" " + self.database.scanner.printable if self.database.scanning else "") +
+                       (" " + self.tournament.printable if self.tournament else ""))
+
+    def finish(self):
+        self.save()
+        if self.count: self.stats()
+        self.prefetcher.close()
+        self.app.quit()
+
+def serve():
+    import asyncio
+    from modules.server import ScoringServer
+    session = Session()
+    server = ScoringServer(session, Args.number_to_compare, Args.height, Args.host, Args.serve, checkpoint_every=Args.compact_every, rank_all=Args.rank_all)
+    try:
+        asyncio.run(server.run())
+    except KeyboardInterrupt:
+        pass
+    session.save()
+    if session.count: session.stats()
+    return session
 
 def main():
     parse_arguments()
-    a = TheApp()
-    a.app.mainloop()
-    hist = [0]*1000
-    max_c = 0
-    for r in a.database.records: 
-        hist[r.comparisons] += 1
-        max_c = max(max_c, r.comparisons)
-
-    for i in range(max_c+1):
+    with capture(Args.capture):
+        if Args.serve:
+            a = serve()
+        else:
+            a = TheApp()
+            a.app.mainloop()
+    if Args.profile:
+        print(profiler.printable)
+        profiler.save_json('profile.json')
+        profiler.append_csv('profile.csv')
+    comparisons = [r.comparisons for r in a.database.records]
+    hist = [0]*(max(comparisons, default=0)+1)
+    for c in comparisons: hist[c] += 1
+
+    for i in range(len(hist)):
         print("{:>4} images have {:>4} comparisons".format(hist[i],i))
 
 if __name__=="__main__":
@@ -0,0 +1,35 @@
+import argparse, os
+
+from modules.shards import Shard, ShardedDatabase, OVERLAPS
+from modules.journal import Journal
+
+class CommentArgumentParser(argparse.ArgumentParser):
+    def convert_arg_line_to_args(self, arg_line):
+        if arg_line.startswith('#'): return [] 
+        line = "=".join(a.strip() for a in arg_line.split('='))
+        return [line,] if len(line) else []
+
+def parse_arguments():
+    parser = CommentArgumentParser("Merge separately scored directories (shards) into one scorefile", fromfile_prefix_chars='@')
+    parser.add_argument('-d', '--shard', action='append', required=True, help="A shard directory (give this once for each shard)")
+    parser.add_argument('-s', '--scores', default="scores.csv", help="Filename of each shard's scores file (relative to the shard directory)")
+    parser.add_argument('--save_in', required=True, help="Merged scorefile (relative to the shards' common parent directory); its comparison log is saved beside it")
+    parser.add_argument('--overlap', choices=OVERLAPS, default='content', help="How to recognise an image that is in more than one shard: the same file content, or the same path within the shard")
+    parser.add_argument('--comparisons', action='append', default=[], help="A journal or history file of comparisons between images in different shards (paths relative to the common parent)")
+    parser.add_argument('--no_refit', action="store_true", help="Just combine the shards' scores, without refitting them to the comparison logs")
+    parser.add_argument('--workers', type=int, default=None, help="Number of shards to load at once (default all)")
+    return parser.parse_args()
+
+def main():
+    Args = parse_arguments()
+    sharded = ShardedDatabase([Shard(d, Args.scores) for d in Args.shard], overlap=Args.overlap, workers=Args.workers)
+    print(sharded.printable)
+    comparisons = [entry for filepath in Args.comparisons for entry in Journal.read(filepath)]
+    if not Args.no_refit: sharded.merge(comparisons)
+    sharded.database.sort(reverse=True)
+    sharded.database.save(Args.save_in)
+    sharded.save_history(os.path.join(sharded.base_directory, os.path.splitext(Args.save_in)[0]+".history.jsonl"), comparisons)
+    print(f"Saved {sharded.database.image_count} images to {os.path.join(sharded.base_directory, Args.save_in)}")
+
+if __name__=='__main__':
+    main()
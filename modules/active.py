@@ -0,0 +1,162 @@
+import math, random
+import numpy as np
+from modules.scoring import ImageDatabase, ImageRecord
+from modules.choosing import ImageChooser
+from modules.sorted_index import ScoreIndex
+
+# Fisher information (in units of score^-2) from one comparison between images with p around 0.2-0.8
+INFORMATION_PER_COMPARISON = 0.2 * math.log(10)**2
+
+def variance(comparisons, prior_variance=1.0):
+    '''
+    Approximate variance of a score estimated from a number of comparisons (works on arrays too)
+    '''
+    return 1.0 / (1.0/prior_variance + INFORMATION_PER_COMPARISON * comparisons)
+
+class ScoreIndexedChooser(ImageChooser):
+    '''
+    An ImageChooser weighting images by score variance, that also keeps them in a ScoreIndex (score order), updated
+    in O(log n) as their scores change
+    '''
+    def __init__(self, image_records:list[ImageRecord], prior_variance=1.0, weights=None, band:tuple[float, float]=None):
+        self.prior_variance = prior_variance
+        super().__init__(image_records, lambda r:variance(r.comparisons, self.prior_variance), weights, band)
+        self.database:ImageDatabase = image_records[0].database if image_records else None
+        self.indexed = { r.slot : r.score for r in image_records }
+        self.index = ScoreIndex((score, slot) for slot, score in self.indexed.items())
+
+    def extend(self, image_records:list[ImageRecord]):
+        super().extend(image_records)
+        if self.database is None and image_records: self.database = image_records[0].database
+        for r in image_records:
+            self.indexed[r.slot] = r.score
+            self.index.add(r.score, r.slot)
+
+    def refresh(self, image_records:list[ImageRecord]):
+        super().refresh(image_records)
+        for r in image_records:
+            if r.slot in self.indexed:
+                self.index.update(r.slot, self.indexed[r.slot], r.score)
+                self.indexed[r.slot] = r.score
+
+class InformationChooser(ScoreIndexedChooser):
+    '''
+    Chooses sets expected to be informative rather than just sets of less compared images.
+
+    An anchor image is sampled with weight proportional to its score variance. Candidate partners are its
+    neighbours in score order (within window places either way, found from a ScoreIndex), plus a few random
+    images for exploration. Partners are then added greedily, each maximising the total expected information
+    p(1-p).(var_a + var_b) with the images already chosen, so near-certain outcomes are avoided.
+    '''
+    def __init__(self, image_records:list[ImageRecord], window=32, explore=4, prior_variance=1.0, weights=None, band:tuple[float, float]=None):
+        self.window = window
+        self.explore = explore
+        super().__init__(image_records, prior_variance, weights, band)
+
+    def _gains(self, candidates:np.ndarray, chosen:list[int]) -> np.ndarray:
+        scores, comparisons = self.database.scores, self.database.comparisons
+        gains = np.zeros(len(candidates))
+        for slot in chosen:
+            p = 1.0 / (1.0 + np.power(10.0, scores[slot] - scores[candidates]))
+            gains += p * (1-p) * (variance(comparisons[candidates], self.prior_variance) + variance(comparisons[slot], self.prior_variance))
+        return gains
+
+    def pick_images(self, number) -> list[ImageRecord]:
+        assert number <= len(self.image_records)
+        anchor = self.sampler.sample()
+        anchor = self.image_records[anchor if anchor is not None else self._pick_uniform(())]
+        rank = self.index.rank(self.indexed[anchor.slot], anchor.slot)
+        candidates = set(slot for _, slot in self.index.slice(rank - self.window, rank + self.window + 1))
+        candidates.update(self.image_records[self._pick_uniform(())].slot for _ in range(self.explore))
+        candidates.discard(anchor.slot)
+        candidates = np.fromiter(candidates, dtype=np.int64)
+        if self.band is not None:
+            scores = self.database.scores[candidates]
+            candidates = candidates[(scores >= self.band[0]) & (scores <= self.band[1])]
+        chosen = [anchor.slot]
+        while len(chosen) < number:
+            remaining = candidates[~np.isin(candidates, chosen)]
+            if len(remaining):
+                chosen.append(int(remaining[np.argmax(self._gains(remaining, chosen))]))
+            else:
+                chosen.append(self.image_records[self._pick_uniform(set(self.positions[s] for s in chosen))].slot)
+        return [self.image_records[self.positions[s]] for s in chosen]
+
+    @classmethod
+    def from_database(cls, database:ImageDatabase, prior_variance=1.0, exclude:set[int]=None, **kwargs):
+        records, comparisons = cls._included(database, exclude)
+        return cls(records, prior_variance=prior_variance, weights=variance(comparisons, prior_variance), **kwargs)
+
+class BoundaryChooser(ScoreIndexedChooser):
+    '''
+    Spends comparisons on deciding which images are in the top (the best top images, or those scoring above threshold)
+    rather than on ordering the whole collection: it picks images whose confidence interval (score +- z standard
+    deviations, see variance) straddles the boundary, and compares each with images just the other side of it.
+
+    The images are kept in a ScoreIndex, updated in O(log n) as their scores change. Candidates are drawn from the ranks
+    within z prior standard deviations of the boundary (found by bisection), and accepted if their interval straddles
+    it, in proportion to their standard deviation. If none is found, an image is sampled by variance instead.
+    '''
+    def __init__(self, image_records:list[ImageRecord], top=None, threshold=None, z=2.0, prior_variance=1.0, window=8, tries=32, weights=None):
+        assert top is not None or threshold is not None
+        assert top is None or top > 0
+        self.top = top
+        self.threshold = threshold
+        self.z = z
+        self.window = window
+        self.tries = tries
+        super().__init__(image_records, prior_variance, weights)
+
+    @property
+    def boundary(self) -> float:
+        '''
+        The threshold, or the score half way between the top'th and the next best image
+        '''
+        if self.threshold is not None: return self.threshold
+        n = len(self.index)
+        if self.top >= n: return self.index.at(0)[0]
+        return (self.index.at(n - self.top)[0] + self.index.at(n - self.top - 1)[0]) / 2
+
+    def straddles(self, slot, boundary) -> bool:
+        return abs(self.database.scores[slot] - boundary) <= self.z * math.sqrt(variance(self.database.comparisons[slot], self.prior_variance))
+
+    def _anchor(self, boundary) -> int:
+        reach = self.z * math.sqrt(self.prior_variance)
+        low, high = self.index.bisect(boundary - reach), self.index.bisect(boundary + reach)
+        for _ in range(self.tries if high > low else 0):
+            score, slot = self.index.at(random.randrange(low, high))
+            sd = math.sqrt(variance(self.database.comparisons[slot], self.prior_variance))
+            if abs(score - boundary) <= self.z * sd and random.random() * math.sqrt(self.prior_variance) < sd: return slot
+        i = self.sampler.sample()
+        return self.image_records[i if i is not None else self._pick_uniform(())].slot
+
+    def pick_images(self, number) -> list[ImageRecord]:
+        assert number <= len(self.image_records)
+        boundary = self.boundary
+        chosen = [self._anchor(boundary)]
+        split = self.index.bisect(boundary)
+        above = self.database.scores[chosen[0]] >= boundary
+        opposite = self.index.slice(split - self.window, split) if above else self.index.slice(split, split + self.window)
+        partners = [slot for _, slot in opposite if slot != chosen[0]]
+        random.shuffle(partners)
+        chosen += partners[:number-1]
+        while len(chosen) < number:
+            chosen.append(self.image_records[self._pick_uniform(set(self.positions[s] for s in chosen))].slot)
+        return [self.image_records[self.positions[s]] for s in chosen]
+
+    @property
+    def uncertain(self) -> int:
+        '''
+        Number of images whose interval still straddles the boundary
+        '''
+        boundary, reach = self.boundary, self.z * math.sqrt(self.prior_variance)
+        return sum(self.straddles(slot, boundary) for _, slot in self.index.slice(self.index.bisect(boundary - reach), self.index.bisect(boundary + reach)))
+
+    @property
+    def printable(self) -> str:
+        return f"{self.uncertain} images not yet clearly either side of the boundary score {self.boundary:.3f}"
+
+    @classmethod
+    def from_database(cls, database:ImageDatabase, top=None, threshold=None, z=2.0, prior_variance=1.0, exclude:set[int]=None, **kwargs):
+        records, comparisons = cls._included(database, exclude)
+        return cls(records, top, threshold, z, prior_variance, weights=variance(comparisons, prior_variance), **kwargs)
@@ -0,0 +1,116 @@
+import numpy as np
+from modules.scoring import ImageDatabase, ScoreUpdater
+
+class ChoiceLog:
+    '''
+    Comparisons as Luce choices: in each, one winner was chosen from a set of shown images (a pairwise comparison
+    is a choice from a set of two). Images are identified by their slot in an ImageDatabase.
+    '''
+    def __init__(self):
+        self.winners:list[int] = []
+        self.indptr:list[int] = [0]
+        self.indices:list[int] = []
+        self.weights:list[float] = []
+
+    def __len__(self): return len(self.winners)
+
+    def add(self, winner:int, shown:list[int], weight=1.0):
+        self.winners.append(winner)
+        self.indices.extend(shown)
+        self.indptr.append(len(self.indices))
+        self.weights.append(weight)
+
+    @staticmethod
+    def choices(entry:dict):
+        '''
+        Yield (winner, shown) for the choices a journal entry represents: one, or for a ranking (entry['ranked'], with
+        the losers in order) the successive choices of the best of those remaining
+        '''
+        shown = [entry['winner']] + entry['losers']
+        if not entry.get('ranked'):
+            yield entry['winner'], shown
+            return
+        for i in range(len(shown) - 1): yield shown[i], shown[i:]
+
+    @classmethod
+    def from_entries(cls, entries, database:ImageDatabase) -> 'ChoiceLog':
+        '''
+        Build a log from journal entries (see modules.journal); images no longer in the database are left out
+        '''
+        log = cls()
+        slots = database.slots
+        for entry in entries:
+            for winner, shown in cls.choices(entry):
+                shown = [slots[rp] for rp in shown if rp in slots]
+                if winner in slots and len(shown) > 1: log.add(slots[winner], shown, entry.get('k_fac', 1.0))
+        return log
+
+def fit(scores:np.ndarray, log:ChoiceLog, prior=1.0, iterations=200, tolerance=1e-5) -> tuple[np.ndarray, int]:
+    '''
+    Maximum likelihood Bradley-Terry (Plackett-Luce for choices from more than two) scores for the choices in log,
+    found with Hunter's MM iterations (accelerated with SQUAREM), warm-started from scores. Scores are on the same
+    base-10 logistic scale as the Elo updates (p = 1/(1+10^-delta)).
+
+    prior is the number of virtual comparisons (half won, half lost) each image has against an image of score 0,
+    which keeps images that have never won or never lost finite. Images not in the log keep their score.
+    Returns (scores, MM steps used).
+    '''
+    n = len(scores)
+    weights = np.asarray(log.weights, dtype=np.float64)
+    winners = np.asarray(log.winners, dtype=np.int64)
+    indices = np.asarray(log.indices, dtype=np.int64)
+    indptr = np.asarray(log.indptr, dtype=np.int64)
+    in_log = np.zeros(n, dtype=bool)
+    in_log[indices] = True
+    wins = np.bincount(winners, weights=weights, minlength=n) + prior/2
+
+    if len(log) and np.all(np.diff(indptr)==2):
+        first, second = indices[0::2], indices[1::2]
+        def denominators(gamma):
+            r = weights / (gamma[first] + gamma[second])
+            return np.bincount(first, weights=r, minlength=n) + np.bincount(second, weights=r, minlength=n)
+    else:
+        from scipy import sparse
+        shown = sparse.csr_matrix((np.ones(len(indices)), indices, indptr), shape=(len(log), n))
+        shown_t = shown.T.tocsr()
+        def denominators(gamma):
+            return shown_t @ (weights / (shown @ gamma))
+
+    def step(theta):
+        gamma = np.power(10.0, theta)
+        return np.where(in_log, np.log10(wins / (denominators(gamma) + prior / (gamma + 1))), theta)
+
+    theta = np.clip(np.asarray(scores, dtype=np.float64), -30, 30)
+    steps = 0
+    while steps < iterations:
+        theta1 = step(theta)
+        theta2 = step(theta1)
+        steps += 2
+        r, v = theta1 - theta, theta2 - 2*theta1 + theta
+        alpha = -np.sqrt(np.dot(r, r) / np.dot(v, v)) if np.dot(v, v) > 0 else -1.0
+        alpha = min(-1.0, alpha)
+        accelerated = np.clip(theta - 2*alpha*r + alpha*alpha*v, -30, 30)
+        new_theta = step(accelerated) if np.all(np.isfinite(accelerated)) else theta2
+        steps += 1
+        if not np.all(np.isfinite(new_theta)): new_theta = theta2
+        change = np.max(np.abs(new_theta - theta)) if n else 0
+        theta = new_theta
+        if change < tolerance: break
+    return np.where(in_log, theta, scores), steps
+
+class BradleyTerryUpdater(ScoreUpdater):
+    '''
+    Makes the usual online (Elo) updates during a session, so that image choice and the stats work as before,
+    but refit() replaces the scores with a batch maximum likelihood fit to the whole comparison log, which
+    doesn't depend on the order in which the judgements were made.
+    '''
+    def __init__(self, k, prior=1.0):
+        super().__init__(k)
+        self.prior = prior
+
+    def refit(self, database:ImageDatabase, entries) -> int:
+        log = ChoiceLog.from_entries(entries, database)
+        if not len(log): return 0
+        database.scores[:], iterations = fit(database.scores, log, prior=self.prior)
+        print(f"Fitted Bradley-Terry scores to {len(log)} comparisons in {iterations} iterations")
+        return iterations
@@ -0,0 +1,183 @@
+import random, math
+import numpy as np
+from modules.scoring import ImageDatabase, ImageRecord
+
+class FenwickTree:
+    '''
+    Sum tree over non-negative weights, giving O(log n) weight updates and O(log n) weighted sampling.
+    '''
+    def __init__(self, weights):
+        self.build(weights)
+
+    def build(self, weights):
+        weights = np.asarray(weights, dtype=np.float64)
+        self.n = len(weights)
+        index = np.arange(1, self.n+1)
+        cumulative = np.concatenate(([0.0], np.cumsum(weights)))
+        self.tree:list[float] = [0.0] + (cumulative[index] - cumulative[index - (index & -index)]).tolist()
+        self.weights:list[float] = weights.tolist()
+        self.top_bit = 1 << (self.n.bit_length()-1) if self.n else 0
+        self.updates = 0
+
+    def __len__(self): return self.n
+
+    def __getitem__(self, i): return self.weights[i]
+
+    def __setitem__(self, i, weight):
+        delta = weight - self.weights[i]
+        if delta == 0: return
+        self.weights[i] = weight
+        i += 1
+        while i <= self.n:
+            self.tree[i] += delta
+            i += i & -i
+        # rebuild from scratch occasionally so that floating point drift in the partial sums can't accumulate
+        self.updates += 1
+        if self.updates > self.n: self.build(self.weights)
+
+    def prefix(self, i) -> float:
+        '''
+        Sum of weights[0..i-1]
+        '''
+        total = 0.0
+        while i > 0:
+            total += self.tree[i]
+            i -= i & -i
+        return total
+
+    def append(self, weight):
+        i = self.n + 1
+        self.tree.append(weight + self.prefix(self.n) - self.prefix(i - (i & -i)))
+        self.weights.append(weight)
+        self.n = i
+        if self.n >= 2*self.top_bit: self.top_bit = max(1, 2*self.top_bit)
+
+    @property
+    def total(self) -> float:
+        return self.prefix(self.n)
+
+    def find(self, value) -> int:
+        '''
+        Return the smallest index i such that the sum of weights[0..i] exceeds value
+        '''
+        pos, bit = 0, self.top_bit
+        while bit:
+            nxt = pos + bit
+            if nxt <= self.n and self.tree[nxt] <= value:
+                pos = nxt
+                value -= self.tree[nxt]
+            bit >>= 1
+        return min(pos, self.n-1)
+
+    def sample(self) -> int:
+        '''
+        Return a random index with probability proportional to its weight, or None if all weights are zero
+        '''
+        for _ in range(3):
+            total = self.total
+            if total <= 0: return None
+            i = self.find(random.random() * total)
+            if self.weights[i] > 0: return i
+            self.build(self.weights)
+        return None
+
+def focus_band(scores:np.ndarray, top:float=None, threshold:float=None, width=0.5) -> tuple[float, float]:
+    '''
+    The range of scores to focus comparisons on: the top fraction of the images (reaching down by width, so that
+    images just below the cut are still compared), or within width either side of threshold. None if neither is given.
+    '''
+    if top is not None: return (float(np.quantile(scores, 1-top)) - width if len(scores) else -math.inf, math.inf)
+    if threshold is not None: return (threshold - width, threshold + width)
+    return None
+
+class ImageChooser:
+    '''
+    Chooses sets of images, weighting all but one by weighter. If band (low, high) is given, only images scoring within
+    it are chosen (while at least number of them are); an image whose score leaves the band is no longer chosen.
+    '''
+    def __init__(self, image_records:list[ImageRecord], weighter:callable, weights=None, band:tuple[float, float]=None):
+        self.image_records = image_records
+        self.weighter = weighter
+        self.band = band
+        self.positions = { r.slot : i for i, r in enumerate(image_records) }
+        weights = weights if weights is not None else [self.weighter(x) for x in self.image_records]
+        self.members:FenwickTree = None
+        if band is not None:
+            inside = np.fromiter((self.in_band(r) for r in image_records), dtype=np.float64, count=len(image_records))
+            weights = np.asarray(weights, dtype=np.float64) * inside
+            self.members = FenwickTree(inside)
+        self.sampler = FenwickTree(weights)
+
+    def in_band(self, r:ImageRecord) -> bool:
+        return self.band is None or self.band[0] <= r.score <= self.band[1]
+
+    def _weight(self, r:ImageRecord) -> float:
+        return self.weighter(r) if self.in_band(r) else 0.0
+
+    def _pick_uniform(self, exclude:set) -> int:
+        if self.members is not None and self.members.total - sum(self.members[i] for i in exclude) >= 0.5:
+            while (i := self.members.sample()) in exclude: pass
+            return i
+        while (i := random.randrange(len(self.image_records))) in exclude: pass
+        return i
+
+    def pick_images(self, number) -> list[ImageRecord]:
+        '''
+        Pick number-1 distinct images weighted by the weighter (sampled without replacement) and one
+        more distinct image chosen uniformly.
+        '''
+        assert number <= len(self.image_records)
+        picked, weights = [], []
+        for _ in range(number-1):
+            i = self.sampler.sample()
+            if i is None: i = self._pick_uniform(set(picked))
+            picked.append(i)
+            weights.append(self.sampler[i])
+            self.sampler[i] = 0.0
+        for i, weight in zip(picked, weights): self.sampler[i] = weight
+        picked.append(self._pick_uniform(set(picked)))
+        return [self.image_records[i] for i in picked]
+
+    def extend(self, image_records:list[ImageRecord]):
+        '''
+        Add more records to choose from (for instance, as they are found by a background scan)
+        '''
+        for r in image_records:
+            self.positions[r.slot] = len(self.image_records)
+            self.image_records.append(r)
+            self.sampler.append(self._weight(r))
+            if self.members is not None: self.members.append(float(self.in_band(r)))
+
+    def refresh(self, image_records:list[ImageRecord]):
+        '''
+        Recalculate the weights of image_records (call after their comparisons have changed)
+        '''
+        for r in image_records:
+            if (i := self.positions.get(r.slot)) is None: continue
+            self.sampler[i] = self._weight(r)
+            if self.members is not None: self.members[i] = float(self.in_band(r))
+
+    @classmethod
+    def from_database(cls, database:ImageDatabase, weighter:callable=None, low_count_weight:float=None, exclude:set[int]=None, band:tuple[float, float]=None):
+        '''
+        A chooser for all the images in database, except those whose slots are in exclude
+        '''
+        records, comparisons = cls._included(database, exclude)
+        weights = np.power(1-low_count_weight, comparisons) if (weighter is None and low_count_weight) else None
+        weighter = weighter or cls.weighter(low_count_weight)
+        return ImageChooser(records, weighter, weights, band)
+
+    @staticmethod
+    def _included(database:ImageDatabase, exclude:set[int]=None) -> tuple[list[ImageRecord], np.ndarray]:
+        if not exclude: return database.records, database.comparison_array
+        order = database.order
+        keep = ~np.isin(order, np.fromiter(exclude, dtype=np.int64, count=len(exclude)))
+        return [ImageRecord(database, s) for s in order[keep].tolist()], database.comparisons[order[keep]]
+
+    @classmethod
+    def weighter(cls, low_count_weight=0.0):
+        if low_count_weight:
+            def lcw(ir:ImageRecord):
+                return math.pow(1-low_count_weight,ir.comparisons)
+            return lcw
+        return lambda a:1.0
@@ -0,0 +1,154 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from PIL import Image
+from scipy.fft import dct
+from modules.scoring import ImageDatabase, ImageRecord
+
+def _pack(bits:np.ndarray) -> int:
+    return int.from_bytes(np.packbits(bits.flatten()).tobytes(), 'big')
+
+def dhash(im:Image.Image) -> int:
+    '''
+    64 bit difference hash: is each pixel of a 9x8 greyscale thumbnail brighter than its left neighbour
+    '''
+    small = np.asarray(im.convert('L').resize((9, 8), Image.BILINEAR), dtype=np.int16)
+    return _pack(small[:, 1:] > small[:, :-1])
+
+def phash(im:Image.Image) -> int:
+    '''
+    64 bit perceptual hash: is each of the lowest 8x8 DCT frequencies of a 32x32 greyscale thumbnail above their median
+    '''
+    small = np.asarray(im.convert('L').resize((32, 32), Image.BILINEAR), dtype=np.float64)
+    low = dct(dct(small, axis=0, norm='ortho'), axis=1, norm='ortho')[:8, :8]
+    return _pack(low > np.median(low))
+
+def fingerprint(filepath) -> list[int]:
+    '''
+    [dhash, phash] of the image at filepath, or None if it can't be read
+    '''
+    try:
+        with Image.open(filepath) as im:
+            im.draft('L', (64, 64))
+            im = im.convert('L')
+            return [dhash(im), phash(im)]
+    except Exception:
+        return None
+
+def fingerprint_many(filepaths:list[str], workers=None) -> list[list[int]]:
+    '''
+    Fingerprints of filepaths, in order, computed in a process pool (decoding and resizing are CPU bound)
+    '''
+    workers = workers or os.cpu_count() or 1
+    if workers == 1 or len(filepaths) < 64: return [fingerprint(f) for f in filepaths]
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(fingerprint, filepaths, chunksize=max(1, min(256, len(filepaths) // (4*workers)))))
+
+def distance(a:list[int], b:list[int]) -> int:
+    '''
+    The larger of the Hamming distances between the dhashes and between the phashes (which is still a metric)
+    '''
+    return max((a[0] ^ b[0]).bit_count(), (a[1] ^ b[1]).bit_count())
+
+class BKTree:
+    '''
+    Burkhard-Keller tree: each child is filed under its distance from its parent, so that by the triangle inequality
+    a search for everything within radius of a key need only descend into children at distance d-radius..d+radius.
+    '''
+    def __init__(self, metric:callable=distance):
+        self.metric = metric
+        self.root = None
+
+    def add(self, key, value):
+        if self.root is None:
+            self.root = (key, value, {})
+            return
+        node = self.root
+        while True:
+            d = self.metric(key, node[0])
+            if d not in node[2]:
+                node[2][d] = (key, value, {})
+                return
+            node = node[2][d]
+
+    def search(self, key, radius) -> list:
+        found, stack = [], [self.root] if self.root is not None else []
+        while stack:
+            node_key, value, children = stack.pop()
+            d = self.metric(key, node_key)
+            if d <= radius: found.append(value)
+            stack.extend(child for k, child in children.items() if d - radius <= k <= d + radius)
+        return found
+
+def clusters(fingerprints:dict[int, list[int]], threshold=6) -> list[list[int]]:
+    '''
+    Group the keys of fingerprints into clusters of near duplicates (connected components of "within threshold")
+    '''
+    parent = { k : k for k in fingerprints }
+    def root(k):
+        while parent[k] != k:
+            parent[k] = parent[parent[k]]
+            k = parent[k]
+        return k
+    tree = BKTree()
+    for k, fp in fingerprints.items():
+        for other in tree.search(fp, threshold): parent[root(other)] = root(k)
+        tree.add(fp, k)
+    groups:dict[int, list[int]] = {}
+    for k in fingerprints: groups.setdefault(root(k), []).append(k)
+    return [g for g in groups.values() if len(g) > 1]
+
+class Duplicates:
+    '''
+    Clusters of near-duplicate images in a database. Each cluster has a representative (its most compared member,
+    then its highest scoring). Choosers can exclude the other members, so that only the representative is shown;
+    or, when merging, the other members also take the representative's score (see propagate).
+    '''
+    def __init__(self, database:ImageDatabase, clusters:list[list[int]]):
+        self.database = database
+        self.clusters = clusters
+        self.representative:dict[int, int] = {}
+        self.members:dict[int, list[int]] = {}
+        for cluster in clusters:
+            rep = max(cluster, key=lambda s:(database.comparisons[s], database.scores[s]))
+            self.members[rep] = [s for s in cluster if s != rep]
+            for s in cluster: self.representative[s] = rep
+
+    @classmethod
+    def find(cls, database:ImageDatabase, threshold=6, workers=None) -> 'Duplicates':
+        '''
+        Fingerprint any images in the database that the metadata index doesn't yet have fingerprints for, and cluster them
+        '''
+        relative_paths = database.paths_in_order
+        database.index.fill_fingerprints(relative_paths, lambda filepaths:fingerprint_many(filepaths, workers))
+        database.index.save()
+        entries = database.index.entries
+        fingerprints = { database.slots[rp] : e.fingerprint for rp in relative_paths if (e := entries.get(rp)) is not None and e.fingerprint }
+        return cls(database, clusters(fingerprints, threshold))
+
+    @property
+    def excluded(self) -> set[int]:
+        '''
+        Slots of the images that aren't the representative of their cluster
+        '''
+        return set(s for members in self.members.values() for s in members)
+
+    def merge(self):
+        self.propagate([ImageRecord(self.database, rep) for rep in self.members])
+
+    def propagate(self, image_records:list[ImageRecord]) -> list[ImageRecord]:
+        '''
+        Copy the score of any representatives in image_records to the rest of their clusters, and return the records
+        of the images changed. Their comparison counts are left alone, so a comparison is only counted (in the totals
+        and by the lcw weighting) for the images actually shown.
+        '''
+        changed = []
+        for r in image_records:
+            for s in self.members.get(r.slot, ()):
+                self.database.scores[s] = self.database.scores[r.slot]
+                changed.append(ImageRecord(self.database, s))
+        return changed
+
+    @property
+    def printable(self) -> str:
+        return f"{len(self.clusters)} clusters of near duplicates, containing {sum(len(c) for c in self.clusters)} images"
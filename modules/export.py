@@ -0,0 +1,151 @@
+import os, errno, shutil, time
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+import numpy as np
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+MODES = ('copy', 'hardlink', 'reflink')
+FICLONE = 0x40049409                # linux ioctl to share the extents of one file with another (btrfs, xfs...)
+_UNSUPPORTED = (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP, errno.ENOTTY, errno.EPERM, errno.ENOTSOCK)
+
+def top(scores:np.ndarray, n:int) -> np.ndarray:
+    '''
+    Boolean mask of the n highest scores (ties broken arbitrarily), in O(len(scores)) with numpy.argpartition
+    '''
+    keep = np.zeros(len(scores), dtype=bool)
+    n = min(max(n, 0), len(scores))
+    if n: keep[np.argpartition(-scores, n-1)[:n]] = True
+    return keep
+
+def top_percent(scores:np.ndarray, percent:float) -> np.ndarray:
+    return top(scores, int(np.ceil(len(scores) * percent / 100.0)))
+
+def _copy_data(source_fd, destination_fd, size):
+    '''
+    Copy size bytes in the kernel: copy_file_range (which some filesystems turn into a reflink or server side copy),
+    then sendfile, then an ordinary copy. Raises OSError(errno.ENOSYS) if none can be used.
+    '''
+    copied = 0
+    if hasattr(os, 'copy_file_range'):
+        try:
+            while copied < size and (n := os.copy_file_range(source_fd, destination_fd, size - copied)): copied += n
+            if copied >= size: return
+        except OSError as e:
+            if e.errno not in _UNSUPPORTED or copied: raise
+    if hasattr(os, 'sendfile'):
+        try:
+            while copied < size and (n := os.sendfile(destination_fd, source_fd, copied, size - copied)): copied += n
+            if copied >= size: return
+        except OSError as e:
+            if e.errno not in _UNSUPPORTED or copied: raise
+    raise OSError(errno.ENOSYS, "No kernel copy available")
+
+def copy_file(source, destination, mode='copy') -> str:
+    '''
+    Copy (or hardlink, or reflink) source to destination, which must not exist, and return the method used.
+    hardlink and reflink fall back to a copy where the filesystem can't do them.
+    '''
+    if mode == 'hardlink':
+        try:
+            os.link(source, destination)
+            return 'hardlink'
+        except OSError as e:
+            if e.errno not in _UNSUPPORTED: raise
+    with open(source, 'rb') as f_in, open(destination, 'xb') as f_out:
+        if mode == 'reflink' and fcntl is not None:
+            try:
+                fcntl.ioctl(f_out.fileno(), FICLONE, f_in.fileno())
+                method = 'reflink'
+            except OSError as e:
+                if e.errno not in _UNSUPPORTED: raise
+                method = None
+        else:
+            method = None
+        if method is None:
+            try:
+                _copy_data(f_in.fileno(), f_out.fileno(), os.fstat(f_in.fileno()).st_size)
+                method = 'kernel copy'
+            except OSError as e:
+                if e.errno != errno.ENOSYS: raise
+                f_in.seek(0)
+                f_out.seek(0)
+                f_out.truncate()
+                shutil.copyfileobj(f_in, f_out, 1 << 20)
+                method = 'copy'
+    shutil.copymode(source, destination)
+    return method
+
+def destination_names(destination_directory, relative_paths:list[str]) -> list[str]:
+    '''
+    Unique destination filepaths for relative_paths (adding _1, _2... before the extension where a name is taken),
+    found from one listing of each destination directory rather than by checking each candidate on disk
+    '''
+    taken:dict[str, set] = {}
+    names = []
+    for rp in relative_paths:
+        directory, filename = os.path.split(os.path.join(destination_directory, rp))
+        if directory not in taken:
+            taken[directory] = set(os.listdir(directory)) if os.path.isdir(directory) else set()
+        used = taken[directory]
+        stem, extension = os.path.splitext(filename)
+        name, i = filename, 0
+        while name in used:
+            i += 1
+            name = f"{stem}_{i}{extension}"
+        used.add(name)
+        names.append(os.path.join(directory, name))
+    return names
+
+class Exporter:
+    '''
+    Copies files on a thread pool (file copying is mostly waiting on the disks, which releases the GIL), keeping at
+    most a few times as many copies queued as there are workers.
+    '''
+    def __init__(self, mode='copy', workers=8):
+        assert mode in MODES, f"mode must be one of {MODES}"
+        self.mode = mode
+        self.workers = workers
+        self.files = 0
+        self.bytes = 0
+        self.failures = 0
+        self.methods:dict[str, int] = {}
+        self.elapsed = 0.0
+
+    def _export(self, source, destination):
+        method = copy_file(source, destination, self.mode)
+        return method, os.stat(destination).st_size
+
+    def export(self, pairs:list[tuple[str, str]]):
+        '''
+        Copy each (source, destination), creating the destination directories first. Yields (source, destination,
+        exception or None) as each finishes; failures don't stop the export.
+        '''
+        start = time.monotonic()
+        for directory in set(os.path.dirname(destination) for _, destination in pairs): os.makedirs(directory, exist_ok=True)
+        pairs = iter(pairs)
+        with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="Exporter") as executor:
+            running = {}
+            while True:
+                while len(running) < 4*self.workers and (pair := next(pairs, None)) is not None:
+                    running[executor.submit(self._export, *pair)] = pair
+                if not running: break
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    source, destination = running.pop(future)
+                    try:
+                        method, size = future.result()
+                        self.files += 1
+                        self.bytes += size
+                        self.methods[method] = self.methods.get(method, 0) + 1
+                        yield source, destination, None
+                    except OSError as e:
+                        self.failures += 1
+                        yield source, destination, e
+                self.elapsed = time.monotonic() - start
+
+    @property
+    def printable(self):
+        methods = ", ".join(f"{n} by {m}" for m, n in self.methods.items())
+        return "{:>6} files ({:>8.1f} MB) in {:>6.1f} s ({}), {} failed".format(self.files, self.bytes/1e6, self.elapsed, methods, self.failures)
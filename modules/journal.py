@@ -0,0 +1,106 @@
+import os, json, time, threading
+
+class Journal:
+    '''
+    Append-only log of judgements, one JSON line per keypress, fsynced as it is written, so a crash loses nothing.
+
+    compact(save) folds the journal into the scorefile: the current journal is renamed to .compacting and a new
+    one started, then (in a background thread by default) save() writes the scorefile, the compacted entries are
+    appended to the history file (the full comparison log) and .compacting is removed. Anything still in
+    .compacting or the journal when a database is loaded has not reached the scorefile, and is replayed.
+
+    Each entry records n, the total comparisons in the database before it was applied, which is what a scorefile
+    saved after it would hold. Replay skips entries the database already contains (which can only happen if a crash
+    came between saving and removing .compacting).
+    '''
+    def __init__(self, filepath, history_filepath=None):
+        self.filepath = filepath
+        self.compacting_filepath = filepath + ".compacting"
+        self.history_filepath = history_filepath
+        self.lock = threading.Lock()
+        self.compactor:threading.Thread = None
+        self.file = open(self.filepath, 'a')
+        self.pending = 0
+
+    @staticmethod
+    def make_entry(n, winner:str, losers:list[str], k, k_fac=1.0, **kwargs) -> dict:
+        return { "n":n, "winner":winner, "losers":losers, "k":k, "k_fac":k_fac, "time":time.time(), **kwargs }
+
+    def record(self, entry:dict):
+        self.record_many([entry])
+
+    def record_many(self, entries:list[dict]):
+        '''
+        Write several entries with a single fsync (a group commit)
+        '''
+        lines = "".join(json.dumps(entry, separators=(',',':')) + "\n" for entry in entries)
+        with self.lock:
+            self.file.write(lines)
+            self.file.flush()
+            os.fsync(self.file.fileno())
+            self.pending += len(entries)
+
+    @staticmethod
+    def read(filepath):
+        if not os.path.exists(filepath): return
+        with open(filepath, 'r') as f:
+            for line in f:
+                try:
+                    yield json.loads(line)
+                except ValueError:
+                    pass    # a line only partly written when the process died
+
+    def unapplied(self):
+        '''
+        Yield the entries that may not yet be in the scorefile, oldest first
+        '''
+        yield from self.read(self.compacting_filepath)
+        yield from self.read(self.filepath)
+
+    def all_entries(self):
+        '''
+        Yield every entry, from the history and the journal, oldest first
+        '''
+        if self.history_filepath: yield from self.read(self.history_filepath)
+        yield from self.unapplied()
+
+    @staticmethod
+    def _append(source, destination):
+        with open(source, 'r') as f_in, open(destination, 'a') as f_out:
+            for line in f_in:
+                if line.endswith("\n"): f_out.write(line)
+            f_out.flush()
+            os.fsync(f_out.fileno())
+
+    def compact(self, save:callable, background=True):
+        '''
+        Fold the journal into the scorefile by calling save() (which must write a copy of the database taken now)
+        '''
+        self.wait()
+        with self.lock:
+            self.file.close()
+            if os.path.exists(self.compacting_filepath):
+                self._append(self.filepath, self.compacting_filepath)
+                os.remove(self.filepath)
+            else:
+                os.replace(self.filepath, self.compacting_filepath)
+            self.file = open(self.filepath, 'a')
+            self.pending = 0
+        def run():
+            save()
+            if self.history_filepath: self._append(self.compacting_filepath, self.history_filepath)
+            os.remove(self.compacting_filepath)
+        if background:
+            self.compactor = threading.Thread(target=run, name="Journal compaction")
+            self.compactor.start()
+        else:
+            run()
+
+    def wait(self):
+        if self.compactor is not None: self.compactor.join()
+        self.compactor = None
+
+    def close(self):
+        self.wait()
+        with self.lock:
+            self.file.close()
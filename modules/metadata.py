@@ -0,0 +1,164 @@
+import os, json, threading
+from modules.thumbnails import CACHE_DIRECTORY
+from modules.probe import probe_many
+from modules.scanner import DirectoryScanner
+
+# Files the scorer keeps beside the images (metadata index, journal, history, tournament state, and temporary files)
+SIDECAR_SUFFIXES = (".index.json", ".journal.jsonl", ".journal.jsonl.compacting", ".history.jsonl", ".tournament.json", ".tmp")
+
+class ImageMetadata:
+    __slots__ = ('size', 'mtime', 'width', 'height', 'format', 'valid', 'fingerprint')
+
+    def __init__(self, size, mtime, width=0, height=0, format=None, valid=False, fingerprint=None):
+        self.size = size
+        self.mtime = mtime
+        self.width = width
+        self.height = height
+        self.format = format
+        self.valid = valid
+        self.fingerprint = fingerprint
+
+    def matches(self, stat:os.stat_result) -> bool:
+        return self.size==stat.st_size and self.mtime==stat.st_mtime_ns
+
+    @property
+    def has_dimensions(self) -> bool:
+        return self.width>0 and self.height>0
+
+    @property
+    def aspect_ratio(self) -> float:
+        return self.width / self.height if self.has_dimensions else 0.0
+
+    @property
+    def as_list(self):
+        return [self.size, self.mtime, self.width, self.height, self.format, self.valid] + ([self.fingerprint] if self.fingerprint is not None else [])
+
+class MetadataIndex:
+    '''
+    Map of relative_path -> ImageMetadata, kept on disk (if filename is given) so that a warm start
+    only has to open files whose size or mtime have changed since the last run.
+    '''
+    def __init__(self, base_directory, filename=None, workers=8):
+        self.base_directory = base_directory
+        self.workers = workers
+        self.filepath = os.path.join(base_directory, filename) if filename else None
+        self.filename = os.path.relpath(self.filepath, base_directory) if filename else None
+        self.entries:dict[str, ImageMetadata] = {}
+        self.checked:set[str] = set()
+        self.changed = False
+        self.lock = threading.RLock()
+        if self.filepath and os.path.exists(self.filepath): self.load()
+
+    def load(self):
+        try:
+            with open(self.filepath,'r') as f:
+                loaded:dict = json.load(f)
+            self.entries = { rp : ImageMetadata(*e) for rp, e in loaded.get('Entries',{}).items() }
+        except (OSError, ValueError, TypeError):
+            print(f"Couldn't read image index {self.filepath}, rebuilding it")
+            self.entries = {}
+
+    def save(self):
+        with self.lock:
+            if not (self.filepath and self.changed): return
+            temppath = self.filepath + ".tmp"
+            with open(temppath,'w') as f:
+                json.dump({ "Entries" : { rp : self.entries[rp].as_list for rp in self.entries } }, f, separators=(',',':'))
+            os.replace(temppath, self.filepath)
+            self.changed = False
+
+    def refresh(self, items:list[tuple[str, os.stat_result, bool]]) -> list[ImageMetadata]:
+        '''
+        items are (relative_path, stat, trusted). Entries that are new or have changed are probed (reading just
+        the image header) in parallel. Returns the entries, in order.
+        '''
+        stale = [(rp, stat, trusted) for rp, stat, trusted in items if rp not in self.entries or not self.entries[rp].matches(stat)]
+        to_probe = [rp for rp, _, trusted in stale if not trusted]
+        probed = dict(zip(to_probe, probe_many([os.path.join(self.base_directory, rp) for rp in to_probe], self.workers)))
+        for relative_path, stat, trusted in stale:
+            entry = ImageMetadata(stat.st_size, stat.st_mtime_ns, valid=trusted)
+            if not trusted:
+                if (result := probed[relative_path]) is not None:
+                    entry.format, entry.width, entry.height = result
+                    entry.valid = True
+                else:
+                    print(f"{relative_path} isn't an image")
+            self.entries[relative_path] = entry
+            self.changed = True
+        self.checked.update(rp for rp, _, _ in items)
+        return [self.entries[rp] for rp, _, _ in items]
+
+    def check(self, relative_paths:list[str]):
+        '''
+        Stat (once per session) and refresh the entries for relative_paths; files that no longer exist are forgotten
+        '''
+        with self.lock:
+            items = []
+            for relative_path in relative_paths:
+                if relative_path in self.checked: continue
+                try:
+                    items.append((relative_path, os.stat(os.path.join(self.base_directory, relative_path)), False))
+                except OSError:
+                    self.forget(relative_path)
+            self.refresh(items)
+
+    def get(self, relative_path) -> ImageMetadata:
+        '''
+        Return the metadata for relative_path, probing the file only if it is new or has changed.
+        Returns None if the file doesn't exist. Files are only stat'd once per session.
+        '''
+        self.check([relative_path])
+        return self.entries.get(relative_path)
+
+    def forget(self, relative_path):
+        self.checked.add(relative_path)
+        if self.entries.pop(relative_path, None) is not None: self.changed = True
+
+    def fill_dimensions(self, relative_paths:list[str]):
+        '''
+        Make sure width and height are known for all valid entries in relative_paths (files trusted by
+        extension haven't been probed yet)
+        '''
+        with self.lock:
+            self.check(relative_paths)
+            missing = [rp for rp in relative_paths if (e := self.entries.get(rp)) is not None and e.valid and not e.has_dimensions]
+            for relative_path, result in zip(missing, probe_many([os.path.join(self.base_directory, rp) for rp in missing], self.workers)):
+                entry = self.entries[relative_path]
+                if result is not None: entry.format, entry.width, entry.height = result
+                else: entry.valid = False
+                self.changed = True
+
+    def fill_fingerprints(self, relative_paths:list[str], fingerprint_many:callable):
+        '''
+        Make sure the valid entries in relative_paths have perceptual fingerprints (see modules.dedupe), computing
+        any that are missing with fingerprint_many(filepaths). Files that can't be fingerprinted get "", so they
+        aren't tried again until they change.
+        '''
+        with self.lock:
+            self.check(relative_paths)
+            missing = [rp for rp in relative_paths if (e := self.entries.get(rp)) is not None and e.valid and e.fingerprint is None]
+            if not missing: return
+            for relative_path, result in zip(missing, fingerprint_many([os.path.join(self.base_directory, rp) for rp in missing])):
+                self.entries[relative_path].fingerprint = result if result is not None else ""
+            self.changed = True
+
+    def scan(self, trust_extensions=None, scanner:DirectoryScanner=None):
+        '''
+        Walk the base directory (in parallel, see DirectoryScanner), yielding a list of the relative_paths of the 
+        valid images in each directory as it is read. Files with trusted extensions are never opened, and the scorer's
+        own files (see SIDECAR_SUFFIXES) are skipped.
+        Entries for files that no longer exist are dropped once the scan is complete.
+        '''
+        trust_extensions = trust_extensions or []
+        scanner = scanner or DirectoryScanner(self.base_directory, skip_directory=lambda rp:rp==CACHE_DIRECTORY or rp.endswith(".ranks"))
+        ignore = (self.filename, self.filename+".tmp") if self.filename else ()
+        seen = set()
+        for files in scanner.scan():
+            items = [(rp, stat, os.path.splitext(rp)[1] in trust_extensions) for rp, stat in files if rp not in ignore and not rp.endswith(SIDECAR_SUFFIXES)]
+            seen.update(rp for rp, _, _ in items)
+            with self.lock:
+                valid = [rp for (rp, _, _), entry in zip(items, self.refresh(items)) if entry.valid]
+            scanner.images += len(valid)
+            if valid: yield valid
+        with self.lock:
+            for relative_path in [rp for rp in self.entries if rp not in seen]: self.forget(relative_path)
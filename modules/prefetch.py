@@ -0,0 +1,72 @@
+import os
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, Future
+from modules.scoring import ImageDatabase, ImageRecord
+from modules.thumbnails import ThumbnailCache, scale_to_height
+from modules.profiling import timer
+
+class Prefetcher:
+    '''
+    Picks the next few comparison sets ahead of time and decodes and downscales their images to the display
+    height on a thread pool, so that the UI thread only has to display them.
+
+    At most depth sets are queued, and decoded images are only kept while a queued set refers to them.
+    Call invalidate() with the records whose scores have changed; queued sets containing them are discarded
+    (their pick was based on stale weights, and would show the same image again straight away).
+    '''
+    def __init__(self, database:ImageDatabase, chooser, number_to_compare, height, depth=4, workers=4, wrap:callable=None, thumbnails:ThumbnailCache=None):
+        self.database = database
+        self.chooser = chooser
+        self.number_to_compare = number_to_compare
+        self.height = height
+        self.depth = max(1, depth)
+        self.wrap = wrap or (lambda im:im)
+        self.thumbnails = thumbnails
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="prefetch")
+        self.queue:deque[tuple[list[ImageRecord], list[Future]]] = deque()
+        self.images:dict[int, Future] = {}
+
+    def _load(self, relative_path):
+        with timer("get_image"):
+            if self.thumbnails: im = self.thumbnails.get(relative_path)
+            else: im = scale_to_height(os.path.join(self.database.base_directory, relative_path), self.height)
+        with timer("wrap image"): return self.wrap(im)
+
+    def _image(self, record:ImageRecord) -> Future:
+        if record.slot not in self.images:
+            self.images[record.slot] = self.executor.submit(self._load, record.relative_path)
+        return self.images[record.slot]
+
+    def fill(self):
+        while len(self.queue) < self.depth:
+            with timer("choose"): records = self.chooser.pick_images(self.number_to_compare)
+            self.queue.append((records, [self._image(r) for r in records]))
+
+    def _trim(self):
+        wanted = set(r.slot for records, _ in self.queue for r in records)
+        for slot in [s for s in self.images if s not in wanted]: self.images.pop(slot).cancel()
+
+    def next(self) -> tuple[list[ImageRecord], list]:
+        '''
+        Return the next set of records, and their images (the output of wrap, or an exception if the load failed)
+        '''
+        self.fill()
+        records, futures = self.queue.popleft()
+        images = []
+        with timer("wait for images"):
+            for future in futures:
+                try:
+                    images.append(future.result())
+                except Exception as e:
+                    images.append(e)
+        self._trim()
+        self.fill()
+        return records, images
+
+    def invalidate(self, changed:list[ImageRecord]):
+        changed = set(r.slot for r in changed)
+        self.queue = deque(item for item in self.queue if not any(r.slot in changed for r in item[0]))
+        self._trim()
+
+    def close(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
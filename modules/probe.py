@@ -0,0 +1,92 @@
+import struct
+from concurrent.futures import ThreadPoolExecutor
+from collections import deque
+
+class NotAnImage(Exception):
+    pass
+
+_JPEG_SOF = {0xC0, 0xC1, 0xC2, 0xC3, 0xC5, 0xC6, 0xC7, 0xC9, 0xCA, 0xCB, 0xCD, 0xCE, 0xCF}
+
+def _probe_png(f, head):
+    if head[12:16] != b'IHDR': raise NotAnImage("PNG without IHDR")
+    return ("PNG",) + struct.unpack(">II", head[16:24])
+
+def _probe_jpeg(f, head):
+    f.seek(2)
+    while True:
+        marker = f.read(2)
+        while len(marker)==2 and marker[1]==0xFF: marker = marker[1:] + f.read(1)    # fill bytes
+        if len(marker) < 2 or marker[0] != 0xFF: raise NotAnImage("bad JPEG marker")
+        if marker[1] in (0xD8, 0x01) or 0xD0 <= marker[1] <= 0xD7: continue          # markers without a length
+        length = f.read(2)
+        if len(length) < 2: raise NotAnImage("truncated JPEG")
+        length = struct.unpack(">H", length)[0]
+        if marker[1] in _JPEG_SOF:
+            sof = f.read(5)
+            if len(sof) < 5: raise NotAnImage("truncated JPEG")
+            height, width = struct.unpack(">HH", sof[1:5])
+            return ("JPEG", width, height)
+        f.seek(length-2, 1)
+
+def _probe_webp(f, head):
+    chunk = head[12:16]
+    if chunk == b'VP8 ':
+        if head[23:26] != b'\x9d\x01\x2a': raise NotAnImage("bad VP8 frame")
+        width, height = struct.unpack("<HH", head[26:30])
+        return ("WEBP", width & 0x3FFF, height & 0x3FFF)
+    if chunk == b'VP8L':
+        bits = int.from_bytes(head[21:25], 'little')
+        return ("WEBP", (bits & 0x3FFF) + 1, ((bits >> 14) & 0x3FFF) + 1)
+    if chunk == b'VP8X':
+        return ("WEBP", int.from_bytes(head[24:27], 'little') + 1, int.from_bytes(head[27:30], 'little') + 1)
+    raise NotAnImage("unknown WEBP chunk")
+
+def _probe_gif(f, head):
+    return ("GIF",) + struct.unpack("<HH", head[6:10])
+
+def _probe_bmp(f, head):
+    width, height = struct.unpack("<ii", head[18:26])
+    return ("BMP", width, abs(height))
+
+def _probe_pil(filepath):
+    from PIL import Image
+    try:
+        with Image.open(filepath) as i:
+            return (i.format, i.width, i.height)
+    except Exception as e:
+        raise NotAnImage(str(e))
+
+def probe(filepath) -> tuple[str, int, int]:
+    '''
+    Return (format, width, height) for the image at filepath, reading only the file header for PNG, JPEG, WEBP,
+    GIF and BMP (and falling back to PIL for anything else). Raises NotAnImage if it isn't an image.
+    '''
+    with open(filepath, 'rb') as f:
+        head = f.read(32)
+        if head[:8] == b'\x89PNG\r\n\x1a\n': return _probe_png(f, head)
+        if head[:3] == b'\xff\xd8\xff':     return _probe_jpeg(f, head)
+        if head[:4] == b'RIFF' and head[8:12] == b'WEBP': return _probe_webp(f, head)
+        if head[:6] in (b'GIF87a', b'GIF89a'): return _probe_gif(f, head)
+        if head[:2] == b'BM' and len(head) >= 26: return _probe_bmp(f, head)
+    return _probe_pil(filepath)
+
+def probe_or_none(filepath) -> tuple[str, int, int]:
+    try:
+        return probe(filepath)
+    except (OSError, NotAnImage, struct.error):
+        return None
+
+def probe_many(filepaths:list[str], workers=8):
+    '''
+    Yield probe_or_none(filepath) for each filepath, in order, using a pool of workers threads with at most
+    a few files per worker in flight at once
+    '''
+    if workers <= 1 or len(filepaths) <= 1:
+        for filepath in filepaths: yield probe_or_none(filepath)
+        return
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="probe") as executor:
+        pending = deque()
+        for filepath in filepaths:
+            pending.append(executor.submit(probe_or_none, filepath))
+            if len(pending) >= 4*workers: yield pending.popleft().result()
+        while pending: yield pending.popleft().result()
@@ -0,0 +1,148 @@
+import os, math, json, time, threading
+from contextlib import contextmanager
+
+class Histogram:
+    '''
+    Log-bucketed (HDR style) histogram of durations: each bucket is a fixed fraction (precision) wider than the last,
+    so percentiles are accurate to that fraction at any scale, in a few hundred buckets at most.
+    '''
+    def __init__(self, precision=0.01):
+        self.scale = 1.0 / math.log1p(precision)
+        self.precision = precision
+        self.buckets:dict[int, int] = {}
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.lock = threading.Lock()
+
+    def record(self, seconds):
+        bucket = int(math.log(seconds * 1e9) * self.scale) if seconds > 1e-9 else 0
+        with self.lock:
+            self.buckets[bucket] = self.buckets.get(bucket, 0) + 1
+            self.count += 1
+            self.total += seconds
+            if seconds > self.max: self.max = seconds
+
+    def percentile(self, p) -> float:
+        '''
+        The duration (in seconds) below which p percent of the recorded durations fall
+        '''
+        if not self.count: return 0.0
+        wanted, seen = self.count * p / 100.0, 0
+        for bucket in sorted(self.buckets):
+            seen += self.buckets[bucket]
+            if seen >= wanted: return min(self.max, math.exp((bucket + 1) / self.scale) / 1e9)
+        return self.max
+
+    @property
+    def mean(self) -> float: return self.total / self.count if self.count else 0.0
+
+    @property
+    def summary(self) -> dict:
+        return { "count" : self.count, "total s" : self.total, "mean ms" : 1e3*self.mean, "p50 ms" : 1e3*self.percentile(50),
+                 "p95 ms" : 1e3*self.percentile(95), "p99 ms" : 1e3*self.percentile(99), "max ms" : 1e3*self.max }
+
+class _Timer:
+    __slots__ = ('histogram', 'start')
+
+    def __init__(self, histogram:Histogram):
+        self.histogram = histogram
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        self.histogram.record(time.perf_counter() - self.start)
+
+class Profiler:
+    '''
+    Named latency histograms. Wrap code in `with timer("name"):` (or decorate a function with @timed("name")); the cost
+    is two clock reads and a dictionary update, so the timers are always on. Safe to use from several threads.
+    '''
+    def __init__(self):
+        self.histograms:dict[str, Histogram] = {}
+        self.lock = threading.Lock()
+
+    def histogram(self, name) -> Histogram:
+        if (h := self.histograms.get(name)) is None:
+            with self.lock:
+                h = self.histograms.setdefault(name, Histogram())
+        return h
+
+    def timer(self, name) -> _Timer:
+        return _Timer(self.histogram(name))
+
+    def record(self, name, seconds):
+        self.histogram(name).record(seconds)
+
+    def timed(self, name):
+        def decorator(function):
+            def wrapped(*args, **kwargs):
+                with self.timer(name): return function(*args, **kwargs)
+            return wrapped
+        return decorator
+
+    @property
+    def report(self) -> dict:
+        return { name : h.summary for name, h in self.histograms.items() if h.count }
+
+    @property
+    def printable(self) -> str:
+        lines = ["{:<24} {:>7} {:>10} {:>10} {:>10} {:>10} {:>10}".format("timer", "count", "total s", "p50 ms", "p95 ms", "p99 ms", "max ms")]
+        for name, s in self.report.items():
+            lines.append("{:<24} {:>7} {:>10.3f} {:>10.2f} {:>10.2f} {:>10.2f} {:>10.2f}".format(name, s["count"], s["total s"], s["p50 ms"], s["p95 ms"], s["p99 ms"], s["max ms"]))
+        return "\n".join(lines)
+
+    def save_json(self, filepath):
+        with open(filepath, 'w') as f:
+            json.dump({ "time" : time.time(), "timers" : self.report }, f, indent=2)
+
+    def append_csv(self, filepath):
+        '''
+        Append a row per timer (with the same time, to group a run's rows) to filepath, writing a header if it is new
+        '''
+        headers = ("time", "timer", "count", "total s", "mean ms", "p50 ms", "p95 ms", "p99 ms", "max ms")
+        now = time.strftime("%Y-%m-%d %H:%M:%S")
+        new = not os.path.exists(filepath)
+        with open(filepath, 'a') as f:
+            if new: print(",".join(headers), file=f)
+            for name, s in self.report.items():
+                print(",".join(str(x) for x in (now, name) + tuple(s[h] for h in headers[2:])), file=f)
+
+profiler = Profiler()
+timer = profiler.timer
+timed = profiler.timed
+
+@contextmanager
+def capture(mode=None, filepath=None):
+    '''
+    Run the block under cProfile (saving stats to filepath, default profile.prof) or tracemalloc (saving the top
+    allocations to filepath, default memory.txt); mode None does nothing
+    '''
+    if mode == 'cprofile':
+        import cProfile, pstats
+        profile = cProfile.Profile()
+        profile.enable()
+        try:
+            yield
+        finally:
+            profile.disable()
+            profile.dump_stats(filepath or "profile.prof")
+            pstats.Stats(profile).sort_stats('cumulative').print_stats(20)
+    elif mode == 'tracemalloc':
+        import tracemalloc
+        tracemalloc.start(25)
+        try:
+            yield
+        finally:
+            snapshot = tracemalloc.take_snapshot()
+            current, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            with open(filepath or "memory.txt", 'w') as f:
+                print(f"current {current/1e6:.1f} MB, peak {peak/1e6:.1f} MB", file=f)
+                for stat in snapshot.statistics('traceback')[:30]:
+                    print(stat, file=f)
+                    for line in stat.traceback.format()[-6:]: print("    " + line, file=f)
+    else:
+        yield
@@ -0,0 +1,269 @@
+import os
+import numpy as np
+from modules.scoring import ImageDatabase, ImageRecord
+from modules.sorted_index import ScoreIndex
+from modules.scorefiles import atomic_write, read_scores
+
+def ranks_of(database:ImageDatabase) -> np.ndarray:
+    '''
+    Rank (0 = best) of each slot in the database, -1 for slots no longer in it. Ties are broken by slot.
+    '''
+    order = database.order
+    ranks = np.full(len(database.paths), -1, dtype=np.int64)
+    ranks[order[np.lexsort((order, -database.scores[order]))]] = np.arange(len(order))
+    return ranks
+
+def ranks_from_scores(scores:np.ndarray) -> np.ndarray:
+    '''
+    Rank (0 = best) of each score, ties broken by position (as in ranks_of)
+    '''
+    ranks = np.empty(len(scores), dtype=np.int64)
+    ranks[np.lexsort((np.arange(len(scores)), -scores))] = np.arange(len(scores))
+    return ranks
+
+def read_ranks(filepath) -> tuple[list[str], np.ndarray]:
+    '''
+    The relative paths in a scorefile, and their ranks, read without an ImageDatabase (so it can be done in another process)
+    '''
+    paths, scores = read_scores(filepath)
+    return paths, ranks_from_scores(scores)
+
+def _common(a:np.ndarray, b:np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    '''
+    The ranks of the items present in both a and b, renumbered 0..m-1 within each
+    '''
+    n = min(len(a), len(b))
+    a, b = a[:n], b[:n]
+    both = np.flatnonzero((a >= 0) & (b >= 0))
+    renumbered = []
+    for ranks in (a[both], b[both]):
+        r = np.empty(len(both), dtype=np.int64)
+        r[np.argsort(ranks, kind='stable')] = np.arange(len(both))
+        renumbered.append(r)
+    return tuple(renumbered)
+
+def spearman(a:np.ndarray, b:np.ndarray) -> float:
+    '''
+    Spearman correlation between two rank arrays (indexed alike, -1 for missing), over the items in both
+    '''
+    a, b = _common(a, b)
+    m = len(a)
+    if m < 2: return 1.0
+    d = (a - b).astype(np.float64)
+    return 1.0 - 6.0 * np.dot(d, d) / (m * (m*m - 1.0))
+
+def _renumbered(ranks:np.ndarray, present:np.ndarray) -> np.ndarray:
+    '''
+    Each row of ranks renumbered 0..m-1 among the entries present in that row (the rest -1)
+    '''
+    order = np.argsort(np.where(present, ranks, np.iinfo(ranks.dtype).max), axis=1, kind='stable')
+    renumbered = np.empty_like(order)
+    np.put_along_axis(renumbered, order, np.broadcast_to(np.arange(ranks.shape[1]), order.shape), axis=1)
+    return np.where(present, renumbered, -1)
+
+def spearman_rows(a:np.ndarray, b:np.ndarray) -> np.ndarray:
+    '''
+    Spearman correlation between each row of a and the same row of b (rank arrays as for spearman; a single row
+    broadcasts against many), each over the items present in both
+    '''
+    a, b = np.broadcast_arrays(np.atleast_2d(a), np.atleast_2d(b))
+    present = (a >= 0) & (b >= 0)
+    d = (_renumbered(a, present) - _renumbered(b, present)).astype(np.float64)
+    m = present.sum(axis=1).astype(np.float64)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(m > 1, 1.0 - 6.0 * np.einsum('ij,ij->i', d, d) / (m * (m*m - 1.0)), 1.0)
+
+def kendall(a:np.ndarray, b:np.ndarray) -> float:
+    '''
+    Kendall tau between two rank arrays (indexed alike, -1 for missing), over the items in both
+    '''
+    from scipy.stats import kendalltau
+    a, b = _common(a, b)
+    return kendalltau(a, b).statistic if len(a) > 1 else 1.0
+
+class RankCheckpoints:
+    '''
+    Saved rankings, each an int32 array (name.npy) of the rank (0 = best, -1 = absent) of every path id, where
+    path ids index a table of relative paths (paths.txt) shared by all the checkpoints and only ever appended to.
+    A checkpoint of 200k images is 800kB, and comparing two doesn't need the scorefiles or an ImageDatabase.
+    '''
+    PATHS = "paths.txt"
+
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self.paths_file = os.path.join(directory, self.PATHS)
+        self.paths:list[str] = []
+        if os.path.exists(self.paths_file):
+            with open(self.paths_file, 'r') as f:
+                self.paths = [line[:-1] for line in f if line.endswith("\n")]
+        self.ids:dict[str, int] = { rp : i for i, rp in enumerate(self.paths) }
+
+    def ids_for(self, relative_paths:list[str]) -> np.ndarray:
+        '''
+        Path ids of relative_paths, adding any that are new to the table
+        '''
+        new = [rp for rp in dict.fromkeys(relative_paths) if rp not in self.ids]
+        if new:
+            with open(self.paths_file, 'a') as f:
+                f.writelines(rp + "\n" for rp in new)
+                f.flush()
+                os.fsync(f.fileno())
+            for rp in new: self.ids[rp] = len(self.paths); self.paths.append(rp)
+        return np.fromiter((self.ids[rp] for rp in relative_paths), dtype=np.int64, count=len(relative_paths))
+
+    def _filepath(self, name): return os.path.join(self.directory, f"{name}.npy")
+
+    def __contains__(self, name): return os.path.exists(self._filepath(name))
+
+    def names(self) -> list:
+        '''
+        Names of the saved checkpoints, numbers (usually the total comparisons) in numerical order first
+        '''
+        names = [os.path.splitext(f)[0] for f in os.listdir(self.directory) if f.endswith(".npy")]
+        return sorted((int(n) if n.isdigit() else n for n in names), key=lambda n:(not isinstance(n, int), n))
+
+    def save(self, name, relative_paths:list[str], ranks:np.ndarray):
+        '''
+        Save ranks (aligned with relative_paths, -1 for absent)
+        '''
+        with atomic_write(self._filepath(name), 'wb') as f:
+            np.save(f, self.by_id(relative_paths, ranks).astype(np.int32))
+
+    def save_database(self, name, database:ImageDatabase):
+        self.save(name, database.paths, ranks_of(database))
+
+    def by_id(self, relative_paths:list[str], ranks:np.ndarray) -> np.ndarray:
+        '''
+        Convert ranks (aligned with relative_paths) into ranks by path id, as they are saved
+        '''
+        ids = self.ids_for(relative_paths)
+        by_id = np.full(len(self.paths), -1, dtype=np.int64)
+        present = ranks >= 0
+        by_id[ids[present]] = ranks[present]
+        return by_id
+
+    def load(self, name) -> np.ndarray:
+        '''
+        The ranks by path id
+        '''
+        ranks = np.load(self._filepath(name)).astype(np.int64)
+        if len(ranks) < len(self.paths): ranks = np.concatenate((ranks, np.full(len(self.paths) - len(ranks), -1)))
+        return ranks
+
+    def for_database(self, ranks:np.ndarray, database:ImageDatabase) -> np.ndarray:
+        '''
+        Convert ranks by path id into ranks by slot in database (-1 for images not in the checkpoint)
+        '''
+        ids = np.fromiter((self.ids.get(rp, -1) for rp in database.paths), dtype=np.int64, count=len(database.paths))
+        return np.where(ids >= 0, ranks[ids], -1)
+
+class RankMatrix:
+    '''
+    The rankings of a series of checkpoints as one (checkpoints x path ids) array, each checkpoint read once, so that
+    they can all be compared (with each other, or with another ranking) in a few vectorized passes. The comparisons
+    are made rows at a time, in blocks of about block_size entries, to bound the working memory.
+    '''
+    def __init__(self, checkpoints:RankCheckpoints, names:list, block_size=1 << 24):
+        self.names = list(names)
+        self.ranks = np.full((len(self.names), len(checkpoints.paths)), -1, dtype=np.int32)
+        for i, name in enumerate(self.names):
+            row = np.load(checkpoints._filepath(name))
+            self.ranks[i, :len(row)] = row
+        self.block = max(1, block_size // max(1, self.ranks.shape[1]))
+
+    def _blocks(self, a:np.ndarray, b:np.ndarray) -> np.ndarray:
+        return np.concatenate([spearman_rows(a[i:i+self.block], b if b.ndim==1 else b[i:i+self.block])
+                               for i in range(0, len(a), self.block)] or [np.zeros(0)])
+
+    def consecutive(self) -> np.ndarray:
+        '''
+        Spearman correlation of each checkpoint with the one before it
+        '''
+        return self._blocks(self.ranks[:-1], self.ranks[1:]) if len(self.names) > 1 else np.zeros(0)
+
+    def against(self, reference:np.ndarray) -> np.ndarray:
+        '''
+        Spearman correlation of each checkpoint with reference (ranks by path id)
+        '''
+        row = np.full(self.ranks.shape[1], -1, dtype=np.int64)
+        n = min(len(row), len(reference))
+        row[:n] = reference[:n]
+        return self._blocks(self.ranks, row)
+
+class RankTracker:
+    '''
+    Keeps the live ranking of a database in a ScoreIndex, and the Spearman correlation with a reference ranking
+    up to date as scores change, without recomputing it.
+
+    With current ranks r and reference ranks q (of the m images in both, each 0..m-1), sum(d^2) = 2.sum(r^2) - 2.sum(r.q),
+    and sum(r^2) is fixed, so only sum(r.q) need be tracked. When an image moves from rank a to rank b, each image in
+    between shifts one place, changing sum(r.q) by the sum of their q, which the index keeps per block.
+    Comparisons against any other ranking (see against) are computed on demand.
+    '''
+    def __init__(self, database:ImageDatabase, reference:np.ndarray=None):
+        self.database = database
+        self.set_reference(ranks_of(database) if reference is None else reference)
+
+    def set_reference(self, reference:np.ndarray):
+        '''
+        Track against reference, the rank of each slot (-1 for absent)
+        '''
+        database = self.database
+        ref = np.full(len(database.paths), -1, dtype=np.int64)
+        n = min(len(ref), len(reference))
+        ref[:n] = reference[:n]
+        order = database.order
+        common = order[ref[order] >= 0]
+        self.reference = np.full(len(database.paths), -1, dtype=np.int64)
+        self.reference[common[np.argsort(ref[common], kind='stable')]] = np.arange(len(common))
+        self.rebuild()
+
+    def rebuild(self):
+        '''
+        Rebuild the index from the database (quicker than refresh after most of the scores have changed)
+        '''
+        scores = self.database.scores
+        common = np.flatnonzero(self.reference >= 0)
+        self.keys:dict[int, float] = dict(zip(common.tolist(), (-scores[common]).tolist()))
+        reference = self.reference.tolist()
+        self.index = ScoreIndex(((key, slot) for slot, key in self.keys.items()), weight=lambda item:reference[item[1]])
+        current = np.empty(len(common), dtype=np.int64)
+        current[np.lexsort((common, -scores[common]))] = np.arange(len(common))
+        self.cross = int(np.dot(current, self.reference[common]))
+        self.m = len(common)
+
+    def refresh(self, image_records:list[ImageRecord]):
+        for r in image_records:
+            slot = r.slot
+            if slot not in self.keys: continue
+            old, new = self.keys[slot], -r.score
+            if old == new: continue
+            a = self.index.rank(old, slot)
+            self.index.remove(old, slot)
+            self.index.add(new, slot)
+            b = self.index.rank(new, slot)
+            if a < b:   self.cross -= int(round(self.index.weight_sum(a, b)))
+            elif b < a: self.cross += int(round(self.index.weight_sum(b+1, a+1)))
+            self.cross += int(self.reference[slot]) * (b - a)
+            self.keys[slot] = new
+
+    @property
+    def squared_displacement(self) -> int:
+        '''
+        Sum over images of the square of the change in rank since the reference
+        '''
+        m = self.m
+        return 2 * ((m-1)*m*(2*m-1)//6 - self.cross)
+
+    @property
+    def spearman(self) -> float:
+        m = self.m
+        return 1.0 - 6.0 * self.squared_displacement / (m * (m*m - 1.0)) if m > 1 else 1.0
+
+    def against(self, reference:np.ndarray) -> tuple[float, float]:
+        '''
+        (spearman, kendall) of the current ranking against reference (ranks by slot; see RankCheckpoints.for_database)
+        '''
+        current = ranks_of(self.database)
+        return spearman(current, reference), kendall(current, reference)
@@ -0,0 +1,69 @@
+import os, time, threading
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+class DirectoryScanner:
+    '''
+    Walks a directory tree with a pool of threads, one directory listing (and the stat of its files) per task,
+    so that on high latency filesystems many directories are being read at once.
+
+    scan() yields, for each directory as soon as it has been read, a list of (relative_path, stat) for its files.
+    Subdirectories for which skip_directory(relative_path) is True are not entered.
+    The counters (directories, files, images) can be read from another thread to show progress.
+    '''
+    def __init__(self, base_directory, workers=16, skip_directory:callable=lambda rp:False):
+        self.base_directory = base_directory
+        self.workers = workers
+        self.skip_directory = skip_directory
+        self.directories = 0
+        self.files = 0
+        self.images = 0
+        self.started = None
+        self.finished = None
+        self.done = threading.Event()
+
+    def _list(self, rel_dir):
+        files, subdirectories = [], []
+        try:
+            with os.scandir(os.path.join(self.base_directory, rel_dir)) as it:
+                for dir_entry in it:
+                    relative_path = os.path.relpath(os.path.join(rel_dir, dir_entry.name))
+                    try:
+                        if dir_entry.is_dir(follow_symlinks=False):
+                            if not self.skip_directory(relative_path): subdirectories.append(relative_path)
+                        elif dir_entry.is_file():
+                            files.append((relative_path, dir_entry.stat()))
+                    except OSError:
+                        pass
+        except OSError:
+            pass
+        return files, subdirectories
+
+    def scan(self):
+        self.started = time.monotonic()
+        try:
+            with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="scan") as executor:
+                pending = { executor.submit(self._list, '.') }
+                while pending:
+                    finished, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in finished:
+                        files, subdirectories = future.result()
+                        pending.update(executor.submit(self._list, d) for d in subdirectories)
+                        self.directories += 1
+                        self.files += len(files)
+                        if files: yield files
+        finally:
+            self.finished = time.monotonic()
+            self.done.set()
+
+    @property
+    def elapsed(self) -> float:
+        return ((self.finished or time.monotonic()) - self.started) if self.started else 0.0
+
+    @property
+    def rate(self) -> float:
+        return self.files / self.elapsed if self.elapsed else 0.0
+
+    @property
+    def printable(self) -> str:
+        return "{:>6} images in {:>7} files in {:>5} directories ({:>7.0f} files/s){}".format(
+            self.images, self.files, self.directories, self.rate, "" if self.done.is_set() else " - scanning")
@@ -0,0 +1,251 @@
+import os, csv, json, mmap, shutil, tempfile
+import numpy as np
+from contextlib import contextmanager
+
+CHUNK = 1 << 16
+
+@contextmanager
+def atomic_write(filepath, mode='w', **kwargs):
+    '''
+    Open a temporary file next to filepath for writing; when the block exits without an exception it is
+    flushed, fsynced and renamed over filepath, so readers only ever see the old file or the complete new one.
+    '''
+    directory = os.path.dirname(os.path.abspath(filepath))
+    fd, temppath = tempfile.mkstemp(dir=directory, prefix=os.path.basename(filepath)+".", suffix=".tmp")
+    try:
+        os.chmod(temppath, os.stat(filepath).st_mode if os.path.exists(filepath) else 0o644)
+        with os.fdopen(fd, mode, **kwargs) as f:
+            yield f
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temppath, filepath)
+    except BaseException:
+        try:
+            os.remove(temppath)
+        except OSError:
+            pass
+        raise
+
+def snapshot(filepath, snapshot_path):
+    '''
+    Make snapshot_path a copy of filepath, by hardlinking if possible. Safe because scorefiles are only ever
+    replaced (atomic_write), never modified in place.
+    '''
+    if os.path.exists(snapshot_path): os.remove(snapshot_path)
+    try:
+        os.link(filepath, snapshot_path)
+    except OSError:
+        shutil.copyfile(filepath, snapshot_path)
+
+def read_csv(filepath):
+    '''
+    Yield the header (a list of column names) and then each row (a list of strings)
+    '''
+    with open(filepath, 'r', newline='') as f:
+        reader = csv.reader(f)
+        yield [h.strip().strip('"') for h in next(reader, [])]
+        for row in reader:
+            if row: yield [v.strip() for v in row]
+
+def write_csv(filepath, header:list[str], rows):
+    with atomic_write(filepath, newline='') as f:
+        writer = csv.writer(f, lineterminator='\n')
+        writer.writerow(header)
+        writer.writerows(rows)
+
+class _JsonStream:
+    def __init__(self, f):
+        self.f = f
+        self.buffer = ""
+        self.pos = 0
+        self.decoder = json.JSONDecoder()
+
+    def more(self) -> bool:
+        chunk = self.f.read(CHUNK)
+        if not chunk: return False
+        self.buffer = self.buffer[self.pos:] + chunk
+        self.pos = 0
+        return True
+
+    def peek(self) -> str:
+        while True:
+            while self.pos < len(self.buffer) and self.buffer[self.pos] in ' \t\r\n': self.pos += 1
+            if self.pos < len(self.buffer) or not self.more(): return self.buffer[self.pos:self.pos+1]
+
+    def expect(self, c):
+        if self.peek() != c: raise ValueError(f"Expected '{c}' in JSON scorefile")
+        self.pos += 1
+
+    def value(self):
+        self.peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buffer, self.pos)
+                if end < len(self.buffer) or not self.more():
+                    self.pos = end
+                    return value
+            except json.JSONDecodeError:
+                if not self.more(): raise
+
+    def keys(self):
+        '''
+        Yield the key of each member of the object starting at the current position; the caller must
+        consume the value (with value(), or keys() if it is an object) before asking for the next key
+        '''
+        self.expect('{')
+        if self.peek() == '}':
+            self.pos += 1
+            return
+        while True:
+            key = self.value()
+            self.expect(':')
+            yield key
+            if self.peek() == '}':
+                self.pos += 1
+                return
+            self.expect(',')
+
+def read_json(filepath, metadata:dict):
+    '''
+    Yield the record dictionaries from the "ImageRecords" of a JSON scorefile one at a time, without loading
+    the whole file; anything in "Metadata" is put into metadata.
+    '''
+    with open(filepath, 'r') as f:
+        stream = _JsonStream(f)
+        for key in stream.keys():
+            if key == "ImageRecords" and stream.peek() == '{':
+                for _ in stream.keys(): yield stream.value()
+            else:
+                value = stream.value()
+                if key == "Metadata": metadata.update(value)
+
+def write_json(filepath, header:list[str], rows, metadata:dict):
+    path_column = header.index('relative_path')
+    with atomic_write(filepath) as f:
+        f.write('{\n  "ImageRecords": {')
+        separator = "\n"
+        for row in rows:
+            record = json.dumps(dict(zip(header, row)), indent=2).replace("\n", "\n    ")
+            f.write(f'{separator}    {json.dumps(row[path_column])}: {record}')
+            separator = ",\n"
+        f.write('\n  },\n  "Metadata": ' + json.dumps(metadata, indent=2).replace("\n", "\n  ") + "\n}\n")
+
+BINARY_EXTENSION = ".scoredb"
+BINARY_MAGIC = b"ABSCORES"
+BINARY_VERSION = 1
+
+def _aligned(n, alignment=8): return (n + alignment - 1) // alignment * alignment
+
+def _string_table(strings:list[str]) -> tuple[np.ndarray, np.ndarray]:
+    '''
+    Strings as (offsets, bytes): string i is bytes[offsets[i]:offsets[i+1]-1], each being followed by a zero byte
+    '''
+    encoded = [s.encode('utf-8') for s in strings]
+    offsets = np.zeros(len(encoded)+1, dtype='<u8')
+    np.cumsum([len(e)+1 for e in encoded], out=offsets[1:])
+    return offsets, np.frombuffer(b"".join(e + b"\0" for e in encoded), dtype=np.uint8)
+
+def write_binary(filepath, header:list[str], paths:list[str], scores:np.ndarray, comparisons:np.ndarray, extra:dict[str, list], metadata:dict):
+    '''
+    Write a binary scorefile: magic, version, the length of a JSON description, the description (header, metadata and
+    the offset, dtype and length of each array), then the arrays, each 8 byte aligned. Scores are little-endian float64 and
+    comparisons int32; relative paths are a string table, and other columns string tables of JSON encoded values
+    (so that values read from a JSON scorefile keep their types).
+    '''
+    arrays = { 'score' : np.ascontiguousarray(scores, dtype='<f8'), 'comparisons' : np.ascontiguousarray(comparisons, dtype='<i4') }
+    arrays['relative_path.offsets'], arrays['relative_path.bytes'] = _string_table(paths)
+    for column, values in extra.items():
+        arrays[column+'.offsets'], arrays[column+'.bytes'] = _string_table([json.dumps(v) for v in values])
+    layout, offset = {}, 0
+    for name, array in arrays.items():
+        layout[name] = { 'offset' : offset, 'dtype' : array.dtype.str, 'length' : len(array) }
+        offset = _aligned(offset + array.nbytes)
+    description = json.dumps({ 'count' : len(paths), 'header' : header, 'metadata' : metadata, 'arrays' : layout }).encode('utf-8')
+    start = _aligned(len(BINARY_MAGIC) + 16 + len(description))
+    with atomic_write(filepath, 'wb') as f:
+        f.write(BINARY_MAGIC + np.array([BINARY_VERSION, len(description)], dtype='<u8').tobytes() + description)
+        for name, array in arrays.items():
+            f.write(b"\0" * (start + layout[name]['offset'] - f.tell()))
+            f.write(array.tobytes())
+
+class BinaryScorefile:
+    '''
+    Read-only, memory-mapped view of a binary scorefile. The arrays are views of the mapping, so nothing is read
+    until it is used, and processes reading the same file share the pages. Use as a context manager, or close()
+    once any arrays taken from it are no longer needed.
+    '''
+    def __init__(self, filepath):
+        with open(filepath, 'rb') as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.map[:len(BINARY_MAGIC)] != BINARY_MAGIC: raise ValueError(f"{filepath} is not a binary scorefile")
+        version, length = np.frombuffer(self.map, dtype='<u8', count=2, offset=len(BINARY_MAGIC))
+        if version > BINARY_VERSION: raise ValueError(f"{filepath} is binary scorefile version {version}, which is newer than this code")
+        start = len(BINARY_MAGIC) + 16
+        description = json.loads(self.map[start:start+int(length)].decode('utf-8'))
+        self.start = _aligned(start + int(length))
+        self.count:int = description['count']
+        self.header:list[str] = description['header']
+        self.metadata:dict = description['metadata']
+        self.layout:dict = description['arrays']
+
+    def __enter__(self): return self
+
+    def __exit__(self, *args): self.close()
+
+    def close(self):
+        try:
+            self.map.close()
+        except BufferError:
+            pass    # arrays still refer to it; the mapping is released when they are
+
+    def array(self, name) -> np.ndarray:
+        entry = self.layout[name]
+        return np.frombuffer(self.map, dtype=entry['dtype'], count=entry['length'], offset=self.start + entry['offset'])
+
+    @property
+    def scores(self) -> np.ndarray: return self.array('score')
+
+    @property
+    def comparisons(self) -> np.ndarray: return self.array('comparisons')
+
+    @property
+    def columns(self) -> list[str]:
+        return [h for h in self.header if h not in ('relative_path', 'score', 'comparisons') and h+'.offsets' in self.layout]
+
+    def _strings(self, name) -> list[str]:
+        if not self.count: return []
+        entry = self.layout[name+'.bytes']
+        start = self.start + entry['offset']
+        return self.map[start:start+entry['length']-1].decode('utf-8').split("\0")
+
+    def path(self, i) -> str:
+        offsets = self.array('relative_path.offsets')
+        start = self.start + self.layout['relative_path.bytes']['offset']
+        return self.map[start+int(offsets[i]):start+int(offsets[i+1])-1].decode('utf-8')
+
+    def paths(self) -> list[str]:
+        return self._strings('relative_path')
+
+    def column(self, name) -> list:
+        if not self.count: return []
+        entry = self.layout[name+'.bytes']
+        start = self.start + entry['offset']
+        return json.loads("[" + self.map[start:start+entry['length']-1].decode('utf-8').replace("\0", ",") + "]")
+
+def read_scores(filepath) -> tuple[list[str], np.ndarray]:
+    '''
+    Just the relative paths and scores from a scorefile of any format, without building an ImageDatabase
+    '''
+    if filepath.endswith(BINARY_EXTENSION):
+        with BinaryScorefile(filepath) as f: return f.paths(), np.array(f.scores)
+    if filepath.endswith("csv"):
+        rows = read_csv(filepath)
+        header = next(rows)
+        path_i, score_i = header.index('relative_path'), header.index('score') if 'score' in header else None
+        paths, scores = [], []
+        for row in rows:
+            paths.append(row[path_i])
+            scores.append(float(row[score_i] or 0.0) if score_i is not None and score_i < len(row) else 0.0)
+        return paths, np.array(scores, dtype=np.float64)
+    records = list(read_json(filepath, {}))
+    return [r['relative_path'] for r in records], np.array([float(r.get('score') or 0.0) for r in records], dtype=np.float64)
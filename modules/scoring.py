@@ -1,131 +1,373 @@
-import os, math, json
-from PIL import Image
+import os, math, queue, threading, itertools
+import numpy as np
+from modules.metadata import MetadataIndex
+from modules.scanner import DirectoryScanner
+from modules.thumbnails import CACHE_DIRECTORY
+from modules import scorefiles
+from modules.journal import Journal
+from modules.profiling import timer
+
+def comparisons_made(entry:dict) -> int:
+    '''
+    How much a journal entry adds to the total comparisons, with shown images in the set: each loser is compared
+    with the winner, 2(shown-1), or for a ranking (entry['ranked']) each image with every other, shown(shown-1)
+    '''
+    shown = len(entry['losers']) + 1
+    return shown * (shown - 1) if entry.get('ranked') else 2 * (shown - 1)
 
 class ImageRecord:
-    header = None
+    __slots__ = ('database', 'slot')
+
+    def __init__(self, database:'ImageDatabase', slot:int):
+        self.database = database
+        self.slot = slot
+
+    def __eq__(self, other): return isinstance(other, ImageRecord) and self.database is other.database and self.slot==other.slot
 
-    def __init__(self,**kwargs):
-        self.columns = {k: kwargs[k] for k in kwargs}
-        assert 'relative_path' in self.columns
-        if 'comparisons' not in self.columns: self.columns['comparisons'] = 0
-        if 'score' not in self.columns: self.columns['score'] = 0.0
-        if ImageRecord.header is None: ImageRecord.header = ",".join( k for k in self.columns )
+    def __hash__(self): return hash((id(self.database), self.slot))
+
+    def __repr__(self): return f"ImageRecord({self.printable})"
 
     @property
-    def relative_path(self): return self.columns['relative_path']
+    def relative_path(self): return self.database.paths[self.slot]
 
     @property
-    def score(self): return float(self.columns['score'])
+    def score(self): return float(self.database.scores[self.slot])
 
     @score.setter
-    def score(self, value): self.columns['score'] = str(value)
+    def score(self, value): self.database.scores[self.slot] = value
 
     @property
-    def comparisons(self): return int(self.columns['comparisons'])
+    def comparisons(self): return int(self.database.comparisons[self.slot])
 
     @comparisons.setter
-    def comparisons(self, value): self.columns['comparisons'] = str(value)
+    def comparisons(self, value): self.database.comparisons[self.slot] = value
+
+    @property
+    def columns(self) -> dict:
+        return { k : self.database.column(k)[self.slot] for k in self.database.header }
 
     @property
     def printable(self):
-        return ",".join( str(self.columns[k]) for k in self.columns )
+        return ",".join( str(v) for v in self.columns.values() )
 
     @property
     def as_dictionary(self):
         return self.columns
     
 class ImageDatabase:
-    def __init__(self, base_directory, loadfrom=None, add_files=True, remove_files=True, trust_extensions=[]):
+    '''
+    Columnar store: scores (float64) and comparisons (int32) are held in arrays indexed by slot, with 
+    relative_path -> slot in self.slots, and the current (live, ordered) slots in self.order.
+    Any other columns read from a scorefile are kept as lists of strings in self.extra so they round-trip.
+    '''
+    default_header = ['relative_path', 'comparisons', 'score']
+
+    def __init__(self, base_directory, loadfrom=None, add_files=True, remove_files=True, trust_extensions=[], index_file=None, background_scan=False,
+                 journal:Journal=None):
         self.base_directory = base_directory
-        self.image_records:dict[str, ImageRecord] = {}
+        self.paths:list[str] = []
+        self.scores = np.zeros(0, dtype=np.float64)
+        self.comparisons = np.zeros(0, dtype=np.int32)
+        self.extra:dict[str, list] = {}
+        self.header = list(self.default_header)
+        self.slots:dict[str, int] = {}
+        self._order = np.zeros(0, dtype=np.int64)
+        self._live = 0
         self.metadata:dict = {}
-        if loadfrom: self.load_scores(loadfrom)
-        if add_files: self.recursively_add(trust_extensions)
-        if remove_files: self.remove_missing()
+        self.model_scores:dict[str, float] = {}
+        self.model_mapping = (1.0, 0.0)
+        with timer("load index"): self.index = MetadataIndex(base_directory, index_file)
+        self.scanner = DirectoryScanner(base_directory, skip_directory=lambda rp:rp==CACHE_DIRECTORY or rp.endswith(".ranks"))
+        self.scanned:queue.Queue[list[str]] = queue.Queue()
+        self.scan_thread:threading.Thread = None
+        if loadfrom: 
+            with timer("load scores"): self.load_scores(loadfrom)
+        saved_comparisons = self.total_comparisons
+        if add_files: 
+            with timer("scan"): self.recursively_add(trust_extensions, background=background_scan)
+        if remove_files: 
+            with timer("remove missing"): self.remove_missing()
+        if journal: 
+            entries = list(journal.unapplied())
+            if self.scanning and any(rp not in self.slots for e in entries for rp in [e['winner']] + e['losers']):
+                print("Waiting for the scan to finish, to replay the journal")
+                self.scan_thread.join()
+                self.add_scanned()
+            with timer("replay journal"): self.replay(entries, saved_comparisons)
+        self.index.save()
+
+    def _reserve(self, n):
+        if n <= len(self.scores) and n <= len(self._order): return
+        capacity = max(n, 2*len(self.scores), 16)
+        self.scores = np.concatenate((self.scores, np.zeros(capacity-len(self.scores), dtype=np.float64)))
+        self.comparisons = np.concatenate((self.comparisons, np.zeros(capacity-len(self.comparisons), dtype=np.int32)))
+        self._order = np.concatenate((self._order, np.zeros(capacity-len(self._order), dtype=np.int64)))
+
+    def extend(self, relative_paths:list[str], scores=None, comparisons=None, extra:dict[str, list]=None):
+        '''
+        Add records in bulk. Paths already in the database are skipped.
+        '''
+        first = len(self.paths)
+        if not self.paths and len(slots := dict(zip(relative_paths, itertools.count()))) == len(relative_paths):
+            keep = slice(None)     # loading into an empty database, with no duplicates
+            n = len(slots)
+            if not n: return
+            self._reserve(n)
+            self.paths.extend(relative_paths)
+            self.slots = slots
+        else:
+            keep, seen = [], set()
+            for i, rp in enumerate(relative_paths):
+                if rp not in self.slots and rp not in seen:
+                    keep.append(i)
+                    seen.add(rp)
+            if not keep: return
+            n = len(keep)
+            self._reserve(first + n)
+            for j, i in enumerate(keep):
+                self.paths.append(relative_paths[i])
+                self.slots[relative_paths[i]] = first + j
+        if scores is not None: self.scores[first:first+n] = np.asarray(scores, dtype=np.float64)[keep]
+        if comparisons is not None: self.comparisons[first:first+n] = np.asarray(comparisons, dtype=np.int32)[keep]
+        for column in self.extra: self.extra[column].extend([""]*n)
+        for column in (extra or {}):
+            if column not in self.extra: 
+                self.extra[column] = [""]*(first+n)
+                if column not in self.header: self.header.append(column)
+            values = extra[column]
+            self.extra[column][first:first+n] = values[keep] if isinstance(keep, slice) else [values[i] for i in keep]
+        self._order[self._live:self._live+n] = np.arange(first, first+n)
+        self._live += n
+
+    def add(self, relative_path, score=0.0, comparisons=0) -> ImageRecord:
+        if relative_path not in self.slots: self.extend([relative_path], [score], [comparisons])
+        return ImageRecord(self, self.slots[relative_path])
+
+    def column(self, name) -> list:
+        if name=='relative_path': return self.paths
+        if name=='score': return self.scores
+        if name=='comparisons': return self.comparisons
+        return self.extra[name]
+
+    def _load_rows(self, header:list[str], rows):
+        header = [h for h in header if h]
+        self.header = header + [h for h in self.default_header if h not in header]
+        path_i = header.index('relative_path')
+        score_i = header.index('score') if 'score' in header else None
+        comparisons_i = header.index('comparisons') if 'comparisons' in header else None
+        paths, scores, comparisons = [], [], []
+        extra = { h : [] for h in header if h not in self.default_header }
+        extra_i = [(header.index(h), extra[h]) for h in extra]
+        for row in rows:
+            if len(row) < len(header): row = row + [""]*(len(header)-len(row))
+            paths.append(row[path_i])
+            scores.append(float(row[score_i] or 0.0) if score_i is not None else 0.0)
+            comparisons.append(int(row[comparisons_i] or 0) if comparisons_i is not None else 0)
+            for i, column in extra_i: column.append(row[i])
+        self.extend(paths, scores, comparisons, extra)
 
     def load_scores(self, filename):
         scores_path = os.path.join(self.base_directory,filename)
         if os.path.exists(scores_path):
             if scores_path.endswith("csv"):
-                with open(scores_path,'r') as f:
-                    headers = list(x.strip().strip('"') for x in f.readline().split(','))
-                    for line in f.readlines():
-                        values = {headers[i] : bit.strip().strip('"') for i, bit in enumerate(line.split(','))}
-                        self.image_records[values['relative_path']] = ImageRecord(**values)
+                rows = scorefiles.read_csv(scores_path)
+                self._load_rows(next(rows), rows)
+            elif scores_path.endswith(scorefiles.BINARY_EXTENSION):
+                self.load_binary(scores_path)
             else:
-                with open(scores_path,'r') as f:
-                    loaded:dict = json.load(f)
-                    self.image_records = loaded.get('ImageRecords',[])
-                    for ir in self.image_records: self.image_records[ir] = ImageRecord(**self.image_records[ir])
-                    self.metadata = loaded.get('Metadata', {})
+                records = scorefiles.read_json(scores_path, self.metadata)
+                if (first := next(records, None)) is not None:
+                    header = list(first)
+                    self._load_rows(header, ([r.get(h, "") for h in header] for r in itertools.chain((first,), records)))
         else:
             print(f"No scorefile to load at {scores_path}")
 
+    def load_binary(self, scores_path):
+        '''
+        Load a binary scorefile (see scorefiles.write_binary). The score and comparison columns are copied straight
+        from the mapping, so the file isn't held open and can be replaced by a later save.
+        '''
+        with scorefiles.BinaryScorefile(scores_path) as f:
+            self.header = f.header + [h for h in self.default_header if h not in f.header]
+            self.metadata.update(f.metadata)
+            self.extend(f.paths(), np.array(f.scores), np.array(f.comparisons), { h : f.column(h) for h in f.columns })
+
+    @property
+    def order(self) -> np.ndarray:
+        return self._order[:self._live]
+
+    def _columns_for_output(self, order) -> list[list]:
+        columns = []
+        for h in self.header:
+            if h=='relative_path': columns.append([self.paths[s] for s in order.tolist()])
+            elif h=='score': columns.append(self.scores[order].tolist())
+            elif h=='comparisons': columns.append(self.comparisons[order].tolist())
+            else: columns.append([self.extra[h][s] for s in order.tolist()])
+        return columns
+
     @property
     def as_dictionary(self):
-        return { "ImageRecords" : { f : self.image_records[f].as_dictionary for f in self.image_records },
+        columns = self._columns_for_output(self.order)
+        return { "ImageRecords" : { rp : dict(zip(self.header, row)) for rp, row in zip(self.paths_in_order, zip(*columns)) },
                  "Metadata" : self.metadata }
 
+    def replay(self, entries, total:int=None) -> int:
+        '''
+        Apply journal entries (see modules.journal) that aren't already reflected in the scores. Returns the number applied.
+        total is the total comparisons in the scorefile as saved (by default, now), which the entries' n are measured
+        against; it must be taken before any missing images are removed.
+        '''
+        applied = 0
+        total = self.total_comparisons if total is None else total
+        for entry in entries:
+            if entry['n'] + comparisons_made(entry) <= total or entry['winner'] not in self.slots: continue
+            updater = ScoreUpdater(entry['k'])
+            winner = ImageRecord(self, self.slots[entry['winner']])
+            if entry.get('ranked'):
+                ranking = [ImageRecord(self, self.slots[rp]) for rp in [entry['winner']] + entry['losers'] if rp in self.slots]
+                if len(ranking) > 1: updater.update_ranking(ranking, k_fac=entry['k_fac'])
+                total += len(ranking) * (len(ranking) - 1)
+            else:
+                for loser in entry['losers']:
+                    if loser in self.slots: 
+                        updater.update_scores(winner, ImageRecord(self, self.slots[loser]), k_fac=entry['k_fac'])
+                        total += 2
+            applied += 1
+        if applied: print(f"Replayed {applied} judgements from the journal")
+        return applied
+
+    def copy(self) -> 'ImageDatabase':
+        '''
+        A copy of the records that can be sorted and saved (e.g. from another thread) while this database changes
+        '''
+        other = ImageDatabase.__new__(ImageDatabase)
+        other.__dict__.update(self.__dict__)
+        other.paths = list(self.paths)
+        other.scores = self.scores.copy()
+        other.comparisons = self.comparisons.copy()
+        other._order = self._order.copy()
+        other.extra = { k : list(v) for k, v in self.extra.items() }
+        other.header = list(self.header)
+        other.slots = dict(self.slots)
+        other.metadata = dict(self.metadata)
+        return other
+
+    def rows(self, chunk=10000):
+        '''
+        Yield each record, in order, as a tuple of values matching self.header (columns are built a chunk at a time)
+        '''
+        order = self.order
+        for start in range(0, len(order), chunk):
+            yield from zip(*self._columns_for_output(order[start:start+chunk]))
+
     def save_scores(self, filename):
-        scores_path = os.path.join(self.base_directory,filename)
-        with open(scores_path,'w') as f:
-            print(json.dumps(self.as_dictionary, indent=2), file=f)
+        scorefiles.write_json(os.path.join(self.base_directory,filename), self.header, self.rows(), self.metadata)
 
     def save_csv(self, filename):
-        scores_path = os.path.join(self.base_directory,filename)
-        with open(scores_path,'w') as f:
-            print(ImageRecord.header, file=f)
-            for relative_path in self.image_records:
-                image_record:ImageRecord = self.image_records[relative_path]
-                print(image_record.printable, file=f)
-
-    def sort(self, reverse=False):
-        l = [self.image_records[x] for x in self.image_records]
-        l.sort(key=lambda ir:ir.score, reverse=reverse)
-        self.image_records = {ir.relative_path:ir for ir in l}
-
-    def recursively_add(self, trust_extensions):
-        for (dir_path, dir_names, file_names) in os.walk(self.base_directory):
-            rel_dir = os.path.relpath(dir_path, self.base_directory)
-            for filename in file_names:
-                relative_path = os.path.relpath(os.path.join(rel_dir,filename))
-                if not relative_path in self.image_records:
-                    fullpath = os.path.join(dir_path, filename)
-                    try:
-                        if not (trust_extensions and os.path.splitext(fullpath)[1] in trust_extensions):
-                            Image.open(fullpath)
-                        self.image_records[relative_path] = ImageRecord(relative_path=relative_path)
-                    except:
-                        print(f"{relative_path} isn't an image")
-
-    def max_aspect_ratio(self) -> float:
-        mar = 0
-        for relative_path in self.image_records:
-            i = Image.open(os.path.join(self.base_directory, relative_path))
-            ar = i.width / i.height
-            mar = max(mar, ar)
-        return mar
+        scorefiles.write_csv(os.path.join(self.base_directory,filename), self.header, self.rows())
+
+    def save_binary(self, filename):
+        order = self.order
+        scorefiles.write_binary(os.path.join(self.base_directory,filename), self.header, [self.paths[s] for s in order.tolist()],
+                                self.scores[order], self.comparisons[order],
+                                { h : [values[s] for s in order.tolist()] for h, values in self.extra.items() }, self.metadata)
+
+    def save(self, filename):
+        if filename.endswith("csv"): self.save_csv(filename)
+        elif filename.endswith(scorefiles.BINARY_EXTENSION): self.save_binary(filename)
+        else: self.save_scores(filename)
+
+    def sort(self, reverse=False, tiebreak:np.ndarray=None):
+        '''
+        Order the records by score; records with equal scores keep their order, or are ordered by tiebreak (indexed by slot)
+        '''
+        order = self.order
+        keys = -self.scores[order] if reverse else self.scores[order]
+        self._order[:self._live] = order[np.lexsort((tiebreak[order], keys)) if tiebreak is not None else np.argsort(keys, kind='stable')]
+
+    def recursively_add(self, trust_extensions, background=False):
+        '''
+        Add all images in the directory tree. If background is True, the scan runs in a thread and the images found
+        are queued; call add_scanned() (from the thread that owns the database) to add them as they arrive.
+        '''
+        if not background:
+            for relative_paths in self.index.scan(trust_extensions, self.scanner): self.extend(relative_paths)
+            return
+        def scan():
+            for relative_paths in self.index.scan(trust_extensions, self.scanner): self.scanned.put(relative_paths)
+            self.index.save()
+        self.scan_thread = threading.Thread(target=scan, daemon=True, name="ImageDatabase scan")
+        self.scan_thread.start()
+
+    @property
+    def scanning(self) -> bool:
+        return self.scan_thread is not None and self.scan_thread.is_alive()
+
+    def add_scanned(self) -> list[ImageRecord]:
+        '''
+        Add any images found by a background scan since the last call, and return the new records
+        '''
+        first = len(self.paths)
+        while True:
+            try:
+                self.extend(self.scanned.get_nowait())
+            except queue.Empty:
+                break
+        return [ImageRecord(self, s) for s in range(first, len(self.paths)) if self.slots.get(self.paths[s])==s]
+
+    def max_aspect_ratio(self, relative_paths:list[str]=None) -> float:
+        '''
+        The widest aspect ratio among relative_paths (by default, all the images)
+        '''
+        relative_paths = self.paths_in_order if relative_paths is None else relative_paths
+        self.index.fill_dimensions(relative_paths)
+        self.index.save()
+        return max((e.aspect_ratio for rp in relative_paths if (e := self.index.entries.get(rp)) is not None), default=0)
     
-    def get_image(self, ir:ImageRecord) -> Image:
+    def get_image(self, ir:ImageRecord) -> 'Image.Image':
+        from PIL import Image
         return Image.open(os.path.join(self.base_directory, ir.relative_path))
     
-    def remove(self, test:callable):
-        remove = []
-        for k in self.image_records:
-            if test(self.image_records[k]): remove.append(k)
-        for k in remove: self.image_records.pop(k)
+    def remove(self, test:callable=None, mask=None):
+        '''
+        Remove records for which test(ImageRecord) is True, or where mask (aligned with self.order) is True
+        '''
+        order = self.order
+        if mask is None: mask = np.fromiter((test(ImageRecord(self, s)) for s in order.tolist()), dtype=bool, count=len(order))
+        mask = np.asarray(mask, dtype=bool)
+        for s in order[mask].tolist(): self.slots.pop(self.paths[s])
+        keep = order[~mask]
+        self._order[:len(keep)] = keep
+        self._live = len(keep)
+
+    @property
+    def image_records(self) -> dict[str, ImageRecord]:
+        return { self.paths[s] : ImageRecord(self, s) for s in self.order.tolist() }
+
+    @property
+    def paths_in_order(self) -> list[str]:
+        return [self.paths[s] for s in self.order.tolist()]
+
+    @property
+    def score_array(self) -> np.ndarray:
+        return self.scores[self.order]
+
+    @property
+    def comparison_array(self) -> np.ndarray:
+        return self.comparisons[self.order]
 
     @property
     def records(self) -> list[ImageRecord]:
-        return [self.image_records[r] for r in self.image_records]
+        return [ImageRecord(self, s) for s in self.order.tolist()]
     
     @property
     def total_comparisons(self) -> int:
-        return sum(self.image_records[r].comparisons for r in self.image_records)
+        return int(self.comparisons[self.order].sum())
     
     @property
     def image_count(self) -> int:
-        return len(self.image_records)
+        return self._live
     
     @property
     def printable(self) -> str:
@@ -139,15 +381,51 @@ class ImageDatabase:
     def for_csv_headers(self):
         return ("comparison","images")
 
+    def seed(self, filename, spread=0.5, min_overlap=20) -> int:
+        '''
+        Give the images that haven't been compared scores from a model's scorefile (any format, relative to the base
+        directory), mapped onto the Elo scale by score = a*model + b. a and b are a least-squares fit (weighted by
+        comparisons) to the images that have been compared, if at least min_overlap of them are in the model's file;
+        otherwise the model's scores are just centred on 0 with standard deviation spread. Returns the number seeded.
+        '''
+        model = ImageDatabase(self.base_directory, loadfrom=filename, add_files=False, remove_files=False)
+        self.model_scores = dict(zip(model.paths_in_order, model.score_array.tolist()))
+        values = model.score_array
+        slots = np.fromiter((self.slots.get(rp, -1) for rp in model.paths_in_order), dtype=np.int64, count=len(values))
+        compared = slots >= 0
+        compared[compared] = self.comparisons[slots[compared]] > 0
+        x, y, w = values[compared], self.scores[slots[compared]], self.comparisons[slots[compared]].astype(np.float64)
+        a = np.cov(x, y, aweights=w)[0, 1] / np.cov(x, aweights=w) if len(x) >= max(2, min_overlap) and np.ptp(x) > 0 else 0.0
+        if a > 0:
+            b = np.average(y - a*x, weights=w)
+            print(f"Model scores calibrated against {len(x)} compared images: score = {a:.4f} * model + {b:.4f}")
+        else:
+            std = float(np.std(values)) if len(values) else 0.0
+            a = spread / std if std > 0 else 0.0
+            b = -a * float(np.mean(values)) if len(values) else 0.0
+        self.model_mapping = (float(a), float(b))
+        self.metadata["model"] = { "scorefile" : filename, "a" : self.model_mapping[0], "b" : self.model_mapping[1] }
+        seeded = self.apply_model(self.order)
+        print(f"Seeded {seeded} scores from {filename}")
+        return seeded
+
+    def apply_model(self, slots:np.ndarray) -> int:
+        '''
+        Set the scores of the images among slots that haven't been compared from the model scores loaded by seed(). Returns the number set.
+        '''
+        if not self.model_scores: return 0
+        a, b = self.model_mapping
+        slots = np.asarray(slots, dtype=np.int64)
+        slots = slots[self.comparisons[slots] == 0]
+        values = np.fromiter((self.model_scores.get(self.paths[s], np.nan) for s in slots.tolist()), dtype=np.float64, count=len(slots))
+        found = ~np.isnan(values)
+        self.scores[slots[found]] = a * values[found] + b
+        return int(found.sum())
+
     def remove_missing(self):
-        missing = []
-        for relative_path in self.image_records:
-            try:
-                i = Image.open(os.path.join(self.base_directory, relative_path))
-            except:
-                missing.append(relative_path)
-        for missing_one in missing:
-            self.image_records.pop(missing_one)
+        relative_paths = self.paths_in_order
+        self.index.check(relative_paths)
+        self.remove(mask=[not ((e := self.index.entries.get(rp)) is not None and e.valid) for rp in relative_paths])
 
 
 class ScoreUpdater:
@@ -165,6 +443,30 @@ class ScoreUpdater:
         loser.score -= (1-p) * k_fac * self.k
         winner.comparisons += 1
         loser.comparisons += 1
+        self._count(p)
+
+    def update_ranking(self, ranking:list[ImageRecord], k_fac = 1.0):
+        '''
+        Listwise (Plackett-Luce) update for images put in order, best first: the ranking is taken as successive choices
+        of the best of those remaining, and each score moves by k times the gradient of its log likelihood (in the same
+        base-10 units as update_scores, which this is for a ranking of two). Every image counts as compared with each other.
+        '''
+        database = ranking[0].database
+        slots = np.fromiter((r.slot for r in ranking), dtype=np.int64, count=len(ranking))
+        scores = database.scores[slots]
+        strength = np.power(10.0, scores - scores.max())
+        remaining = np.cumsum(strength[::-1])[::-1][:-1]     # total strength of those left at each choice
+        chosen = np.zeros(len(slots))
+        chosen[:-1] = 1.0
+        expected = strength * np.cumsum(1.0 / remaining)[np.minimum(np.arange(len(slots)), len(slots)-2)]
+        database.scores[slots] = scores + (chosen - expected) * k_fac * self.k
+        database.comparisons[slots] += len(slots) - 1
+        for p in 1.0/(1.0+np.power(10.0, scores[1:] - scores[:-1])): self._count(p)
+
+    def _count(self, p):
+        '''
+        Add a choice, which had probability p, to the stats
+        '''
         self.average_p = (self.total_comparisons * self.average_p + p)/(self.total_comparisons + 1)
         self.average_bestp = (self.total_comparisons * self.average_bestp + max(p,1-p))/(self.total_comparisons + 1)
         self.total_favourite_wins += (p>0.5)
@@ -0,0 +1,272 @@
+import os, json, math, asyncio, itertools, time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit
+from modules.scoring import ImageRecord
+from modules.thumbnails import ThumbnailCache, scale_to_height, encode
+from modules.profiling import profiler, timer, timed
+
+MAX_BODY = 64*1024
+STATUS = { 200:"OK", 400:"Bad Request", 404:"Not Found", 405:"Method Not Allowed", 410:"Gone", 413:"Payload Too Large" }
+
+PAGE = '''<!DOCTYPE html>
+<html><head><meta charset="utf-8"><title>AB scorer</title>
+<style>
+body { margin:0; background:#222; color:#ccc; font-family:sans-serif; }
+#images { display:flex; justify-content:space-around; align-items:center; height:calc(100vh - 2em); }
+#images img { max-height:100%; max-width:calc(100vw / var(--n)); cursor:pointer; }
+#status { height:2em; line-height:2em; text-align:center; }
+</style></head>
+<body><div id="images"></div><div id="status"></div>
+<script>
+const rater = new URLSearchParams(location.search).get("rater") || "";
+let current = null, upcoming = null, shown = 0, count = 0, ranking = [];
+async function fetchSet() {
+  const set = await (await fetch("next")).json();
+  set.loaded = Promise.all(set.images.map(url => new Promise(resolve => {
+    const img = new Image(); img.onload = img.onerror = () => resolve(img); img.src = url; })));
+  return set;
+}
+async function show() {
+  current = await (upcoming || fetchSet());
+  upcoming = fetchSet();
+  const images = await current.loaded, div = document.getElementById("images");
+  div.style.setProperty("--n", images.length);
+  div.replaceChildren(...images);
+  images.forEach((img, i) => { img.style.opacity = 1; img.onclick = () => pick(i); });
+  ranking = [];
+  shown = performance.now();
+}
+function pick(i) {
+  if (!current) return;
+  if (!current.rank) return judge(i);
+  if (ranking.includes(i)) return;
+  ranking.push(i);
+  document.getElementById("images").children[i].style.opacity = 0.3;
+  if (ranking.length == current.images.length - 1) {
+    current.images.forEach((_, j) => { if (!ranking.includes(j)) ranking.push(j); });
+    judge(ranking[0], ranking);
+  }
+}
+function undo() {
+  if (current && ranking.length) document.getElementById("images").children[ranking.pop()].style.opacity = 1;
+}
+async function judge(winner, order) {
+  if (!current) return;
+  const set = current; current = null;
+  const ms = performance.now() - shown;
+  show();
+  const response = await fetch("judge", { method:"POST", headers:{"Content-Type":"application/json"},
+                                          body:JSON.stringify({ set:set.set, winner:winner, ranking:order, ms:ms, rater:rater }) });
+  if (response.ok) document.getElementById("status").textContent = `${++count} judged by you, ${(await response.json()).count} in total`;
+}
+document.addEventListener("keyup", e => {
+  if (e.key == "Backspace") return undo();
+  const i = parseInt(e.key) - 1; if (current && i >= 0 && i < current.images.length) pick(i); });
+show();
+</script></body></html>
+'''
+
+class ScoringServer:
+    '''
+    Serves comparison sets to any number of browsers, and applies their judgements to a single session (see
+    image_ab_scorer.Session).
+
+    Everything that touches the session runs on the event loop thread, so there are no locks: requests for sets are
+    answered straight from the image chooser, and judgements go through a queue to a single updater task, which applies
+    everything waiting, journals the batch with one fsync (a group commit, so throughput isn't limited by fsyncs), and
+    then replies. Scaling images and reading thumbnails happen on a thread pool, starting when a set is handed out.
+
+    The response time of a judgement (which weights it, see Session.k_fac) is the one the browser measured, clamped to
+    the time since the server issued the set.
+
+    With rank_all, the page asks the rater to put each set in order, and sends the ranking with the judgement.
+    '''
+    def __init__(self, session, number_to_compare, height, host="127.0.0.1", port=8080, checkpoint_every=500, checkpoint_seconds=60,
+                 outstanding=10000, workers=8, rank_all=False):
+        self.session = session
+        self.number_to_compare = number_to_compare
+        self.height = height
+        self.host = host
+        self.port = port
+        self.checkpoint_every = checkpoint_every
+        self.checkpoint_seconds = checkpoint_seconds
+        self.outstanding = outstanding
+        self.rank_all = rank_all
+        self.thumbnails:ThumbnailCache = session.thumbnails
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="server")
+        self.sets:OrderedDict[int, tuple[list[ImageRecord], float]] = OrderedDict()
+        self.set_ids = itertools.count(1)
+        self.images:OrderedDict[int, asyncio.Future] = OrderedDict()
+        self.raters:dict[str, int] = {}
+        self.checkpointed = session.count
+
+    @property
+    def content_type(self): return self.thumbnails.content_type if self.thumbnails else "image/jpeg"
+
+    def _image_bytes(self, relative_path) -> bytes:
+        if self.thumbnails: return self.thumbnails.get_bytes(relative_path)
+        return encode(scale_to_height(os.path.join(self.session.database.base_directory, relative_path), self.height), "JPEG")
+
+    def _image(self, record:ImageRecord) -> asyncio.Future:
+        if record.slot in self.images:
+            self.images.move_to_end(record.slot)
+        else:
+            self.images[record.slot] = asyncio.get_running_loop().run_in_executor(self.executor, self._image_bytes, record.relative_path)
+            while len(self.images) > 4 * self.number_to_compare * 64: self.images.popitem(last=False)
+        return self.images[record.slot]
+
+    @timed("next set")
+    def next_set(self) -> dict:
+        self.session.add_scanned()
+        records = self.session.image_chooser.pick_images(self.number_to_compare)
+        set_id = next(self.set_ids)
+        self.sets[set_id] = (records, time.monotonic())
+        while len(self.sets) > self.outstanding: self.sets.popitem(last=False)
+        for r in records: self._image(r)
+        return { "set" : set_id, "images" : [f"image/{r.slot}" for r in records], "rank" : self.rank_all }
+
+    async def judge(self, judgement:dict) -> tuple[int, dict]:
+        try:
+            set_id, win = int(judgement['set']), int(judgement['winner'])
+        except (KeyError, TypeError, ValueError):
+            return 400, { "error" : "expected set and winner" }
+        if set_id not in self.sets: return 410, { "error" : "unknown or already judged set" }
+        records, issued = self.sets[set_id]
+        if not 0 <= win < len(records): return 400, { "error" : "no such image in the set" }
+        ranking = judgement.get('ranking')
+        if ranking is not None:
+            if not isinstance(ranking, list) or not all(isinstance(i, int) for i in ranking) or sorted(ranking) != list(range(len(records))) or ranking[0] != win:
+                return 400, { "error" : "ranking must order every image in the set, starting with the winner" }
+        ms = judgement.get('ms')
+        if ms is not None and not (isinstance(ms, (int, float)) and math.isfinite(ms)): return 400, { "error" : "ms must be a number" }
+        del self.sets[set_id]
+        elapsed = time.monotonic() - issued
+        seconds = elapsed if ms is None else min(max(ms/1000, 0.0), elapsed)
+        rater = str(judgement.get('rater') or "")
+        future = asyncio.get_running_loop().create_future()
+        losers = [records[i] for i in ranking[1:]] if ranking else [r for i, r in enumerate(records) if i!=win]
+        await self.updates.put(((records[win], losers, seconds, rater, bool(ranking)), future))
+        return 200, { "count" : await future }
+
+    async def updater(self):
+        '''
+        Apply judgements (and checkpoints) from the queue, in order, in batches. A judgement that fails is answered
+        with its error without holding up the rest of the batch. Checkpoints copy the database here, and wait for the
+        previous compaction on the thread pool.
+        '''
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.updates.get()]
+            while not self.updates.empty(): batch.append(self.updates.get_nowait())
+            entries, futures, checkpoint = [], [], False
+            start = time.perf_counter()
+            for item, future in batch:
+                if item is None:
+                    checkpoint = True
+                    continue
+                winner, losers, seconds, rater, ranked = item
+                try:
+                    k_fac = self.session.k_fac(seconds)
+                    entry = self.session.entry(winner, losers, k_fac, **({ "rater" : rater } if rater else {}), **({ "ranked" : True } if ranked else {}))
+                    self.session.apply(winner, losers, k_fac, ranked)
+                except Exception as e:
+                    future.set_exception(e)
+                    continue
+                entries.append(entry)
+                self.raters[rater] = self.raters.get(rater, 0) + 1
+                futures.append(future)
+            profiler.record("apply batch", time.perf_counter() - start)
+            try:
+                if entries: 
+                    with timer("journal batch"): await loop.run_in_executor(self.executor, self.session.journal.record_many, entries)
+                for future in futures: future.set_result(self.session.count)
+            except Exception as e:
+                for future in futures: future.set_exception(e)
+            if (checkpoint and self.session.count > self.checkpointed) or \
+                    (self.checkpoint_every and self.session.count - self.checkpointed >= self.checkpoint_every):
+                database = self.session.database.copy()
+                with timer("checkpoint"): await loop.run_in_executor(self.executor, self.session.checkpoint, database)
+                self.checkpointed = self.session.count
+            for _ in batch: self.updates.task_done()
+
+    async def checkpointer(self):
+        while True:
+            await asyncio.sleep(self.checkpoint_seconds)
+            await self.updates.put((None, None))
+
+    @property
+    def status(self) -> dict:
+        return { "judgements" : self.session.count, "comparisons" : self.session.total_comparisons, "images" : self.session.database.image_count,
+                 "spearman start-end" : self.session.rank_tracker.spearman, "raters" : self.raters, "outstanding sets" : len(self.sets) }
+
+    async def route(self, method, target, body) -> tuple[int, str, bytes]:
+        path = urlsplit(target).path.strip("/")
+        as_json = lambda status, value : (status, "application/json", json.dumps(value).encode())
+        if path in ("", "index.html"):
+            return 200, "text/html; charset=utf-8", PAGE.encode()
+        if path == "next":
+            return as_json(200, self.next_set())
+        if path == "status":
+            return as_json(200, self.status)
+        if path == "judge":
+            if method != "POST": return as_json(405, { "error" : "POST a judgement" })
+            try:
+                judgement = json.loads(body)
+            except ValueError:
+                return as_json(400, { "error" : "judgement must be JSON" })
+            return as_json(*await self.judge(judgement if isinstance(judgement, dict) else {}))
+        if path.startswith("image/") and path[6:].isdigit():
+            slot = int(path[6:])
+            if slot >= len(self.session.database.paths): return as_json(404, { "error" : "no such image" })
+            try:
+                return 200, self.content_type, await self._image(ImageRecord(self.session.database, slot))
+            except OSError as e:
+                self.images.pop(slot, None)
+                return as_json(404, { "error" : str(e) })
+        return as_json(404, { "error" : "not found" })
+
+    async def handle(self, reader:asyncio.StreamReader, writer:asyncio.StreamWriter):
+        '''
+        A minimal HTTP/1.1 connection: requests are read and answered in turn until the client closes it
+        '''
+        try:
+            while (request_line := await reader.readline()):
+                method, target, version = request_line.decode('latin-1').split()
+                headers = {}
+                while (line := await reader.readline()) not in (b"\r\n", b"\n", b""):
+                    name, _, value = line.decode('latin-1').partition(":")
+                    headers[name.strip().lower()] = value.strip()
+                length = int(headers.get("content-length", 0))
+                if length > MAX_BODY:
+                    status, content_type, payload = 413, "text/plain", b""
+                else:
+                    body = await reader.readexactly(length) if length else b""
+                    status, content_type, payload = await self.route(method, target, body)
+                keep_alive = headers.get("connection", "").lower() != "close" and version == "HTTP/1.1"
+                writer.write((f"HTTP/1.1 {status} {STATUS.get(status, '')}\r\nContent-Type: {content_type}\r\nContent-Length: {len(payload)}\r\n"
+                              f"Cache-Control: no-store\r\nConnection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n").encode('latin-1') + payload)
+                await writer.drain()
+                if not keep_alive or status == 413: break
+        except (ConnectionError, ValueError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def run(self):
+        '''
+        Serve until cancelled (eg by Ctrl-C), then apply any judgements still queued
+        '''
+        self.updates:asyncio.Queue = asyncio.Queue()
+        tasks = [asyncio.create_task(self.updater()), asyncio.create_task(self.checkpointer())]
+        server = await asyncio.start_server(self.handle, self.host, self.port)
+        print(f"Serving on http://{self.host}:{self.port}/ (Ctrl-C to stop)")
+        try:
+            async with server:
+                await server.serve_forever()
+        except asyncio.CancelledError:
+            pass
+        finally:
+            await self.updates.join()
+            for task in tasks: task.cancel()
+            self.executor.shutdown(wait=False, cancel_futures=True)
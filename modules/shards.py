@@ -0,0 +1,173 @@
+import os, json, hashlib, itertools
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from modules.scoring import ImageDatabase
+from modules.journal import Journal
+from modules.bradley_terry import ChoiceLog, fit
+from modules.scorefiles import atomic_write
+from modules.profiling import timer
+
+OVERLAPS = ('content', 'path', 'none')
+
+class Shard:
+    '''
+    One directory with its own scorefile, and the comparison log (history, and any journal not yet compacted) beside it
+    '''
+    def __init__(self, directory, scores="scores.csv", name=None):
+        self.directory = directory
+        self.scores = scores
+        self.name = name
+        stem = os.path.join(directory, os.path.splitext(scores)[0])
+        self.log_filepaths = (stem+".history.jsonl", stem+".journal.jsonl.compacting", stem+".journal.jsonl")
+
+    def namespaced(self, relative_path) -> str:
+        return self.name + "/" + relative_path
+
+    def load(self, add_files=False) -> tuple[ImageDatabase, list[dict]]:
+        database = ImageDatabase(self.directory, loadfrom=self.scores, add_files=add_files, remove_files=False)
+        return database, [entry for filepath in self.log_filepaths for entry in Journal.read(filepath)]
+
+def _digest(filepath) -> str:
+    digest = hashlib.sha1()
+    with open(filepath, 'rb') as f:
+        while (chunk := f.read(1 << 20)): digest.update(chunk)
+    return digest.hexdigest()
+
+def _components(log:ChoiceLog, n) -> int:
+    '''
+    Number of groups of images (among those in log) that no chain of comparisons connects
+    '''
+    parent = list(range(n))
+    def root(k):
+        while parent[k] != k:
+            parent[k] = parent[parent[k]]
+            k = parent[k]
+        return k
+    for start, stop in zip(log.indptr, log.indptr[1:]):
+        first = root(log.indices[start])
+        for slot in log.indices[start+1:stop]: parent[root(slot)] = first
+    return len(set(root(s) for s in set(log.indices)))
+
+class ShardedDatabase:
+    '''
+    Several shards (directories scored separately, each with its own scorefile and comparison log) opened as one
+    collection in self.database. Paths are namespaced by the shard's name, which by default is its directory relative
+    to the shards' common parent, so they are also ordinary relative paths from there (self.base_directory).
+
+    Images found in more than one shard (by content, or by path within the shard) are overlaps: the copies are
+    pooled into the first (the canonical copy), and the others dropped, so each image has one record. merge() refits
+    every score to the union of the shards' comparison logs, with each copy read as its canonical copy, so that the
+    overlaps link the shards' otherwise independent scales.
+    '''
+    def __init__(self, shards:list[Shard], overlap='content', workers=None, add_files=False):
+        self.shards = shards
+        self.base_directory = os.path.commonpath([os.path.dirname(os.path.abspath(s.directory)) for s in shards])
+        for shard in shards:
+            if shard.name is None: shard.name = os.path.relpath(os.path.abspath(shard.directory), self.base_directory).replace(os.sep, "/")
+        if len(set(s.name for s in shards)) < len(shards): raise ValueError("shard names must be different")
+        workers = workers or len(shards)
+        with timer("load shards"), ThreadPoolExecutor(max_workers=workers) as executor:
+            loaded = list(executor.map(lambda s:s.load(add_files), shards))
+
+        self.database = ImageDatabase(self.base_directory, add_files=False, remove_files=False)
+        self.entries:list[dict] = []
+        self.shard_of:list[int] = []
+        for i, (shard, (database, entries)) in enumerate(zip(shards, loaded)):
+            order = database.order
+            relative_paths = [database.paths[s] for s in order.tolist()]
+            first = len(self.database.paths)
+            self.database.extend([shard.namespaced(rp) for rp in relative_paths], database.scores[order], database.comparisons[order],
+                                 { h : [values[s] for s in order.tolist()] for h, values in database.extra.items() })
+            self.shard_of.extend([i] * (len(self.database.paths) - first))
+            self.entries.extend(dict(e, winner=shard.namespaced(e['winner']), losers=[shard.namespaced(l) for l in e['losers']]) for e in entries)
+        self.database.metadata["shards"] = [s.name for s in shards]
+
+        with timer("find overlaps"): self.aliases = self.find_overlaps(overlap, workers)
+        self.copies = { self.database.paths[alias] : self.database.paths[canonical] for alias, canonical in self.aliases.items() }
+        self.pool()
+        self.database.remove(mask=np.isin(self.database.order, np.fromiter(self.aliases, dtype=np.int64, count=len(self.aliases))))
+
+    def _within_shard(self, slot) -> str:
+        return self.database.paths[slot][len(self.shards[self.shard_of[slot]].name)+1:]
+
+    def find_overlaps(self, overlap='content', workers=8) -> dict[int, int]:
+        '''
+        Map the slot of each copy of an image that is in more than one shard to the slot of its first copy. Copies are
+        files with the same content (only files whose sizes match are read), or with the same path within their shards.
+        '''
+        if overlap == 'none' or len(self.shards) < 2: return {}
+        slots = range(len(self.database.paths))
+        if overlap == 'path':
+            keys = { s : self._within_shard(s) for s in slots }
+        else:
+            sizes = {}
+            for s in slots:
+                try:
+                    sizes[s] = os.stat(os.path.join(self.base_directory, self.database.paths[s])).st_size
+                except OSError:
+                    pass
+            by_size = {}
+            for s, size in sizes.items(): by_size.setdefault(size, []).append(s)
+            candidates = [s for group in by_size.values() if len(set(self.shard_of[s] for s in group)) > 1 for s in group]
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                digests = executor.map(_digest, (os.path.join(self.base_directory, self.database.paths[s]) for s in candidates))
+                keys = { s : (sizes[s], d) for s, d in zip(candidates, digests) }
+        groups:dict = {}
+        for s, key in keys.items(): groups.setdefault(key, []).append(s)
+        return { s : group[0] for group in groups.values() if len(set(self.shard_of[s] for s in group)) > 1 for s in group[1:] }
+
+    @property
+    def groups(self) -> dict[int, list[int]]:
+        '''
+        First copy -> all the copies, for each image in more than one shard
+        '''
+        groups = {}
+        for alias, canonical in self.aliases.items(): groups.setdefault(canonical, [canonical]).append(alias)
+        return groups
+
+    def pool(self):
+        '''
+        Give every copy of an overlapping image the comparisons of all of them (each made in a different shard), and
+        their comparison-weighted mean score
+        '''
+        scores, comparisons = self.database.scores, self.database.comparisons
+        for copies in self.groups.values():
+            total = int(comparisons[copies].sum())
+            scores[copies] = np.dot(scores[copies], comparisons[copies]) / total if total else scores[copies].mean()
+            comparisons[copies] = total
+
+    def canonical(self, relative_path) -> str:
+        return self.copies.get(relative_path, relative_path)
+
+    def canonical_entries(self, comparisons=()):
+        '''
+        The shards' comparison logs, followed by comparisons, with every copy of an image named as its canonical copy
+        '''
+        for e in itertools.chain(self.entries, comparisons):
+            yield dict(e, winner=self.canonical(e['winner']), losers=[self.canonical(l) for l in e['losers']])
+
+    def merge(self, comparisons=(), prior=1.0) -> int:
+        '''
+        Refit all the scores (Bradley-Terry, see modules.bradley_terry) to the shards' comparison logs together with any
+        other comparisons (journal entries with namespaced paths, eg from a session comparing images from different shards).
+        Returns the number of separate groups of images, whose scores aren't on a common scale if there is more than one.
+        '''
+        log = ChoiceLog.from_entries(self.canonical_entries(comparisons), self.database)
+        if not len(log): return 0
+        with timer("refit"): self.database.scores[:], iterations = fit(self.database.scores, log, prior=prior)
+        components = _components(log, len(self.database.paths))
+        print(f"Fitted scores to {len(log)} comparisons from {len(self.shards)} shards in {iterations} iterations")
+        if components > 1: print(f"Warning: the comparisons fall into {components} separate groups of images, whose scores aren't comparable")
+        return components
+
+    def save_history(self, filepath, comparisons=()):
+        '''
+        Write the combined comparison log, with copies named as their canonical copy (as the history file of a scorefile
+        in the base directory, so that a later session with --updater=bt refits to all of it)
+        '''
+        with atomic_write(filepath) as f:
+            for entry in self.canonical_entries(comparisons): f.write(json.dumps(entry, separators=(',',':')) + "\n")
+
+    @property
+    def printable(self) -> str:
+        return f"{len(self.shards)} shards, {self.database.image_count} images ({len(self.aliases)} copies of images in other shards merged), {len(self.entries)} logged judgements"
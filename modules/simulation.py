@@ -0,0 +1,129 @@
+import time, random
+import numpy as np
+from modules.scoring import ImageDatabase, ScoreUpdater
+from modules.choosing import ImageChooser
+from modules.active import InformationChooser, BoundaryChooser
+from modules.bradley_terry import BradleyTerryUpdater, ChoiceLog, fit
+from modules.ranks import spearman
+
+class Oracle:
+    '''
+    A simulated rater. Each image has a true score; when shown a set, the rater perceives each true score plus
+    gaussian noise and picks the highest.
+    '''
+    def __init__(self, truth:np.ndarray, noise=0.5, rng:np.random.Generator=None):
+        self.truth = truth
+        self.noise = noise
+        self.rng = rng or np.random.default_rng()
+
+    def choose(self, slots:list[int]) -> int:
+        '''
+        Return the index (into slots) of the preferred image
+        '''
+        return int(np.argmax(self.truth[slots] + self.rng.normal(0, self.noise, len(slots))))
+
+    def rank(self, slots:list[int]) -> list[int]:
+        '''
+        Return the indices (into slots) in order of preference, best first
+        '''
+        return np.argsort(-(self.truth[slots] + self.rng.normal(0, self.noise, len(slots)))).tolist()
+
+class Simulation:
+    '''
+    Drive an ImageChooser and ScoreUpdater with an Oracle instead of a person, recording how well the scores
+    match the truth (and how long picks and updates take) every report_every sets. top is the size of the top set that
+    the boundary chooser looks for, and whose recovery is reported (by default a tenth of the images). With judgement='rank'
+    the rater puts each set in order instead of picking the best.
+    '''
+    def __init__(self, images=1000, noise=0.5, spread=1.0, k=0.7, lcw=0.4, number_to_compare=2, chooser='lcw', updater='elo', seed=None, top=None,
+                 judgement='choose'):
+        self.rng = np.random.default_rng(seed)
+        random.seed(seed)
+        self.database = ImageDatabase(".", add_files=False, remove_files=False)
+        self.database.extend([f"image_{i}" for i in range(images)])
+        self.oracle = Oracle(self.rng.normal(0, spread, len(self.database.scores)), noise, self.rng)
+        self.number_to_compare = number_to_compare
+        self.judgement = judgement
+        self.top = top or max(1, images // 10)
+        if chooser=='information': self.chooser = InformationChooser.from_database(self.database)
+        elif chooser=='boundary': self.chooser = BoundaryChooser.from_database(self.database, top=self.top)
+        else: self.chooser = ImageChooser.from_database(self.database, low_count_weight=lcw)
+        self.score_updater = BradleyTerryUpdater(k) if updater=='bt' else ScoreUpdater(k)
+        self.log = ChoiceLog() if updater=='bt' else None
+        self.count = 0
+        self.pick_time = 0.0
+        self.update_time = 0.0
+        self.last_ranks = self.ranks()
+
+    def ranks(self) -> np.ndarray:
+        return np.argsort(np.argsort(self.database.score_array, kind='stable'))
+
+    @property
+    def spearman_truth(self) -> float:
+        return spearman(self.ranks(), np.argsort(np.argsort(self.oracle.truth[self.database.order], kind='stable')))
+
+    @property
+    def top_found(self) -> float:
+        '''
+        Fraction of the true top images that are in the top by score
+        '''
+        slots = self.database.order
+        found = slots[np.argsort(-self.database.scores[slots], kind='stable')[:self.top]]
+        truth = slots[np.argsort(-self.oracle.truth[slots], kind='stable')[:self.top]]
+        return len(np.intersect1d(found, truth)) / self.top
+
+    def step(self):
+        start = time.perf_counter()
+        records = self.chooser.pick_images(self.number_to_compare)
+        self.pick_time += time.perf_counter() - start
+        if self.judgement=='rank':
+            ranking = [records[i] for i in self.oracle.rank([r.slot for r in records])]
+            start = time.perf_counter()
+            self.score_updater.update_ranking(ranking)
+            entry = { "winner" : ranking[0].slot, "losers" : [r.slot for r in ranking[1:]], "ranked" : True }
+        else:
+            win = self.oracle.choose([r.slot for r in records])
+            start = time.perf_counter()
+            for i, loser in enumerate(records):
+                if i!=win: self.score_updater.update_scores(winner=records[win], loser=loser)
+            entry = { "winner" : records[win].slot, "losers" : [r.slot for i, r in enumerate(records) if i!=win] }
+        self.chooser.refresh(records)
+        self.update_time += time.perf_counter() - start
+        if self.log is not None:
+            for winner, shown in ChoiceLog.choices(entry): self.log.add(winner, shown)
+        self.count += 1
+
+    def run(self, sets, report_every=100):
+        '''
+        Make sets comparisons, yielding a row (see for_csv) every report_every, and after the last if it falls between
+        '''
+        for _ in range(sets):
+            self.step()
+            if self.count % report_every == 0: yield self.report()
+        if self.count % report_every: yield self.report()
+
+    def report(self) -> tuple:
+        if self.log is not None:
+            start = time.perf_counter()
+            self.database.scores[:], _ = fit(self.database.scores, self.log, prior=self.score_updater.prior)
+            self.update_time += time.perf_counter() - start
+            self.chooser.refresh(self.database.records)
+        ranks = self.ranks()
+        since_last = spearman(self.last_ranks, ranks)
+        self.last_ranks = ranks
+        row = self.database.for_csv + self.score_updater.for_csv + (since_last, self.spearman_truth, self.top_found,
+                    1e6*self.pick_time/self.count, 1e6*self.update_time/self.count)
+        return row
+
+    @property
+    def for_csv_headers(self):
+        return self.database.for_csv_headers + self.score_updater.for_csv_headers + ("spearman since last report", "spearman truth", "top found", "pick us", "update us")
+
+def comparisons_to_plateau(comparisons:list[int], spearman:list[float], tolerance=0.01) -> int:
+    '''
+    The number of comparisons after which spearman stays within tolerance of the best value reached
+    '''
+    best = max(spearman)
+    for i in reversed(range(len(spearman))):
+        if spearman[i] < best - tolerance: return comparisons[min(i+1, len(spearman)-1)]
+    return comparisons[0]
@@ -0,0 +1,119 @@
+from bisect import bisect_left, insort
+from modules.choosing import FenwickTree
+
+class ScoreIndex:
+    '''
+    Order statistics over (score, slot) items, in ascending order. Items are kept in a list of sorted blocks
+    (as in sortedcontainers), with the last item of each block kept for bisection and a Fenwick tree of block
+    lengths for rank lookups, so add, remove, rank and at are O(log n) plus a memmove of at most 2*load items.
+
+    If weight (item -> number) is given, a Fenwick tree of the weight in each block is kept too, so weight_sum
+    over a range of ranks is O(log n + load).
+    '''
+    def __init__(self, items=(), load=500, weight:callable=None):
+        self.load = load
+        self.weight = weight
+        items = sorted(items)
+        self.blocks:list[list[tuple[float, int]]] = [items[i:i+load] for i in range(0, len(items), load)]
+        self._rebuild()
+
+    def _rebuild(self):
+        self.maxes = [block[-1] for block in self.blocks]
+        self.lengths = FenwickTree([len(block) for block in self.blocks])
+        if self.weight: self.sums = FenwickTree([sum(self.weight(item) for item in block) for block in self.blocks])
+
+    def __len__(self):
+        return int(round(self.lengths.total)) if self.blocks else 0
+
+    def __iter__(self):
+        for block in self.blocks: yield from block
+
+    def _block(self, item) -> int:
+        return min(bisect_left(self.maxes, item), len(self.blocks)-1)
+
+    def add(self, score, slot):
+        item = (score, slot)
+        if not self.blocks:
+            self.blocks = [[item]]
+            self._rebuild()
+            return
+        b = self._block(item)
+        block = self.blocks[b]
+        insort(block, item)
+        self.maxes[b] = block[-1]
+        if len(block) > 2*self.load:
+            self.blocks[b:b+1] = [block[:self.load], block[self.load:]]
+            self._rebuild()
+        else:
+            self.lengths[b] = len(block)
+            if self.weight: self.sums[b] += self.weight(item)
+
+    def remove(self, score, slot):
+        item = (score, slot)
+        b = self._block(item)
+        block = self.blocks[b]
+        i = bisect_left(block, item)
+        if i == len(block) or block[i] != item: raise KeyError(item)
+        del block[i]
+        if not block:
+            del self.blocks[b]
+            self._rebuild()
+        else:
+            self.maxes[b] = block[-1]
+            self.lengths[b] = len(block)
+            if self.weight: self.sums[b] -= self.weight(item)
+
+    def update(self, slot, old_score, new_score):
+        if old_score == new_score: return
+        self.remove(old_score, slot)
+        self.add(new_score, slot)
+
+    def rank(self, score, slot) -> int:
+        '''
+        Position (0 = lowest score) of the item
+        '''
+        item = (score, slot)
+        b = self._block(item)
+        return int(round(self.lengths.prefix(b))) + bisect_left(self.blocks[b], item)
+
+    def bisect(self, score) -> int:
+        '''
+        Position of the first item with a score of at least score
+        '''
+        if not self.blocks: return 0
+        b = bisect_left(self.maxes, (score, -1))
+        if b == len(self.blocks): return len(self)
+        return int(round(self.lengths.prefix(b))) + bisect_left(self.blocks[b], (score, -1))
+
+    def at(self, rank) -> tuple[float, int]:
+        if rank < 0: rank += len(self)
+        if not 0 <= rank < len(self): raise IndexError(rank)
+        b = self.lengths.find(rank + 0.5)
+        return self.blocks[b][rank - int(round(self.lengths.prefix(b)))]
+
+    def slice(self, start, stop) -> list[tuple[float, int]]:
+        start, stop = max(0, start), min(len(self), stop)
+        if start >= stop: return []
+        result = []
+        b = self.lengths.find(start + 0.5)
+        i = start - int(round(self.lengths.prefix(b)))
+        while len(result) < stop - start:
+            result.extend(self.blocks[b][i:i + stop - start - len(result)])
+            b, i = b + 1, 0
+        return result
+
+    def weight_sum(self, start, stop) -> float:
+        '''
+        Total weight of the items with ranks start..stop-1
+        '''
+        return self._weight_prefix(stop) - self._weight_prefix(start)
+
+    def _weight_prefix(self, rank) -> float:
+        rank = min(max(0, rank), len(self))
+        if rank == 0: return 0.0
+        if rank == len(self): return self.sums.total
+        b = self.lengths.find(rank + 0.5)
+        i = rank - int(round(self.lengths.prefix(b)))
+        block = self.blocks[b]
+        if 2*i <= len(block): return self.sums.prefix(b) + sum(map(self.weight, block[:i]))
+        return self.sums.prefix(b+1) - sum(map(self.weight, block[i:]))
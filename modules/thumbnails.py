@@ -0,0 +1,136 @@
+import os, io, hashlib, threading
+from collections import OrderedDict
+
+CACHE_DIRECTORY = ".thumbnails"
+
+def scale_to_height(filepath, height) -> 'Image.Image':
+    from PIL import Image
+    with Image.open(filepath) as im:
+        size = (max(1, int(height*im.width/im.height)), height)
+        im.draft(None, size)
+        return im.resize(size, Image.LANCZOS) if im.size != size else im.copy()
+
+def encode(im:'Image.Image', format="WEBP", quality=90, file=None):
+    '''
+    Save im to file (a path or file object) in format, or return the encoded bytes if file is None
+    '''
+    buffer = io.BytesIO() if file is None else file
+    if format=="WEBP":
+        im.save(buffer, format="WEBP", quality=quality)
+    else:
+        (im if im.mode in ("RGB", "L") else im.convert("RGB")).save(buffer, format="JPEG", quality=quality)
+    if file is None: return buffer.getvalue()
+
+class ThumbnailCache:
+    '''
+    Content-addressed cache of images scaled to a display height, kept in CACHE_DIRECTORY under the base directory.
+    Thumbnails are keyed by (path, mtime, height), so an edited image or a new height just produces a new key.
+    When the cache grows beyond max_bytes the least recently used thumbnails are deleted (file mtimes record
+    last use, so the LRU order survives between runs).
+    '''
+    def __init__(self, base_directory, height, max_bytes=512*1024*1024, format="WEBP", quality=90):
+        self.base_directory = base_directory
+        self.directory = os.path.join(base_directory, CACHE_DIRECTORY)
+        self.height = height
+        self.max_bytes = max_bytes
+        self.format = format
+        self.quality = quality
+        self.lock = threading.Lock()
+        self.entries:OrderedDict[str, int] = OrderedDict()
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(self.directory, exist_ok=True)
+        with os.scandir(self.directory) as it:
+            found = [(e.stat().st_mtime_ns, e.name, e.stat().st_size) for e in it if e.is_file() and not e.name.endswith(".tmp")]
+        for _, name, size in sorted(found):
+            self.entries[name] = size
+            self.total_bytes += size
+
+    @property
+    def extension(self): return ".webp" if self.format=="WEBP" else ".jpg"
+
+    @property
+    def content_type(self): return "image/webp" if self.format=="WEBP" else "image/jpeg"
+
+    def key(self, relative_path, mtime_ns) -> str:
+        return hashlib.sha1(f"{relative_path}|{mtime_ns}|{self.height}".encode()).hexdigest() + self.extension
+
+    def _store(self, name, im:'Image.Image'):
+        temppath = os.path.join(self.directory, name + ".tmp")
+        try:
+            encode(im, self.format, self.quality, temppath)
+            os.replace(temppath, os.path.join(self.directory, name))
+        except Exception:
+            try:
+                os.remove(temppath)
+            except OSError:
+                pass
+            raise
+        size = os.path.getsize(os.path.join(self.directory, name))
+        with self.lock:
+            self.total_bytes += size - self.entries.pop(name, 0)
+            self.entries[name] = size
+            while self.total_bytes > self.max_bytes and len(self.entries) > 1:
+                oldest, oldest_size = self.entries.popitem(last=False)
+                self.total_bytes -= oldest_size
+                try:
+                    os.remove(os.path.join(self.directory, oldest))
+                except OSError:
+                    pass
+
+    def get(self, relative_path) -> 'Image.Image':
+        '''
+        Return the image at relative_path (relative to the base directory, or absolute) scaled to height
+        '''
+        from PIL import Image
+        filepath = os.path.join(self.base_directory, relative_path)
+        name = self.key(relative_path, os.stat(filepath).st_mtime_ns)
+        cachepath = os.path.join(self.directory, name)
+        if name in self.entries:
+            try:
+                with Image.open(cachepath) as im:
+                    im.load()
+                os.utime(cachepath)
+                with self.lock:
+                    if name in self.entries: self.entries.move_to_end(name)
+                self.hits += 1
+                return im
+            except OSError:
+                with self.lock:
+                    self.total_bytes -= self.entries.pop(name, 0)
+        self.misses += 1
+        im = scale_to_height(filepath, self.height)
+        try:
+            self._store(name, im)
+        except (OSError, KeyError, ValueError) as e:
+            print(f"Couldn't cache thumbnail for {relative_path}: {e}")
+        return im
+
+    def _encode(self, relative_path, im:'Image.Image') -> bytes:
+        try:
+            return encode(im, self.format, self.quality)
+        except (KeyError, ValueError) as e:
+            raise OSError(f"Couldn't encode {relative_path}: {e}") from e
+
+    def get_bytes(self, relative_path) -> bytes:
+        '''
+        Return the thumbnail of relative_path encoded in self.format (for serving), straight from the cache if it is there.
+        Raises OSError if the image can't be read or encoded.
+        '''
+        name = self.key(relative_path, os.stat(os.path.join(self.base_directory, relative_path)).st_mtime_ns)
+        cached = name in self.entries
+        if not cached:
+            im = self.get(relative_path)
+            if name not in self.entries: return self._encode(relative_path, im)
+        cachepath = os.path.join(self.directory, name)
+        try:
+            with open(cachepath, 'rb') as f:
+                data = f.read()
+            os.utime(cachepath)
+            with self.lock:
+                if name in self.entries: self.entries.move_to_end(name)
+            if cached: self.hits += 1
+            return data
+        except OSError:
+            return self._encode(relative_path, self.get(relative_path))
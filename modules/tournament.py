@@ -0,0 +1,149 @@
+import os, json, math, random
+import numpy as np
+from modules.scoring import ImageDatabase, ImageRecord
+from modules.bradley_terry import ChoiceLog, fit
+from modules.scorefiles import atomic_write
+
+def merge_insertion(items:list):
+    '''
+    Ford-Johnson merge-insertion sort, which needs close to the fewest comparisons possible, written as a generator:
+    it yields pairs (a, b), must be sent the better of each, and returns the items best first.
+    '''
+    n = len(items)
+    if n < 2: return list(items)
+    pairs = []
+    for i in range(0, n-1, 2):
+        winner = yield (items[i], items[i+1])
+        pairs.append((items[i+1], items[i]) if winner == items[i] else (items[i], items[i+1]))   # (loser, winner)
+    loser = { w : l for l, w in pairs }
+    highs = yield from merge_insertion([w for _, w in pairs])
+    highs.reverse()
+    chain = [loser[highs[0]]] + highs    # worst first
+    pending = [(loser[a], a) for a in highs[1:]] + ([(items[-1], None)] if n % 2 else [])
+    # insert b_2, b_3... (pending[0], pending[1]...) in groups ending at the Jacobsthal numbers, so that each binary search is over 2^k-1 items
+    jacobsthal = [1, 3]
+    while jacobsthal[-1] <= len(pending): jacobsthal.append(jacobsthal[-1] + 2*jacobsthal[-2])
+    for previous, last in zip(jacobsthal, jacobsthal[1:]):
+        for k in range(min(last, len(pending)+1), previous, -1):
+            item, bound = pending[k-2]
+            low, high = 0, chain.index(bound) if bound is not None else len(chain)
+            while low < high:
+                middle = (low + high) // 2
+                winner = yield (item, chain[middle])
+                if winner == item: low = middle + 1
+                else: high = middle
+            chain.insert(low, item)
+    chain.reverse()
+    return chain
+
+def comparisons_needed(n) -> int:
+    '''
+    Most comparisons merge_insertion can need for n items
+    '''
+    return sum(math.ceil(math.log2(3*k/4)) for k in range(1, n+1))
+
+def decreasing(values:np.ndarray) -> np.ndarray:
+    '''
+    The closest (least squares) non-increasing sequence to values (pool adjacent violators)
+    '''
+    blocks:list[list[float]] = []    # [mean, count]
+    for v in values.tolist():
+        blocks.append([v, 1])
+        while len(blocks) > 1 and blocks[-2][0] < blocks[-1][0]:
+            v2, c2 = blocks.pop()
+            blocks[-1] = [(blocks[-1][0]*blocks[-1][1] + v2*c2) / (blocks[-1][1] + c2), blocks[-1][1] + c2]
+    return np.repeat([b[0] for b in blocks], [b[1] for b in blocks])
+
+class Tournament:
+    '''
+    Ranks every image with a comparison sort (merge_insertion), asking for just the comparisons it needs, one pair at a time.
+    Used in place of an image chooser: pick_images() returns the pair the sort is waiting for, and answer() gives it the result.
+
+    The order in which the images entered the sort is kept in a state file; the answers are the comparisons in the journal
+    and history. When restarted, the sort replays them (taking the latest answer for each pair, including any comparisons
+    made in normal scoring) and carries on where it left off. Images found since the start are added at the end of the order.
+    Slots in exclude (eg near duplicates) are left out of the sort.
+    '''
+    def __init__(self, database:ImageDatabase, filepath, entries=(), exclude:set[int]=None):
+        self.database = database
+        self.filepath = filepath
+        order = []
+        if os.path.exists(filepath):
+            with open(filepath, 'r') as f: order = json.load(f).get('order', [])
+        slots = database.slots
+        order = [rp for rp in order if rp in slots]
+        known = set(order)
+        new = [rp for rp in database.paths_in_order if rp not in known]
+        random.shuffle(new)
+        if new or not os.path.exists(filepath):
+            order += new
+            with atomic_write(filepath) as f: json.dump({ "order" : order }, f)
+        self.items = [slots[rp] for rp in order if slots[rp] not in (exclude or ())]
+        self.answers:dict[frozenset, int] = {}
+        for entry in entries:
+            for winner, shown in ChoiceLog.choices(entry):
+                if winner not in slots: continue
+                for rp in shown:
+                    if rp != winner and rp in slots: self.answers[frozenset((slots[winner], slots[rp]))] = slots[winner]
+        self.sorter = merge_insertion(self.items)
+        self.pending:tuple[int, int] = None
+        self.ranking:list[int] = None
+        self.replayed = 0
+        self.asked = 0
+        self._run(lambda : next(self.sorter))
+
+    def _run(self, step:callable):
+        try:
+            pair = step()
+            while (winner := self.answers.get(frozenset(pair))) is not None:
+                self.replayed += 1
+                pair = self.sorter.send(winner)
+            self.pending = pair
+        except StopIteration as done:
+            self.pending, self.ranking = None, done.value
+
+    @property
+    def done(self) -> bool: return self.ranking is not None
+
+    def pick_images(self, number=2) -> list[ImageRecord]:
+        assert number == 2 and not self.done
+        return [ImageRecord(self.database, s) for s in self.pending]
+
+    def answer(self, winner:ImageRecord, losers:list[ImageRecord]):
+        for loser in losers: self.answers[frozenset((winner.slot, loser.slot))] = winner.slot
+        if self.pending is not None and frozenset(self.pending) in self.answers:
+            self.asked += 1
+            self._run(lambda : self.sorter.send(self.answers[frozenset(self.pending)]))
+
+    def extend(self, image_records:list[ImageRecord]): pass
+
+    def refresh(self, image_records:list[ImageRecord]): pass
+
+    def finish(self, entries, prior=1.0):
+        '''
+        Store the ranking (1 = best) in a rank column, and make the scores a Bradley-Terry fit to all the comparisons,
+        evened out where needed (see decreasing) so that they fall in rank order
+        '''
+        database, ranking = self.database, np.array(self.ranking, dtype=np.int64)
+        log = ChoiceLog.from_entries(entries, database)
+        if len(log): database.scores[:], _ = fit(database.scores, log, prior=prior)
+        database.scores[ranking] = decreasing(database.scores[ranking])
+        if 'rank' not in database.extra:
+            database.extra['rank'] = [""] * len(database.paths)
+            if 'rank' not in database.header: database.header.append('rank')
+        for rank, slot in enumerate(self.ranking, 1): database.extra['rank'][slot] = str(rank)
+        database.sort(reverse=True, tiebreak=self.ranks)
+
+    @property
+    def ranks(self) -> np.ndarray:
+        '''
+        Rank (1 = best) of each slot in the finished ranking, len(ranking)+1 for images not in it
+        '''
+        ranks = np.full(len(self.database.scores), len(self.ranking) + 1, dtype=np.int64)
+        ranks[self.ranking] = np.arange(1, len(self.ranking) + 1)
+        return ranks
+
+    @property
+    def printable(self) -> str:
+        if self.done: return f"ranking of {len(self.items)} images complete"
+        return f"{self.replayed + self.asked} of at most {comparisons_needed(len(self.items))} comparisons"
@@ -0,0 +1,80 @@
+import argparse, itertools, os
+
+from modules.simulation import Simulation, comparisons_to_plateau
+
+class CommentArgumentParser(argparse.ArgumentParser):
+    def convert_arg_line_to_args(self, arg_line):
+        if arg_line.startswith('#'): return [] 
+        line = "=".join(a.strip() for a in arg_line.split('='))
+        return [line,] if len(line) else []
+
+def parse_arguments():
+    to_list = lambda t : lambda s : list( t(x.strip()) for x in s.split(',') )
+
+    parser = CommentArgumentParser("Simulate AB scoring against a synthetic rater, to tune the scoring parameters", fromfile_prefix_chars='@')
+    parser.add_argument('--images', type=int, default=1000, help="Number of simulated images")
+    parser.add_argument('--sets', type=int, default=10000, help="Number of sets of images to compare in each run")
+    parser.add_argument('--report_every', type=int, default=100, help="Report (and write a csv row) after this many sets")
+    parser.add_argument('--noise', type=float, default=0.5, help="Standard deviation of the simulated rater's perception noise")
+    parser.add_argument('--spread', type=float, default=1.0, help="Standard deviation of the true scores")
+    parser.add_argument('--repeats', type=int, default=1, help="Number of runs for each combination of parameters")
+    parser.add_argument('--seed', type=int, default=None, help="Random seed")
+    parser.add_argument('--top', type=int, default=None, help="Size of the top set sought by the boundary chooser, and whose recovery is reported (default a tenth of --images)")
+    parser.add_argument('--plateau', type=float, default=0.01, help="Tolerance used to decide when spearman has plateaued")
+    parser.add_argument('--output', default="simulation.csv", help="Append results to this csv file")
+
+    parser.add_argument('--k', type=to_list(float), default=[0.7], help="Comma separated list of K values to try")
+    parser.add_argument('--lcw', type=to_list(float), default=[0.4], help="Comma separated list of lcw values to try")
+    parser.add_argument('--number_to_compare', type=to_list(int), default=[2], help="Comma separated list of numbers of images to choose from")
+    parser.add_argument('--chooser', type=to_list(str), default=['lcw'], help="Comma separated list of choosers (lcw, information, boundary)")
+    parser.add_argument('--updater', type=to_list(str), default=['elo'], help="Comma separated list of updaters (elo, bt)")
+    parser.add_argument('--judgement', type=to_list(str), default=['choose'], help="Comma separated list of ways to judge a set (choose: pick the best, rank: put them all in order)")
+
+    args = parser.parse_args()
+    if args.top is not None and args.top < 1: parser.error("--top must be at least 1")
+    return args
+
+def output_path(filepath, header) -> str:
+    '''
+    filepath, unless it already holds results with different columns, in which case the first of filepath_1,
+    filepath_2... that is new or has the same columns
+    '''
+    stem, ext = os.path.splitext(filepath)
+    for i in itertools.count():
+        path = filepath if i==0 else f"{stem}_{i}{ext}"
+        if not os.path.exists(path): return path
+        with open(path) as f:
+            if f.readline().rstrip("\n") in ("", header): return path
+
+def main():
+    args = parse_arguments()
+    parameter_headers = ("run", "k", "lcw", "number_to_compare", "chooser", "updater", "judgement")
+    f = None
+    run = 0
+    try:
+        for k, lcw, number_to_compare, chooser, updater, judgement in itertools.product(args.k, args.lcw, args.number_to_compare, args.chooser, args.updater, args.judgement):
+            for _ in range(args.repeats):
+                seed = None if args.seed is None else args.seed + run
+                simulation = Simulation(args.images, args.noise, args.spread, k, lcw, number_to_compare, chooser, updater, seed, args.top, judgement)
+                if f is None:
+                    header = ",".join(parameter_headers + simulation.for_csv_headers)
+                    path = output_path(args.output, header)
+                    if path != args.output: print(f"{args.output} has different columns, appending results to {path} instead")
+                    f = open(path, 'a')
+                    if f.tell() == 0: print(header, file=f)
+                comparisons, spearman, top_found = [], [], []
+                for row in simulation.run(args.sets, args.report_every):
+                    print(",".join(str(x) for x in (run, k, lcw, number_to_compare, chooser, updater, judgement) + row), file=f)
+                    comparisons.append(row[0])
+                    spearman.append(row[simulation.for_csv_headers.index("spearman truth")])
+                    top_found.append(row[simulation.for_csv_headers.index("top found")])
+                f.flush()
+                if comparisons: print("k={:<5} lcw={:<5} n={:<2} {:>11} {:>3} {:>6}: spearman truth {:>6.4f}, top {:.0%} found, plateau after {:>7} comparisons, {:>7.1f} us/pick, {:>7.1f} us/update".format(
+                    k, lcw, number_to_compare, chooser, updater, judgement, spearman[-1], top_found[-1], comparisons_to_plateau(comparisons, spearman, args.plateau),
+                    1e6*simulation.pick_time/simulation.count, 1e6*simulation.update_time/simulation.count))
+                run += 1
+    finally:
+        if f is not None: f.close()
+
+if __name__=='__main__':
+    main()